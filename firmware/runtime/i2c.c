@@ -1,186 +1,268 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <irq.h>
+#include <system.h>
+#include <hw/common.h>
 #include <generated/csr.h>
+#include <generated/mem.h>
 #include "i2c.h"
 
-static void i2c_halfperiod()
+/* I2CMaster registers, see gateware/i2c.py. There is a single bus. */
+#define I2C_XFER   MMPTR(I2C_BASE + 4*0)
+#define I2C_CONFIG MMPTR(I2C_BASE + 4*1)
+#define I2C_FIFO   MMPTR(I2C_BASE + 4*2)
+#define I2C_HOLD   MMPTR(I2C_BASE + 4*3)
+
+#define I2C_ACK     (1 << 8)
+#define I2C_READ    (1 << 9)
+#define I2C_WRITE   (1 << 10)
+#define I2C_START   (1 << 11)
+#define I2C_STOP    (1 << 12)
+#define I2C_IDLE    (1 << 13)
+#define I2C_FULL    (1 << 14)
+#define I2C_REFUSED (1 << 15)
+#define I2C_ERROR   I2C_ACK
+
+/* Register capture engine, see gateware/i2c_capture.py */
+#define I2C_CAPTURE_CTRL  MMPTR(I2C_BASE + 4*0x200)
+#define I2C_CAPTURE_DEV   MMPTR(I2C_BASE + 4*0x201)
+#define I2C_CAPTURE_REG   MMPTR(I2C_BASE + 4*0x202)
+#define I2C_CAPTURE_COUNT MMPTR(I2C_BASE + 4*0x203)
+#define I2C_CAPTURE_DATA(i) MMPTR(I2C_BASE + 4*(0x300 + (i)))
+
+#define I2C_CAPTURE_BUSY  (1 << 0)
+#define I2C_CAPTURE_ERROR (1 << 2)
+#define I2C_CAPTURE_DEPTH 256
+
+/* DMA engine, see gateware/i2c_dma.py */
+#define I2C_DMA_CTRL    MMPTR(I2C_BASE + 4*0x400)
+#define I2C_DMA_HEAD    MMPTR(I2C_BASE + 4*0x401)
+#define I2C_DMA_CURRENT MMPTR(I2C_BASE + 4*0x402)
+#define I2C_DMA_COUNT   MMPTR(I2C_BASE + 4*0x403)
+
+#define I2C_DMA_BUSY  (1 << 0)
+#define I2C_DMA_ERROR (1 << 2)
+
+/* Event sources, in the order of the gateware */
+#define I2C_EV_IDLE (1 << 0)
+#define I2C_EV_DMA  (1 << 1)
+
+static i2c_callback_t i2c_callback;
+static i2c_callback_t i2c_dma_callback;
+/* A NACK of the queued frames, cleared by i2c_xfer() with a refusal */
+static int i2c_nacked;
+
+static int i2c_xfer(int busno, int command)
 {
-    timer0_en_write(0);
-    timer0_load_write(CONFIG_CLOCK_FREQUENCY/10000); //5kHz
-    timer0_reload_write(0);
-    timer0_en_write(1);
+    int status;
 
-    timer0_update_value_write(1);
-    while(timer0_value_read() != 0)
-        timer0_update_value_write(1);
+    /* Single transfers must not interleave with queued frames or a DMA
+     * list. The command is refused if an engine takes the master between
+     * the poll and the write (I2C_REFUSED), and is then sent again.
+     */
+    while(1) {
+        while(i2c_dma_busy(busno));
+        while(!(I2C_FIFO & I2C_IDLE));
+        I2C_XFER = command;
+        do
+            status = I2C_XFER;
+        while(!(status & I2C_IDLE));
+        if(!(status & I2C_REFUSED))
+            return status;
+        if(I2C_FIFO & I2C_ERROR)
+            i2c_nacked = 1;
+        I2C_FIFO = I2C_ERROR;
+    }
 }
 
-#define SDA_BIT (1 << (2*busno + 1))
-#define SCL_BIT (1 << (2*busno))
+void i2c_init(int busno)
+{
+    I2C_CONFIG = CONFIG_I2C_DIVIDER;
+    I2C_HOLD = CONFIG_I2C_HOLD;
+    /* Clear a stale error from before a CPU reset */
+    I2C_FIFO = I2C_ERROR;
+}
 
-static int i2c_sda_i(int busno)
+void i2c_start(int busno)
 {
-    return i2c_in_read() & SDA_BIT;
+    i2c_xfer(busno, I2C_START);
 }
 
-static void i2c_sda_oe(int busno, int oe)
+void i2c_restart(int busno)
 {
-    int reg;
+    i2c_xfer(busno, I2C_STOP | I2C_START);
+}
 
-    reg = i2c_oe_read();
-    if(oe)
-        reg |= SDA_BIT;
-    else
-        reg &= ~SDA_BIT;
-    i2c_oe_write(reg);
+void i2c_stop(int busno)
+{
+    i2c_xfer(busno, I2C_STOP);
 }
 
-static void i2c_sda_o(int busno, int o)
+int i2c_write(int busno, int b)
 {
-    int reg;
+    /* returns 1 if acked */
+    return (i2c_xfer(busno, I2C_WRITE | (b & 0xff)) & I2C_ACK) != 0;
+}
 
-    reg = i2c_out_read();
-    if(o)
-        reg |= SDA_BIT;
-    else
-        reg &= ~SDA_BIT;
-    i2c_out_write(reg);
+int i2c_read(int busno, int ack)
+{
+    return i2c_xfer(busno, I2C_READ | (ack ? I2C_ACK : 0)) & 0xff;
 }
 
-static void i2c_scl_oe(int busno, int oe)
+/* Queues a whole write frame, START before the first octet and STOP after
+ * the last, and returns without waiting for it to be sent. The bus stalls
+ * only while the transmit FIFO is full. A NACK aborts the frame and the
+ * error is reported by i2c_wait() or the callback. Waits for a DMA list
+ * first.
+ */
+void i2c_queue(int busno, const uint8_t *frame, int len)
 {
-    int reg;
+    int i, word;
 
-    reg = i2c_oe_read();
-    if(oe)
-        reg |= SCL_BIT;
-    else
-        reg &= ~SCL_BIT;
-    i2c_oe_write(reg);
+    /* The FIFO writes are refused while the DMA engine owns the master */
+    while(i2c_dma_busy(busno));
+    for(i=0;i<len;i++) {
+        word = frame[i];
+        if(i == 0)
+            word |= I2C_START;
+        if(i == len - 1)
+            word |= I2C_STOP;
+        I2C_FIFO = word;
+    }
 }
 
-static void i2c_scl_o(int busno, int o)
+int i2c_busy(int busno)
 {
-    int reg;
-
-    reg = i2c_out_read();
-    if(o)
-        reg |= SCL_BIT;
-    else
-        reg &= ~SCL_BIT;
-    i2c_out_write(reg);
+    return !(I2C_FIFO & I2C_IDLE);
 }
 
+/* Waits for all queued frames, returns -1 if one of them was NACKed or
+ * refused by an engine
+ */
+int i2c_wait(int busno)
+{
+    int status;
 
-void i2c_init(int busno)
+    do
+        status = I2C_FIFO;
+    while(!(status & I2C_IDLE));
+    if((status & (I2C_ERROR | I2C_REFUSED)) || i2c_nacked) {
+        I2C_FIFO = I2C_ERROR;
+        i2c_nacked = 0;
+        return -1;
+    }
+    return 0;
+}
+
+/* Reads len registers of dev (write address) from reg into buf, in a single
+ * frame run by the capture engine. Waits for the queued frames first.
+ * Returns -1 if the frame was NACKed.
+ */
+int i2c_capture(int busno, int dev, int reg, uint8_t *buf, int len)
 {
-    /* Set SCL as output, and high level */
-    i2c_scl_o(busno, 1);
-    i2c_scl_oe(busno, 1);
-    /* Prepare a zero level on SDA so that i2c_sda_oe pulls it down */
-    i2c_sda_o(busno, 0);
-    /* Release SDA */
-    i2c_sda_oe(busno, 0);
-
-    /* Check the I2C bus is ready */
-    i2c_halfperiod();
-    i2c_halfperiod();
-    if(!i2c_sda_i(busno)) {
-        puts("SDA is stuck low");
-        abort();
+    int i, word = 0;
+
+    if(len > I2C_CAPTURE_DEPTH)
+        return -1;
+    I2C_CAPTURE_DEV = dev;
+    I2C_CAPTURE_REG = reg;
+    I2C_CAPTURE_COUNT = len;
+    I2C_CAPTURE_CTRL = I2C_CAPTURE_BUSY;
+    while(I2C_CAPTURE_CTRL & I2C_CAPTURE_BUSY);
+    if(I2C_CAPTURE_CTRL & I2C_CAPTURE_ERROR)
+        return -1;
+    for(i=0;i<len;i++) {
+        if(i % 4 == 0)
+            word = I2C_CAPTURE_DATA(i/4);
+        buf[i] = word >> 8*(i % 4);
     }
+    return 0;
 }
 
-void i2c_start(int busno)
+/* Fills desc, a frame to or from dev (write address) at reg, followed by
+ * next or the end of the list if next is NULL. buf is word aligned.
+ */
+void i2c_dma_desc_init(struct i2c_dma_desc *desc, struct i2c_dma_desc *next,
+                       int dev, int reg, int flags, void *buf, int len)
 {
-    /* Set SCL high then SDA low */
-    i2c_scl_o(busno, 1);
-    i2c_halfperiod();
-    i2c_sda_oe(busno, 1);
-    i2c_halfperiod();
+    desc->next = (uint32_t)next;
+    desc->ctl = (dev & 0xff) | ((reg & 0xff) << 8) | flags;
+    desc->buffer = (uint32_t)buf;
+    desc->length = len;
+    desc->status = 0;
 }
 
-void i2c_restart(int busno)
+/* Runs the list of descriptors at head after the queued frames and a list
+ * still running, and returns at once. The descriptors and the buffers must
+ * stay in place until i2c_dma_wait() returns or the callback is called.
+ * i2c_wait() and the idle callback wait for the list too.
+ */
+void i2c_dma_submit(int busno, struct i2c_dma_desc *head)
 {
-    /* Set SCL low then SDA high */
-    i2c_scl_o(busno, 0);
-    i2c_halfperiod();
-    i2c_sda_oe(busno, 0);
-    i2c_halfperiod();
-    /* Do a regular start */
-    i2c_start(busno);
+    /* The engine reads HEAD when it starts */
+    while(i2c_dma_busy(busno));
+    I2C_DMA_HEAD = (uint32_t)head;
+    I2C_DMA_CTRL = I2C_DMA_BUSY;
 }
 
-void i2c_stop(int busno)
+int i2c_dma_busy(int busno)
 {
-    /* First, make sure SCL is low, so that the target releases the SDA line */
-    i2c_scl_o(busno, 0);
-    i2c_halfperiod();
-    /* Set SCL high then SDA high */
-    i2c_sda_oe(busno, 1);
-    i2c_scl_o(busno, 1);
-    i2c_halfperiod();
-    i2c_sda_oe(busno, 0);
-    i2c_halfperiod();
+    return (I2C_DMA_CTRL & I2C_DMA_BUSY) != 0;
 }
 
-int i2c_write(int busno, int b)
+/* Waits for the list, returns -1 if a descriptor was NACKed. The status
+ * words of the descriptors and the buffers read are valid afterwards.
+ */
+int i2c_dma_wait(int busno)
 {
-    int i;
-
-    /* MSB first */
-    for(i=7;i>=0;i--) {
-        /* Set SCL low and set our bit on SDA */
-        i2c_scl_o(busno, 0);
-        i2c_sda_oe(busno, b & (1 << i) ? 0 : 1);
-        i2c_halfperiod();
-        /* Set SCL high ; data is shifted on the rising edge of SCL */
-        i2c_scl_o(busno, 1);
-        i2c_halfperiod();
-    }
-    /* Check ack */
-    /* Set SCL low, then release SDA so that the I2C target can respond */
-    i2c_scl_o(busno, 0);
-    i2c_halfperiod();
-    i2c_sda_oe(busno, 0);
-    /* Set SCL high and check for ack */
-    i2c_scl_o(busno, 1);
-    i2c_halfperiod();
-    /* returns 1 if acked (I2C target pulled SDA low) */
-    return !i2c_sda_i(busno);
+    while(I2C_DMA_CTRL & I2C_DMA_BUSY);
+    /* The engine wrote to memory behind the data cache */
+    flush_cpu_dcache();
+    return (I2C_DMA_CTRL & I2C_DMA_ERROR) ? -1 : 0;
 }
 
-int i2c_read(int busno, int ack)
+static void i2c_ev_update(int event)
 {
-    int i;
-    unsigned char b;
+    int enable = 0;
 
-    /* Set SCL low first, otherwise setting SDA as input may cause a transition
-     * on SDA with SCL high which will be interpreted as START/STOP condition.
-     */
-    i2c_scl_o(busno, 0);
-    i2c_halfperiod(); /* make sure SCL has settled low */
-    i2c_sda_oe(busno, 0);
-
-    b = 0;
-    /* MSB first */
-    for(i=7;i>=0;i--) {
-        i2c_scl_o(busno, 0);
-        i2c_halfperiod();
-        /* Set SCL high and shift data */
-        i2c_scl_o(busno, 1);
-        i2c_halfperiod();
-        if(i2c_sda_i(busno)) b |= (1 << i);
-    }
-    /* Send ack */
-    /* Set SCL low and pull SDA low when acking */
-    i2c_scl_o(busno, 0);
-    if(ack)
-        i2c_sda_oe(busno, 1);
-    i2c_halfperiod();
-    /* then set SCL high */
-    i2c_scl_o(busno, 1);
-    i2c_halfperiod();
-
-    return b;
+    if(i2c_callback != NULL)
+        enable |= I2C_EV_IDLE;
+    if(i2c_dma_callback != NULL)
+        enable |= I2C_EV_DMA;
+    i2c_ev_pending_write(event);
+    i2c_ev_enable_write(enable);
+    if(enable)
+        irq_setmask(irq_getmask() | (1 << I2C_INTERRUPT));
+    else
+        irq_setmask(irq_getmask() & ~(1 << I2C_INTERRUPT));
+}
+
+/* Calls callback from the interrupt handler when the queue has drained, or
+ * disables the interrupt if callback is NULL.
+ */
+void i2c_set_callback(int busno, i2c_callback_t callback)
+{
+    i2c_callback = callback;
+    i2c_ev_update(I2C_EV_IDLE);
+}
+
+/* Calls callback from the interrupt handler when a DMA list is complete,
+ * or disables the interrupt if callback is NULL.
+ */
+void i2c_set_dma_callback(int busno, i2c_callback_t callback)
+{
+    i2c_dma_callback = callback;
+    i2c_ev_update(I2C_EV_DMA);
+}
+
+void i2c_isr(void)
+{
+    int pending;
+
+    pending = i2c_ev_pending_read();
+    i2c_ev_pending_write(pending);
+    if((pending & I2C_EV_IDLE) && (i2c_callback != NULL))
+        i2c_callback(0, i2c_wait(0));
+    if((pending & I2C_EV_DMA) && (i2c_dma_callback != NULL))
+        i2c_dma_callback(0, i2c_dma_wait(0));
 }
@@ -1,6 +1,27 @@
 #ifndef __I2C_H
 #define __I2C_H
 
+#include <stdint.h>
+
+typedef void (*i2c_callback_t)(int busno, int error);
+
+/* DMA descriptor, see gateware/i2c_dma.py. Word aligned. */
+struct i2c_dma_desc {
+    uint32_t next;
+    uint32_t ctl;
+    uint32_t buffer;
+    uint32_t length;
+    uint32_t status;
+};
+
+#define I2C_DMA_READ     (1 << 16)
+#define I2C_DMA_NO_REG   (1 << 17)
+#define I2C_DMA_CONTINUE (1 << 18)
+
+#define I2C_DMA_DONE (1 << 16)
+#define I2C_DMA_NACK (1 << 17)
+#define I2C_DMA_TRANSFERRED(status) ((status) & 0xffff)
+
 void i2c_init(int busno);
 void i2c_start(int busno);
 void i2c_restart(int busno);
@@ -8,4 +29,17 @@ void i2c_stop(int busno);
 int i2c_write(int busno, int b);
 int i2c_read(int busno, int ack);
 
+void i2c_queue(int busno, const uint8_t *frame, int len);
+int i2c_busy(int busno);
+int i2c_wait(int busno);
+int i2c_capture(int busno, int dev, int reg, uint8_t *buf, int len);
+void i2c_set_callback(int busno, i2c_callback_t callback);
+void i2c_dma_desc_init(struct i2c_dma_desc *desc, struct i2c_dma_desc *next,
+                       int dev, int reg, int flags, void *buf, int len);
+void i2c_dma_submit(int busno, struct i2c_dma_desc *head);
+int i2c_dma_busy(int busno);
+int i2c_dma_wait(int busno);
+void i2c_set_dma_callback(int busno, i2c_callback_t callback);
+void i2c_isr(void);
+
 #endif
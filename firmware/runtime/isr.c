@@ -1,6 +1,7 @@
 #include <generated/csr.h>
 #include <irq.h>
 #include <uart.h>
+#include "i2c.h"
 
 void isr(void);
 void isr(void)
@@ -11,4 +12,6 @@ void isr(void)
 
     if(irqs & (1 << UART_INTERRUPT))
         uart_isr();
+    if(irqs & (1 << I2C_INTERRUPT))
+        i2c_isr();
 }
@@ -20,6 +20,12 @@ int main(void)
     pca9548_readback();
 
     si5324_program(4);
+
+    /* Time the calibration until lock, 10s at most */
+    timer0_en_write(0);
+    timer0_load_write(10*CONFIG_CLOCK_FREQUENCY);
+    timer0_reload_write(0);
+    timer0_en_write(1);
     printf("waiting for ");
     printf("xtal... ");
     while(!si5324_has_xtal());
@@ -27,7 +33,10 @@ int main(void)
     while(!si5324_has_input());
     printf("PLL lock... ");
     while(!si5324_locked());
-    printf("ok\n");
+    timer0_update_value_write(1);
+    printf("ok, locked after %d ms\n",
+           (10*CONFIG_CLOCK_FREQUENCY - timer0_value_read())/
+           (CONFIG_CLOCK_FREQUENCY/1000));
 
     uint8_t skew = 0;
     while(1) {
@@ -1,5 +1,6 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include "i2c.h"
 #include "pca9548.h"
 
@@ -7,16 +8,12 @@ void pca9548_select(int channel)
 {
     printf("%s: channel=%d\n", __func__, channel);
 
-    i2c_start(0);
-    if(!i2c_write(0, (0x74 << 1))) {
-        puts("PCA9548 failed to ack write address");
-        abort();
-    }
-    if(!i2c_write(0, 1 << channel)) {
-        puts("PCA9548 failed to ack control word");
+    uint8_t frame[] = {0x74 << 1, 1 << channel};
+    i2c_queue(0, frame, sizeof(frame));
+    if(i2c_wait(0) < 0) {
+        puts("PCA9548 failed to ack");
         abort();
     }
-    i2c_stop(0);
 }
 
 int pca9548_readback()
@@ -4,10 +4,23 @@
 #include "i2c.h"
 #include "si5324.h"
 
+#define ADDRESS 0x68
+
+/* Returns 1 if the Si5324 ACKs its address */
+static int si5324_ready()
+{
+    int ack;
+
+    i2c_start(0);
+    ack = i2c_write(0, (ADDRESS << 1));
+    i2c_stop(0);
+    return ack;
+}
+
 void si5324_reset()
 {
     timer0_en_write(0);
-    timer0_load_write(CONFIG_CLOCK_FREQUENCY/50); // 20ms
+    timer0_load_write(CONFIG_CLOCK_FREQUENCY/10000); // 100us
     timer0_reload_write(0);
     timer0_en_write(1);
 
@@ -19,35 +32,40 @@ void si5324_reset()
 
     si5324_rst_n_out_write(1);
 
+    /* Poll until the device answers instead of waiting for the worst case */
+    timer0_en_write(0);
+    timer0_load_write(CONFIG_CLOCK_FREQUENCY/5); // 200ms
+    timer0_en_write(1);
     timer0_update_value_write(1);
-    while(timer0_value_read() != 0)
+    while(!si5324_ready()) {
         timer0_update_value_write(1);
+        if(timer0_value_read() == 0) {
+            puts("Si5324 failed to come out of reset");
+            abort();
+        }
+    }
 }
 
-#define ADDRESS 0x68
-
 void si5324_write(uint8_t reg, uint8_t val)
 {
     // printf("%s: [%d]=0x%02x\n", __func__, reg, val);
 
-    i2c_start(0);
-    if(!i2c_write(0, (ADDRESS << 1))) {
-        puts("Si5324 failed to ack write address");
-        abort();
-    }
-    if(!i2c_write(0, reg)) {
-        puts("Si5324 failed to ack register");
-        abort();
-    }
-    if(!i2c_write(0, val)) {
-        puts("Si5324 failed to ack value");
+    uint8_t frame[] = {ADDRESS << 1, reg, val};
+    i2c_queue(0, frame, sizeof(frame));
+}
+
+/* Waits for the queued writes */
+void si5324_flush()
+{
+    if(i2c_wait(0) < 0) {
+        puts("Si5324 failed to ack write");
         abort();
     }
-    i2c_stop(0);
 }
 
 uint8_t si5324_read(uint8_t reg)
 {
+    si5324_flush();
     i2c_start(0);
     if(!i2c_write(0, (ADDRESS << 1))) {
         puts("Si5324 failed to ack write address");
@@ -70,9 +88,22 @@ uint8_t si5324_read(uint8_t reg)
     return val;
 }
 
+/* Reads len registers from reg at once */
+void si5324_dump(uint8_t reg, uint8_t *buf, int len)
+{
+    si5324_flush();
+    if(i2c_capture(0, ADDRESS << 1, reg, buf, len) < 0) {
+        puts("Si5324 failed to ack register dump");
+        abort();
+    }
+}
+
 uint16_t si5324_ident()
 {
-    return (si5324_read(134) << 8) | si5324_read(135);
+    uint8_t ident[2];
+
+    si5324_dump(134, ident, sizeof(ident));
+    return (ident[0] << 8) | ident[1];
 }
 
 void si5324_program(int bwsel)
@@ -102,18 +133,34 @@ void si5324_program(int bwsel)
     si5324_write(2,  (si5324_read(2) & 0x0f) | (bwsel << 4));
     si5324_write(3,  (si5324_read(3)       ) | /*SQ_ICAL=1*/0x10);
     si5324_write(6,  (si5324_read(6) & 0x07) | /*SFOUT1_REG=b111*/0x07);
-    si5324_write(25,  N1_HS  << 5);
-    si5324_write(31,  NC1_LS >> 16);
-    si5324_write(32,  NC1_LS >> 8);
-    si5324_write(33,  NC1_LS);
-    si5324_write(40, (N2_HS  << 5) | (N2_LS >> 16));
-    si5324_write(41,  N2_LS  >> 8);
-    si5324_write(42,  N2_LS);
-    si5324_write(43,  N31    >> 16);
-    si5324_write(44,  N31    >> 8);
-    si5324_write(45,  N31);
+
+    /* The dividers, one burst per register block, in a single DMA list */
+    struct i2c_dma_desc desc[3];
+    uint8_t n1[] __attribute__((aligned(4))) = {
+        N1_HS << 5
+    };
+    uint8_t nc1[] __attribute__((aligned(4))) = {
+        NC1_LS >> 16, NC1_LS >> 8, NC1_LS
+    };
+    uint8_t n2_n31[] __attribute__((aligned(4))) = {
+        (N2_HS << 5) | (N2_LS >> 16), N2_LS >> 8, N2_LS,
+        N31 >> 16, N31 >> 8, N31
+    };
+    i2c_dma_desc_init(&desc[0], &desc[1], ADDRESS << 1, 25, 0,
+                      n1, sizeof(n1));
+    i2c_dma_desc_init(&desc[1], &desc[2], ADDRESS << 1, 31, 0,
+                      nc1, sizeof(nc1));
+    i2c_dma_desc_init(&desc[2], NULL, ADDRESS << 1, 40, 0,
+                      n2_n31, sizeof(n2_n31));
+    i2c_dma_submit(0, &desc[0]);
+    if(i2c_dma_wait(0) < 0) {
+        puts("Si5324 failed to ack divider write");
+        abort();
+    }
+
     si5324_write(137, si5324_read(137) | /*FASTLOCK=1*/0x01);
     si5324_write(136, /*ICAL=1*/0x40);
+    si5324_flush();
 }
 
 int si5324_has_input()
@@ -134,4 +181,5 @@ int si5324_locked()
 void si5324_set_skew(int8_t skew)
 {
     si5324_write(142, skew);
+    si5324_flush();
 }
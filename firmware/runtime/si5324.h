@@ -5,7 +5,9 @@
 
 void si5324_reset(void);
 void si5324_write(uint8_t reg, uint8_t val);
+void si5324_flush(void);
 uint8_t si5324_read(uint8_t reg);
+void si5324_dump(uint8_t reg, uint8_t *buf, int len);
 
 uint16_t si5324_ident(void);
 void si5324_program(int bwsel);
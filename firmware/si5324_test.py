@@ -1,15 +1,81 @@
 #!/usr/bin/env python3
 
-import os, argparse
+import os, sys, argparse
 
 from migen import *
 from migen.build.platforms import kc705
 from migen.build.xilinx.vivado import XilinxVivadoToolchain
 from migen.build.xilinx.ise import XilinxISEToolchain
 from misoc.cores import gpio
+from misoc.interconnect import wishbone
+from misoc.interconnect.csr import AutoCSR
+from misoc.interconnect.csr_eventmanager import EventManager, EventSourceProcess
 from misoc.targets.kc705 import BaseSoC, soc_kc705_args, soc_kc705_argdict
 from misoc.integration.builder import Builder, builder_args, builder_argdict
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "gateware"))
+from i2c import I2CMaster, i2c_divider, i2c_hold
+from i2c_capture import I2CCapture
+from i2c_dma import I2CDMA
+
+
+# I2CMaster on the SoC bus, behind the register capture engine and the DMA
+# engine. The registers are decoded from the low address bits, the capture
+# engine registers follow at word 0x200, the DMA engine registers at word
+# 0x400. The idle interrupt fires when the transmit FIFO has drained, the
+# last frame is complete and neither engine runs, the dma interrupt when a
+# descriptor list is complete. A capture started while a list waits for the
+# queued frames runs first.
+class I2C(Module, AutoCSR):
+    def __init__(self, pads):
+        self.bus = wishbone.Interface()
+        self.submodules.master = I2CMaster(pads)
+        self.submodules.capture = I2CCapture(self.master)
+        self.submodules.dma = I2CDMA(self.master, self.capture.bus)
+
+        self.submodules.ev = EventManager()
+        self.ev.idle = EventSourceProcess()
+        self.ev.dma = EventSourceProcess()
+        self.ev.finalize()
+
+        ###
+
+        sel_capture = Signal()
+        sel_dma = Signal()
+        self.comb += [
+            sel_capture.eq(~self.bus.adr[10] & self.bus.adr[9]),
+            sel_dma.eq(self.bus.adr[10]),
+        ]
+        for slave, selected in ((self.dma.bus, ~sel_capture & ~sel_dma),
+                                (self.capture.ctrl, sel_capture),
+                                (self.dma.ctrl, sel_dma)):
+            self.comb += [
+                slave.adr.eq(self.bus.adr[:9]),
+                slave.dat_w.eq(self.bus.dat_w),
+                slave.sel.eq(self.bus.sel),
+                slave.we.eq(self.bus.we),
+                slave.cyc.eq(self.bus.cyc & selected),
+                slave.stb.eq(self.bus.stb & selected),
+            ]
+        self.comb += [
+            If(sel_dma,
+                self.bus.ack.eq(self.dma.ctrl.ack),
+                self.bus.dat_r.eq(self.dma.ctrl.dat_r),
+            ).Elif(sel_capture,
+                self.bus.ack.eq(self.capture.ctrl.ack),
+                self.bus.dat_r.eq(self.capture.ctrl.dat_r),
+            ).Else(
+                self.bus.ack.eq(self.dma.bus.ack),
+                self.bus.dat_r.eq(self.dma.bus.dat_r),
+            ),
+            self.capture.hold.eq(self.dma.grant),
+            self.dma.hold.eq(self.capture.busy),
+            self.ev.idle.trigger.eq(~self.master.idle | self.capture.busy |
+                                    self.dma.busy),
+            self.ev.dma.trigger.eq(self.dma.busy),
+        ]
+
 class Si5324ClockRouting(Module):
     def __init__(self, platform):
         si5324_clkin = platform.request("si5324_clkin")
@@ -43,6 +109,11 @@ class Si5324ClockRouting(Module):
         ]
 
 class Si5324Test(BaseSoC):
+    mem_map = {
+        "i2c": 0x30000000,
+    }
+    mem_map.update(BaseSoC.mem_map)
+
     def __init__(self, cpu_type="or1k", **kwargs):
         BaseSoC.__init__(self,
                          cpu_type=cpu_type,
@@ -63,8 +134,15 @@ class Si5324Test(BaseSoC):
             self.platform.request("user_led", 1)))
 
         i2c = self.platform.request("i2c")
-        self.submodules.i2c = gpio.GPIOTristate([i2c.scl, i2c.sda])
+        self.submodules.i2c = I2C(i2c)
+        self.register_mem("i2c", self.mem_map["i2c"] | self.shadow_base,
+                          self.i2c.bus, 0x2000)
+        # descriptors and buffers in the main memory
+        self.add_wb_master(self.i2c.dma.dma)
         self.csr_devices.append("i2c")
+        self.interrupt_devices.append("i2c")
+        self.config["I2C_DIVIDER"] = i2c_divider(self.clk_freq, "fast")
+        self.config["I2C_HOLD"] = i2c_hold(self.clk_freq, "fast")
 
         si5324 = self.platform.request("si5324", 0)
         self.submodules.si5324_rst_n = gpio.GPIOOut(si5324.rst_n)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3.5
+
+# Sequencer program assembler, disassembler and peephole optimizer.
+#
+# Text format: one instruction per line, the mnemonic followed by the fields
+# of the instruction tuple separated by commas; data octets are separated by
+# spaces. Targets are addresses or label names, labels are defined by
+# "name:" lines. Everything after "#" is a comment.
+#
+#     write       0x01, 0x00013
+#     retry:
+#     i2c_write   0x02, 0xd0, 0x03, 0x15 0x07
+#     wait        0x02, 0x02000
+#     branch      0x02, 0x100, 0x100, retry
+#     end
+
+import sys, argparse
+from collections import OrderedDict
+
+from migen import Memory
+
+from sequencer import *
+from sequencer import encode_program, unpack_program
+from i2c import I2C_IDLE
+from model import SystemModel
+
+
+__all__ = ["MNEMONICS", "decode", "decode_program", "format_program",
+           "parse_program", "optimize", "program_stats", "optimize_report"]
+
+
+MNEMONICS = OrderedDict([
+    ("end",        InstEnd),
+    ("write",      InstWrite),
+    ("wait",       InstWait),
+    ("i2c_write",  InstI2CWrite),
+    ("wait_event", InstWaitEvent),
+    ("i2c_poll",   InstI2CPoll),
+    ("i2c_read",   InstI2CRead),
+    ("i2c_update", InstI2CUpdate),
+    ("jump",       InstJump),
+    ("branch",     InstBranch),
+    ("load",       InstLoad),
+    ("loop",       InstLoop),
+    ("call",       InstCall),
+    ("ret",        InstReturn),
+    ("delay",      InstDelay),
+    ("abort",      InstAbort),
+])
+
+
+# Returns the instruction at words[pc] and its length in words
+def decode(words, pc=0):
+    word = words[pc]
+    opcode, address, data_mask = (word >> 28, (word >> 20) & 0xff,
+                                  word & 0xfffff)
+    count, dev, reg = (data_mask >> 16, (data_mask >> 8) & 0xff,
+                       data_mask & 0xff)
+    if opcode == 0b0000:
+        return InstEnd(), 1
+    elif opcode == 0b0001:
+        return InstWrite(address, data_mask), 1
+    elif opcode == 0b0010:
+        return InstWait(address, data_mask), 1
+    elif opcode in (0b0011, 0b0111):
+        n = (count + 3)//4
+        data = [(payload >> 8*j) & 0xff
+                for payload in words[pc + 1:pc + 1 + n]
+                for j in range(4)][:count]
+        if len(data) != count:
+            raise ValueError("truncated instruction at {}".format(pc))
+        inst = InstI2CWrite if opcode == 0b0011 else InstI2CUpdate
+        return inst(address, dev, reg, data), 1 + n
+    elif opcode == 0b0100:
+        return InstWaitEvent(address, data_mask), 1
+    elif opcode == 0b0101:
+        if pc + 1 >= len(words):
+            raise ValueError("truncated instruction at {}".format(pc))
+        payload = words[pc + 1]
+        return InstI2CPoll(address, dev, reg, payload & 0xff,
+                           (payload >> 8) & 0xff, payload >> 16), 2
+    elif opcode == 0b0110:
+        return InstI2CRead(address, dev, reg, count), 1
+    elif opcode == 0b1000:
+        return InstJump(data_mask), 1
+    elif opcode == 0b1001:
+        if pc + 1 >= len(words):
+            raise ValueError("truncated instruction at {}".format(pc))
+        payload = words[pc + 1]
+        return InstBranch(address, data_mask, payload & 0xfffff,
+                          payload >> 20), 2
+    elif opcode == 0b1010:
+        return InstLoad(address, data_mask), 1
+    elif opcode == 0b1011:
+        return InstLoop(address, data_mask), 1
+    elif opcode == 0b1100:
+        return InstCall(data_mask), 1
+    elif opcode == 0b1101:
+        return InstReturn(), 1
+    elif opcode == 0b1110:
+        return InstDelay((address << 20) | data_mask), 1
+    else:
+        return InstAbort(), 1
+
+
+# Decodes a list of words, a packed program or the content of the program
+# Memory. The zero words padding the memory after the last InstEnd are
+# dropped. Targets are left as addresses.
+def decode_program(words):
+    if isinstance(words, Memory):
+        words = words.init
+    elif isinstance(words, bytes):
+        words = unpack_program(words)
+    words = list(words)
+    program = []
+    pc = 0
+    while pc < len(words):
+        inst, n = decode(words, pc)
+        program.append(inst)
+        pc += n
+        if isinstance(inst, InstEnd) and not any(words[pc:]):
+            break
+    return program
+
+
+def _format_field(value):
+    if isinstance(value, (list, tuple)):
+        return " ".join("{:#04x}".format(octet) for octet in value)
+    if isinstance(value, str):
+        return value
+    return "{:#x}".format(value)
+
+
+def format_program(program):
+    names = {inst: name for name, inst in MNEMONICS.items()}
+    lines = []
+    for inst in program:
+        if isinstance(inst, Label):
+            lines.append(inst.name + ":")
+            continue
+        line = "{:11} ".format(names[type(inst)])
+        line += ", ".join(_format_field(value) for value in inst)
+        lines.append(line.rstrip())
+    return "\n".join(lines) + "\n"
+
+
+def parse_program(text):
+    program = []
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        if line.endswith(":") and line[:-1].isidentifier():
+            program.append(Label(line[:-1]))
+            continue
+        name, _, fields = line.partition(" ")
+        try:
+            inst = MNEMONICS[name]
+        except KeyError:
+            raise ValueError("line {}: unknown mnemonic {}".format(n, name))
+        if fields.strip():
+            fields = [field.strip() for field in fields.split(",")]
+        else:
+            fields = []
+        if len(fields) != len(inst._fields):
+            raise ValueError("line {}: {} takes {} fields".format(
+                n, name, len(inst._fields)))
+        values = []
+        for field, value in zip(inst._fields, fields):
+            if field == "data" and inst in (InstI2CWrite, InstI2CUpdate):
+                values.append([int(octet, 0) for octet in value.split()])
+            elif field == "target" and value.isidentifier():
+                values.append(value)
+            else:
+                values.append(int(value, 0))
+        program.append(inst(*values))
+    return program
+
+
+_FIFO_INSTS = InstI2CWrite, InstI2CUpdate, InstI2CPoll, InstI2CRead
+
+
+def _is_idle_wait(inst):
+    return (isinstance(inst, InstWait) and inst.mask and
+            not inst.mask & ~I2C_IDLE)
+
+
+def _drop_waits(program):
+    # An idle wait is redundant when the I2CMaster is known to be idle, or
+    # between frames for the same FIFO, that are queued behind the previous
+    # ones anyway.
+    result = []
+    # FIFO addresses known to be idle
+    idle = set()
+    for i, inst in enumerate(program):
+        if isinstance(inst, (Label, InstCall)):
+            idle.clear()
+        if _is_idle_wait(inst):
+            following = program[i + 1] if i + 1 < len(program) else None
+            if inst.address in idle:
+                continue
+            if (result and isinstance(result[-1], _FIFO_INSTS) and
+                    result[-1].address == inst.address and
+                    isinstance(following, (InstI2CWrite, InstI2CUpdate)) and
+                    following.address == inst.address):
+                continue
+        elif (isinstance(inst, InstWaitEvent) and result and
+                result[-1] == inst):
+            continue
+        if isinstance(inst, InstWrite):
+            # may start a transfer on any register of the I2CMaster
+            idle.clear()
+        elif isinstance(inst, _FIFO_INSTS):
+            idle.discard(inst.address)
+        if _is_idle_wait(inst) or isinstance(inst, (InstI2CPoll,
+                                                     InstI2CRead)):
+            # polls and reads end once the I2CMaster is idle
+            idle.add(inst.address)
+        result.append(inst)
+    return result
+
+
+def _merge_writes(program, max_burst=15):
+    # Writes continuing at the next register of the same device are sent in
+    # one frame using the register address auto-increment
+    result = []
+    for inst in program:
+        if result and isinstance(inst, InstI2CWrite):
+            prev = result[-1]
+            if (isinstance(prev, InstI2CWrite) and prev.data and
+                    prev.address == inst.address and prev.dev == inst.dev and
+                    prev.reg + len(prev.data) == inst.reg and
+                    len(prev.data) + len(inst.data) <= max_burst):
+                result[-1] = prev._replace(data=list(prev.data) +
+                                           list(inst.data))
+                continue
+        result.append(inst)
+    return result
+
+
+def _drop_selects(program, mux_devs):
+    # A channel select of an I2C switch that is already selected
+    result = []
+    selected = {}
+    for inst in program:
+        if isinstance(inst, (Label, InstCall)):
+            selected.clear()
+        elif isinstance(inst, InstI2CWrite) and inst.dev in mux_devs:
+            key = inst.address, inst.dev
+            if not inst.data:
+                if selected.get(key) == inst.reg:
+                    continue
+                selected[key] = inst.reg
+            else:
+                selected.pop(key, None)
+        result.append(inst)
+    return result
+
+
+# mux_devs: write addresses of the I2C switches (PCA9548). Jump targets
+# must be labels, as instructions move.
+def optimize(program, mux_devs=(0x74 << 1,)):
+    for inst in program:
+        if "target" in inst._fields and not isinstance(inst.target, str):
+            raise ValueError("numeric target in " + repr(inst))
+    while True:
+        optimized = _drop_selects(program, mux_devs)
+        optimized = _drop_waits(optimized)
+        optimized = _merge_writes(optimized)
+        if optimized == program:
+            return optimized
+        program = optimized
+
+
+# Instruction count, ROM size, and cycles estimated by SystemModel (None if
+# the program does not end without external events), with devices that
+# answer at once and a PLL that is already locked. With clk_freq, also the
+# time in seconds.
+def program_stats(program, fifo_depth=16, clk_freq=None):
+    words = encode_program(program)
+    stats = OrderedDict([
+        ("instructions", len(program)),
+        ("words", len(words)),
+        ("rom_bits", 32*len(words)),
+    ])
+    try:
+        stats["cycles"] = SystemModel(program, fifo_depth).run()
+    except RuntimeError:
+        stats["cycles"] = None
+    if clk_freq is not None:
+        stats["time"] = (None if stats["cycles"] is None
+                         else stats["cycles"]/clk_freq)
+    return stats
+
+
+def optimize_report(before, after, fifo_depth=16):
+    lines = []
+    for name, program in ("before", before), ("after", after):
+        stats = program_stats(program, fifo_depth)
+        lines.append("{:6}: {:4} instructions, {:6} ROM bits, {} cycles"
+                     .format(name, stats["instructions"], stats["rom_bits"],
+                             stats["cycles"]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sequencer program assembler and disassembler")
+    parser.add_argument("input",
+                        help="program text, or $readmemh/.init file with -d")
+    parser.add_argument("-d", "--disassemble", action="store_true",
+                        help="input is a memory initialization file")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="optimize, and report the gain on stderr")
+    parser.add_argument("-o", "--output", default=None,
+                        help="memory initialization file to write "
+                             "(default: program text on stdout)")
+    args = parser.parse_args()
+
+    with open(args.input) as f:
+        text = f.read()
+    if args.disassemble:
+        program = decode_program(int(word, 16) for word in text.split()
+                                 if not word.startswith("@"))
+    else:
+        program = parse_program(text)
+    if args.optimize:
+        optimized = optimize(program)
+        print(optimize_report(program, optimized), file=sys.stderr)
+        program = optimized
+    if args.output is None:
+        sys.stdout.write(format_program(program))
+    else:
+        with open(args.output, "w") as f:
+            f.write("".join("{:08X}\n".format(word)
+                            for word in encode_program(program)))
+
+
+if __name__ == "__main__":
+    main()
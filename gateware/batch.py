@@ -0,0 +1,93 @@
+# Batch generation of design variants, one per frequency plan, in a process
+# pool. Every variant is built by build(variant, build_dir, **kwargs) in
+# its own directory under the batch directory, and returns the row of the
+# summary: asm.program_stats() with clk_freq, and how the sources and the
+# bitstream were obtained (see format_summary). A variant that fails to
+# build gets an error row, and the others are built anyway. Builds are
+# independent, so the batch scales with the number of processes. See
+# si5324_test.py for the Si5324Test builds.
+
+import os, time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+__all__ = ["Variant", "parse_variant", "variant_name", "run_batch",
+           "format_summary"]
+
+
+# clk_freq: Si5324 reference and system clock, fout: Si5324 output
+Variant = namedtuple("Variant", "clk_freq fout")
+
+
+# "FIN:FOUT" in Hz, floats allowed (62.5e6:125e6)
+def parse_variant(text):
+    try:
+        clk_freq, fout = (float(f) for f in text.split(":"))
+    except ValueError:
+        raise ValueError("variants are FIN:FOUT, not " + repr(text))
+    return Variant(clk_freq, fout)
+
+
+def variant_name(variant):
+    return "{:.0f}_{:.0f}".format(*variant)
+
+
+def _build(build, variant, build_dir, kwargs):
+    start = time.monotonic()
+    row = OrderedDict([
+        ("name", variant_name(variant)),
+        ("clk_freq", variant.clk_freq),
+        ("fout", variant.fout),
+        ("build_dir", build_dir),
+    ])
+    try:
+        row.update(build(variant, build_dir, **kwargs))
+    except Exception as e:
+        # no frequency plan or clocking for the variant, or a failed build
+        row["error"] = str(e) or type(e).__name__
+    row["seconds"] = time.monotonic() - start
+    return row
+
+
+# Returns the rows in the order of variants. build must be picklable,
+# i.e. a module level function. processes=None uses all the cores.
+def run_batch(build, variants, build_dir, processes=None, **kwargs):
+    variants = [Variant(*variant) for variant in variants]
+    names = [variant_name(variant) for variant in variants]
+    if len(set(names)) != len(names):
+        raise ValueError("duplicate variants")
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_build, build, variant,
+                               os.path.join(build_dir, name), kwargs)
+                   for variant, name in zip(variants, names)]
+        return [future.result() for future in futures]
+
+
+_COLUMNS = [
+    ("variant", "{name}"),
+    ("ROM words", "{words}"),
+    ("config (us)", "{config_time_us}"),
+    ("sources", "{sources}"),
+    ("bitstream", "{bitstream}"),
+    ("time (s)", "{seconds:.1f}"),
+]
+
+
+def format_summary(rows):
+    header = [title for title, _ in _COLUMNS]
+    table = [header]
+    for row in rows:
+        if "error" in row:
+            table.append([row["name"], "error: " + row["error"]])
+        else:
+            time = row["time"]
+            fields = dict(row, config_time_us="-" if time is None
+                          else "{:.1f}".format(time*1e6))
+            table.append([fmt.format(**fields) for _, fmt in _COLUMNS])
+    # error rows only count for the variant column
+    widths = [max(len(line[i]) for line in table
+                  if i == 0 or len(line) == len(header))
+              for i in range(len(header))]
+    return "\n".join("  ".join(cell.ljust(width)
+                               for cell, width in zip(line, widths)).rstrip()
+                     for line in table)
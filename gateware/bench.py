@@ -0,0 +1,180 @@
+#!/usr/bin/env python3.5
+
+# Configuration latency benchmarks: the bring-up programs are run in the
+# migen simulation against simulated PCA9548 and Si5324 devices. The I2C
+# divider is lowered to keep the simulation short; the latency at the real
+# divider is obtained from the transaction-level model.
+
+import sys, json, argparse, subprocess
+from collections import OrderedDict
+
+from migen import *
+
+from sequencer import *
+from i2c import *
+from si5324 import *
+from si5324_plan import *
+from regmap import cost_report
+from model import SystemModel
+from i2c_sim import *
+
+
+__all__ = ["BENCHMARKS", "run_benchmark", "run_benchmarks", "compare"]
+
+
+BENCHMARKS = OrderedDict([
+    ("bringup",            {}),
+    ("bringup_poll",       {"event": None}),
+    ("bringup_uncompiled", {"compile": False}),
+    ("bringup_nolock",     {"lock": False}),
+    ("bringup_retry",      {"retries": 3}),
+])
+
+
+def _registers_ok(switch, si5324, clk_freq, fout):
+    plan = solve(clk_freq, fout)
+    expected = {}
+    for phase in si5324_registers(*plan_registers(plan)):
+        expected.update(phase)
+    return (switch.control == 1 << 7 and
+            all(si5324.registers.get(reg) == value
+                for reg, value in expected.items()))
+
+
+# program configures the Si5324 for fout, by default clk_freq like
+# bringup_program()
+def run_benchmark(program, clk_freq, divider=4, fifo_depth=16, fout=None):
+    if fout is None:
+        fout = clk_freq
+    frames = []
+    dut = I2CSequencerSystem(with_divider(program, divider), fifo_depth,
+                             registers=SI5324_DEFAULTS)
+    bus = dut.sequencer.bus
+    result = OrderedDict()
+
+    def gen():
+        cycles = reads = writes = 0
+        while (yield dut.sequencer.running):
+            if (yield bus.ack):
+                if (yield bus.we):
+                    writes += 1
+                else:
+                    reads += 1
+            cycles += 1
+            yield
+        result["cycles"] = cycles
+        result["bus_writes"] = writes
+        result["bus_reads"] = reads
+        result["timeout"] = yield dut.sequencer.timeout
+
+    with open_drain():
+        run_simulation(dut, [gen(), dut.devices(frames)])
+
+    octets = sum(len(frame) for frame in frames)
+    result["frames"] = len(frames)
+    result["octets"] = octets
+    result["cycles_per_octet"] = result["cycles"]/octets
+    result["time"] = result["cycles"]/clk_freq
+    result["registers_ok"] = _registers_ok(dut.switch, dut.si5324,
+                                           clk_freq, fout)
+
+    # at the divider of the program
+    model = SystemModel(program, fifo_depth)
+    result["model_cycles"] = model.run()
+    result["model_time"] = result["model_cycles"]/clk_freq
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(clk_freq=62.5e6, divider=4, names=None, fout=None):
+    if fout is None:
+        fout = clk_freq
+    report = OrderedDict([
+        ("commit", _commit()),
+        ("clk_freq", clk_freq),
+        ("fout", fout),
+        ("divider", divider),
+        ("benchmarks", OrderedDict()),
+    ])
+    for name, kwargs in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        program = bringup_program(clk_freq, fout, **kwargs)
+        report["benchmarks"][name] = run_benchmark(program, clk_freq, divider,
+                                                   fout=fout)
+    return report
+
+
+def compare(old, new):
+    lines = []
+    for name, result in new["benchmarks"].items():
+        if name not in old["benchmarks"]:
+            continue
+        for key, value in result.items():
+            before = old["benchmarks"][name].get(key)
+            if before == value:
+                continue
+            line = "{}.{}: {} -> {}".format(name, key, before, value)
+            if (isinstance(before, (int, float)) and before and
+                    not isinstance(value, bool)):
+                line += " ({:+.1f}%)".format(100*(value - before)/before)
+            lines.append(line)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sequencer/I2CMaster configuration latency benchmarks")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON report (default: stdout)")
+    parser.add_argument("--clk-freq", type=float, default=62.5e6,
+                        help="system clock frequency (default: %(default)s)")
+    parser.add_argument("--fout", type=float, default=None,
+                        help="Si5324 output frequency (default: the system "
+                             "clock frequency)")
+    parser.add_argument("--divider", type=int, default=4,
+                        help="I2C divider in simulation "
+                             "(default: %(default)s)")
+    parser.add_argument("--compare", default=None,
+                        help="previous JSON report to compare against")
+    parser.add_argument("--regmap", action="store_true",
+                        help="report the bring-up write sequence with and "
+                             "without burst compilation")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run (default: all of {})"
+                             .format(", ".join(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: " + name)
+
+    report = run_benchmarks(args.clk_freq, args.divider, args.benchmarks,
+                            args.fout)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for line in compare(old, report):
+            print(line, file=sys.stderr)
+    if args.regmap:
+        registers = plan_registers(solve(args.clk_freq, report["fout"]))
+        print(cost_report(i2c_sequence(*registers, compile=False),
+                          i2c_sequence(*registers),
+                          I2C_TIMINGS["fast"].scl_freq), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
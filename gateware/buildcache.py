@@ -0,0 +1,170 @@
+# Content-addressed build cache, in two layers.
+#
+# Sources: everything the platform writes before the toolchain runs
+# (Verilog, XDC, Tcl, $readmemh files of the memories), keyed by a hash of
+# the design parameters and of the gateware sources. A hit skips elaboration
+# and Verilog generation.
+#
+# Outputs: the bitstream and the reports, keyed by a hash of the generated
+# sources. Parameters that do not change the generated design, or an
+# elaboration that ends up identical, skip the toolchain.
+#
+# Entries are directories named after their key, written to a temporary
+# directory first and renamed, so that concurrent builds can share a cache.
+
+import os, json, glob, shutil, hashlib, tempfile, subprocess
+from collections import OrderedDict, namedtuple
+
+from sequencer import encode_program
+from si5324_plan import solve
+
+
+__all__ = ["CACHE_DIR", "source_digest", "design_params", "design_key",
+           "BuildCache", "BuildResult", "vivado_toolchain", "cached_build"]
+
+
+CACHE_DIR = os.environ.get("SI5324_CACHE", os.path.join(
+    os.path.expanduser("~"), ".cache", "si5324_test"))
+
+OUTPUT_PATTERNS = ["{}.bit", "{}.bin", "*.rpt"]
+
+
+def _hash_files(paths, root):
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        h.update(os.path.relpath(path, root).encode())
+        h.update(b"\0")
+        with open(path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+# Hash of the gateware modules the design is built from
+def source_digest(directory=None):
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+    return _hash_files(glob.glob(os.path.join(directory, "*.py")), directory)
+
+
+def design_params(clk_freq, fout, program, **kwargs):
+    plan = solve(clk_freq, fout)
+    params = OrderedDict([
+        ("clk_freq", clk_freq),
+        ("fout", fout),
+        ("plan", list(plan)),
+        ("program", encode_program(program)),
+    ])
+    params.update(sorted(kwargs.items()))
+    return params
+
+
+def design_key(params, digest=None):
+    if digest is None:
+        digest = source_digest()
+    h = hashlib.sha256(digest.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class BuildCache:
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+
+    def path(self, layer, key):
+        return os.path.join(self.root, layer, key[:2], key)
+
+    # Copies the entry into build_dir, returns the paths copied, or None
+    def fetch(self, layer, key, build_dir):
+        entry = self.path(layer, key)
+        if not os.path.isdir(entry):
+            return None
+        os.makedirs(build_dir, exist_ok=True)
+        paths = []
+        for name in sorted(os.listdir(entry)):
+            shutil.copy2(os.path.join(entry, name), build_dir)
+            paths.append(os.path.join(build_dir, name))
+        return paths
+
+    def store(self, layer, key, files):
+        entry = self.path(layer, key)
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        for path in files:
+            shutil.copy2(path, tmp)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored meanwhile by another build
+            shutil.rmtree(tmp)
+
+
+def _files(build_dir):
+    return [path for path in glob.glob(os.path.join(build_dir, "*"))
+            if os.path.isfile(path)]
+
+
+# What a build named build_name leaves in its directory
+def _previous(build_dir, build_name):
+    return (glob.glob(os.path.join(build_dir, build_name + ".*")) +
+            glob.glob(os.path.join(build_dir, "*.init")))
+
+
+def _outputs(build_dir, build_name):
+    paths = set()
+    for pattern in OUTPUT_PATTERNS:
+        paths.update(glob.glob(os.path.join(build_dir,
+                                            pattern.format(build_name))))
+    return sorted(paths)
+
+
+def vivado_toolchain(build_dir, build_name):
+    env = dict(os.environ, LC_ALL="C")
+    subprocess.check_call(["vivado", "-mode", "batch",
+                           "-source", build_name + ".tcl"],
+                          cwd=build_dir, env=env)
+
+
+# elaborated: the design was elaborated, built: the toolchain was run
+BuildResult = namedtuple("BuildResult", "key output_key elaborated built")
+
+
+# Builds the design returned by elaborate(), unless params hit the cache.
+# toolchain(build_dir, build_name) runs synthesis and implementation on the
+# sources written by platform.build(run=False); run=False stops after the
+# sources. The build runs in a fresh directory, so that other files cannot
+# end up in the cache, and its files are then copied to build_dir, replacing
+# those of a previous build of build_name.
+def cached_build(platform, elaborate, params, build_dir, build_name="top",
+                 run=True, cache=None, toolchain=vivado_toolchain):
+    if cache is None:
+        cache = BuildCache()
+    work_dir = tempfile.mkdtemp(prefix=build_name + "-")
+    try:
+        key = design_key(params)
+        sources = cache.fetch("sources", key, work_dir)
+        elaborated = sources is None
+        if elaborated:
+            platform.build(elaborate(), build_dir=work_dir,
+                           build_name=build_name, run=False)
+            sources = _files(work_dir)
+            cache.store("sources", key, sources)
+
+        output_key = _hash_files(sources, work_dir)
+        built = False
+        if run and cache.fetch("outputs", output_key, work_dir) is None:
+            toolchain(work_dir, build_name)
+            cache.store("outputs", output_key,
+                        _outputs(work_dir, build_name))
+            built = True
+
+        os.makedirs(build_dir, exist_ok=True)
+        for path in _previous(build_dir, build_name):
+            if os.path.isfile(path):
+                os.remove(path)
+        for path in _files(work_dir):
+            shutil.copy2(path, build_dir)
+    finally:
+        shutil.rmtree(work_dir)
+    return BuildResult(key, output_key, elaborated, built)
@@ -0,0 +1,445 @@
+# Co-simulation of migen designs under Verilator, driven by the generator
+# testbenches of migen's run_simulation.
+#
+# The design is converted to Verilog, compiled with a small C++ harness and
+# run as a separate process, driven over a pipe. Signals nothing drives are
+# inputs of the design, every other signal of up to 64 bits is copied to an
+# output port, so that generators can read any of them. The bridge runs the
+# generators as migen's simulator does: in each cycle, they read the values
+# before the rising edge, and their writes take effect with it. Only inputs
+# can be written, signals the design does not use are kept by the bridge.
+# Only the "sys" clock domain is supported.
+#
+# Harness protocol, one command per line, values in hexadecimal:
+#   w ID VALUE  write an input, applied with the next clock edge
+#   i           apply the writes without a clock edge
+#   r ID        read a signal, answered with its value
+#   a ID        add a signal to the watch list
+#   s           clock cycle, answered with the values of the watch list
+#   q           quit
+#
+# The compiled simulators are cached, keyed by a hash of their sources.
+
+import os, re, shutil, hashlib, inspect, tempfile, subprocess, collections
+
+from migen import *
+from migen.fhdl.structure import _Fragment, _Assign, _Value, _Slice
+from migen.fhdl.tools import (list_signals, list_targets, list_special_ios,
+                              lower_specials)
+from migen.fhdl import verilog
+from migen.sim import run_simulation as _migen_run_simulation
+
+from buildcache import CACHE_DIR
+
+
+__all__ = ["BACKENDS", "verilator_available", "VerilatorSimulator",
+           "run_verilator", "run_simulation"]
+
+
+BACKENDS = ["migen", "verilator"]
+
+
+def verilator_available():
+    return shutil.which("verilator") is not None
+
+
+_HARNESS = """\
+#include <cstdio>
+#include <cstdlib>
+#include <cstdint>
+#include "verilated.h"
+#include "Vtop.h"
+#if VM_TRACE
+#include "verilated_vcd_c.h"
+#endif
+
+static Vtop *top;
+
+static uint64_t get(int id)
+{{
+    switch(id) {{
+{get}
+    default: abort();
+    }}
+}}
+
+static void set(int id, uint64_t value)
+{{
+    switch(id) {{
+{set}
+    default: abort();
+    }}
+}}
+
+static int watch[{n}], n_watch;
+static int pending_id[{n}], n_pending;
+static uint64_t pending_value[{n}];
+
+static void apply(void)
+{{
+    for(int i = 0; i < n_pending; i++)
+        set(pending_id[i], pending_value[i]);
+    n_pending = 0;
+}}
+
+int main(int argc, char **argv)
+{{
+    char line[64];
+    int id;
+    unsigned long long value;
+
+    Verilated::commandArgs(argc, argv);
+#if VM_TRACE
+    VerilatedVcdC *vcd = NULL;
+    uint64_t t = 0;
+    if(argc > 1)
+        Verilated::traceEverOn(true);
+#endif
+    top = new Vtop;
+#if VM_TRACE
+    if(argc > 1) {{
+        vcd = new VerilatedVcdC;
+        top->trace(vcd, 99);
+        vcd->open(argv[1]);
+    }}
+#endif
+    top->eval();
+    while(fgets(line, sizeof(line), stdin)) {{
+        switch(line[0]) {{
+        case 'w':
+            sscanf(line + 1, "%d %llx", &id, &value);
+            pending_id[n_pending] = id;
+            pending_value[n_pending] = value;
+            n_pending++;
+            break;
+        case 'i':
+            apply();
+            top->eval();
+            break;
+        case 'r':
+            sscanf(line + 1, "%d", &id);
+            printf("%llx\\n", (unsigned long long)get(id));
+            fflush(stdout);
+            break;
+        case 'a':
+            sscanf(line + 1, "%d", &id);
+            watch[n_watch++] = id;
+            break;
+        case 's':
+            top->{clk} = 1;
+            top->eval();
+            apply();
+            top->eval();
+#if VM_TRACE
+            if(vcd) vcd->dump(t++);
+#endif
+            top->{clk} = 0;
+            top->eval();
+#if VM_TRACE
+            if(vcd) vcd->dump(t++);
+#endif
+            for(int i = 0; i < n_watch; i++)
+                printf(i ? " %llx" : "%llx",
+                       (unsigned long long)get(watch[i]));
+            printf("\\n");
+            fflush(stdout);
+            break;
+        case 'q':
+            goto done;
+        }}
+    }}
+done:
+#if VM_TRACE
+    if(vcd) vcd->close();
+#endif
+    top->final();
+    delete top;
+    return 0;
+}}
+"""
+
+
+class _Design:
+    # Verilog and harness of a design, with the signal ids of the protocol
+    def __init__(self, fragment):
+        if not isinstance(fragment, _Fragment):
+            fragment = fragment.get_fragment()
+        f, _ = lower_specials({}, fragment)
+        domains = {cd.name for cd in f.clock_domains}
+        for cd in f.clock_domains:
+            if cd.name != "sys":
+                raise NotImplementedError("clock domain " + cd.name)
+        if "sys" in domains:
+            cd = f.clock_domains["sys"]
+        else:
+            cd = ClockDomain("sys")
+            f.clock_domains.append(cd)
+
+        signals = list_signals(f) | list_special_ios(f, True, True, False)
+        driven = list_targets(f) | list_special_ios(f, False, True, True)
+        driven -= {cd.clk, cd.rst}
+        self.signals = signals
+        self.inputs = {s for s in signals - driven if 0 < len(s) <= 64}
+        self.inputs |= {cd.clk, cd.rst}
+        self.ids = {}
+        ports = set(self.inputs)
+        probes = {}
+        for signal in sorted(signals | self.inputs, key=lambda s: s.duid):
+            if signal in self.inputs:
+                port = signal
+            elif 0 < len(signal) <= 64:
+                # output reg ports would lose the reset value of signal
+                port = Signal(len(signal),
+                              name_override="probe{}".format(len(probes)))
+                probes[signal] = port
+                ports.add(port)
+            else:
+                continue
+            self.ids[signal] = len(self.ids)
+        f.comb += [port.eq(signal) for signal, port in probes.items()]
+
+        output = verilog.convert(f, ports, name="top")
+        self.sources = collections.OrderedDict([("top.v",
+                                                 output.main_source)])
+        self.sources.update(output.data_files)
+        names = {signal: output.ns.get_name(probes.get(signal, signal))
+                 for signal in self.ids}
+        self.sources["harness.cpp"] = _HARNESS.format(
+            n=len(self.ids) + 1,
+            clk=names[cd.clk],
+            get="\n".join("    case {}: return top->{};".format(
+                self.ids[signal], names[signal]) for signal in self.ids),
+            set="\n".join("    case {}: top->{} = value; break;".format(
+                self.ids[signal], names[signal])
+                for signal in sorted(self.inputs, key=self.ids.get)))
+        self.names = {output.ns.get_name(obj) for obj in output.ns.sigs}
+
+    # migen numbers the names of the instances of a class across a process:
+    # the names of the migen namespace are renamed in order of appearance,
+    # so that the same design elaborated again hits the cache. Other
+    # tokens, such as the base and digits of sized literals (3'd5), are
+    # kept. The protocol ids only depend on the structure.
+    def key(self, trace):
+        names = {}
+
+        def rename(m):
+            name = m.group(0)
+            if name not in self.names:
+                return name
+            return names.setdefault(name, "n{}".format(len(names)))
+
+        h = hashlib.sha256(str(trace).encode())
+        for name, content in self.sources.items():
+            if name in ("top.v", "harness.cpp"):
+                content = _identifier.sub(rename, content)
+            h.update(content.encode() + b"\0")
+        return h.hexdigest()
+
+
+_identifier = re.compile(r"(?<![A-Za-z0-9_$'])[A-Za-z_][A-Za-z0-9_$]*")
+
+
+def _build(design, trace, cache_dir):
+    entry = os.path.join(cache_dir, "verilator", design.key(trace))
+    if os.path.isdir(entry):
+        return entry
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    build_dir = tempfile.mkdtemp(dir=os.path.dirname(entry))
+    for name, content in design.sources.items():
+        with open(os.path.join(build_dir, name), "w") as f:
+            f.write(content)
+    command = ["verilator", "--cc", "top.v", "--exe", "harness.cpp",
+               "--top-module", "top", "-Mdir", "obj", "-O3",
+               "-Wno-fatal", "-Wno-lint", "-Wno-style", "-Wno-COMBDLY",
+               "-Wno-INITIALDLY", "-CFLAGS", "-O2"]
+    if trace:
+        command.append("--trace")
+    try:
+        subprocess.check_call(command, cwd=build_dir,
+                              stdout=subprocess.DEVNULL)
+        subprocess.check_call(["make", "-s", "-C", "obj", "-f", "Vtop.mk",
+                               "-j", str(os.cpu_count() or 1)],
+                              cwd=build_dir, stdout=subprocess.DEVNULL)
+    except:
+        shutil.rmtree(build_dir)
+        raise
+    try:
+        os.rename(build_dir, entry)
+    except OSError:
+        # built meanwhile by another process
+        shutil.rmtree(build_dir)
+    return entry
+
+
+class VerilatorSimulator:
+    def __init__(self, fragment_or_module, generators, clocks={"sys": 10},
+                 vcd_name=None, cache_dir=CACHE_DIR):
+        if set(clocks) != {"sys"}:
+            raise NotImplementedError("only the sys clock domain is supported")
+        self.design = _Design(fragment_or_module)
+        entry = _build(self.design, vcd_name is not None, cache_dir)
+
+        if isinstance(generators, dict):
+            if set(generators) != {"sys"}:
+                raise NotImplementedError(
+                    "only the sys clock domain is supported")
+            generators = generators["sys"]
+        if (isinstance(generators, collections.abc.Iterable) and
+                not inspect.isgenerator(generators)):
+            self.generators = list(generators)
+        else:
+            self.generators = [generators]
+        self.passive_generators = set()
+
+        command = [os.path.join(entry, "obj", "Vtop")]
+        if vcd_name is not None:
+            command.append(os.path.abspath(vcd_name))
+        # the memory initialization files are read from the working
+        # directory
+        self.process = subprocess.Popen(command, cwd=entry,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        self.watch = []
+        self.values = {}
+        # the last write of a cycle wins
+        self.pending = collections.OrderedDict()
+        for signal in self.design.inputs:
+            if signal.reset.value:
+                self.pending[signal] = signal.reset.value
+        self.unused = {}
+        self.pending_unused = {}
+        self._send("i")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.write("q\n")
+            self.process.stdin.close()
+            self.process.wait()
+
+    def _send(self, command):
+        lines = ["w {} {:x}\n".format(self.design.ids[signal],
+                                      value & (2**len(signal) - 1))
+                 for signal, value in self.pending.items()]
+        self.pending.clear()
+        self.process.stdin.write("".join(lines) + command + "\n")
+        self.process.stdin.flush()
+
+    def _id(self, signal):
+        try:
+            return self.design.ids[signal]
+        except KeyError:
+            raise ValueError("{} is not visible in co-simulation"
+                             .format(signal))
+
+    def read(self, signal):
+        if signal not in self.design.signals:
+            value = self.unused.get(signal, signal.reset.value)
+        else:
+            if signal not in self.values:
+                self._send("r {}\na {}".format(self._id(signal),
+                                               self._id(signal)))
+                self.values[signal] = int(self.process.stdout.readline(), 16)
+                self.watch.append(signal)
+            value = self.values[signal]
+        if signal.signed and value & (1 << len(signal) - 1):
+            value -= 1 << len(signal)
+        return value
+
+    def eval(self, node):
+        if isinstance(node, Signal):
+            return self.read(node)
+        elif isinstance(node, _Slice):
+            value = self.eval(node.value)
+            return (value >> node.start) & (2**(node.stop - node.start) - 1)
+        elif isinstance(node, Constant):
+            return node.value
+        elif isinstance(node, int):
+            return node
+        raise NotImplementedError(node)
+
+    def write(self, statement):
+        if not isinstance(statement.l, Signal):
+            raise NotImplementedError(statement)
+        value = self.eval(statement.r) & (2**len(statement.l) - 1)
+        if statement.l not in self.design.signals:
+            self.pending_unused[statement.l] = value
+        elif statement.l in self.design.inputs:
+            self.pending[statement.l] = value
+        else:
+            raise ValueError("{} is driven by the design".format(statement.l))
+
+    def _evalexec_nested_lists(self, x):
+        if isinstance(x, list):
+            return [self._evalexec_nested_lists(e) for e in x]
+        elif isinstance(x, _Value):
+            return self.eval(x)
+        elif isinstance(x, _Assign):
+            self.write(x)
+            return None
+        else:
+            raise ValueError("Invalid simulator exec/eval request", x)
+
+    def _process_generators(self):
+        exhausted = []
+        for generator in self.generators:
+            reply = None
+            while True:
+                try:
+                    request = generator.send(reply)
+                    if request is None:
+                        break  # next cycle
+                    elif isinstance(request, str):
+                        if request == "passive":
+                            self.passive_generators.add(generator)
+                        elif request == "active":
+                            self.passive_generators.discard(generator)
+                        else:
+                            raise ValueError("Unknown simulator command: '{}'"
+                                             .format(request))
+                    else:
+                        reply = self._evalexec_nested_lists(request)
+                except StopIteration:
+                    exhausted.append(generator)
+                    break
+        for generator in exhausted:
+            self.generators.remove(generator)
+
+    def _step(self):
+        self._send("s")
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("the simulator process exited")
+        self.values = dict(zip(self.watch,
+                               (int(value, 16) for value in line.split())))
+        self.unused.update(self.pending_unused)
+        self.pending_unused.clear()
+
+    def run(self):
+        while set(self.generators) - self.passive_generators:
+            self._process_generators()
+            self._step()
+
+
+def run_verilator(*args, **kwargs):
+    with VerilatorSimulator(*args, **kwargs) as s:
+        s.run()
+
+
+# Drop-in for migen's run_simulation, backend is one of BACKENDS, and
+# defaults to $SIM_BACKEND or migen.
+def run_simulation(*args, backend=None, **kwargs):
+    if backend is None:
+        backend = os.environ.get("SIM_BACKEND", "migen")
+    if backend == "migen":
+        _migen_run_simulation(*args, **kwargs)
+    elif backend == "verilator":
+        run_verilator(*args, **kwargs)
+    else:
+        raise ValueError("unknown simulation backend " + backend)
@@ -1,11 +1,20 @@
+import math
+from collections import namedtuple
+
 from migen import *
+from migen.genlib.fifo import SyncFIFO
+from migen.genlib.cdc import MultiReg
 from misoc.interconnect import wishbone
 
 
 __all__ = [
-    "I2CMaster",
-    "I2C_XFER_ADDR", "I2C_CONFIG_ADDR",
+    "I2CMaster", "I2CEngineMux",
+    "I2C_XFER_ADDR", "I2C_CONFIG_ADDR", "I2C_FIFO_ADDR", "I2C_HOLD_ADDR",
+    "I2C_OCTETS_ADDR", "I2C_NACKS_ADDR", "I2C_BUSY_CYCLES_ADDR",
+    "I2C_POLLS_ADDR",
     "I2C_ACK", "I2C_READ", "I2C_WRITE", "I2C_STOP", "I2C_START", "I2C_IDLE",
+    "I2C_ERROR", "I2C_FULL", "I2C_REFUSED",
+    "I2CTiming", "I2C_TIMINGS", "i2c_divider", "i2c_hold",
 ]
 
 
@@ -30,6 +39,7 @@ class I2CClockGen(Module):
 class I2CMasterMachine(Module):
     def __init__(self, clock_width):
         self.scl_o = Signal(reset=1)
+        self.scl_i = Signal(reset=1)
         self.sda_o = Signal(reset=1)
         self.sda_i = Signal()
 
@@ -41,6 +51,9 @@ class I2CMasterMachine(Module):
         self.read  = Signal()
         self.ack   = Signal()
         self.data  = Signal(8)
+        # Pulses when an octet has been written and its ACK read
+        self.written = Signal()
+        self.nack    = Signal()
 
         ###
 
@@ -51,10 +64,10 @@ class I2CMasterMachine(Module):
         self.submodules += fsm
 
         fsm.act("IDLE",
-            If(self.start,
-                NextState("START0"),
-            ).Elif(self.stop & self.start,
+            If(self.stop & self.start,
                 NextState("RESTART0"),
+            ).Elif(self.start,
+                NextState("START0"),
             ).Elif(self.stop,
                 NextState("STOP0"),
             ).Elif(self.write,
@@ -82,10 +95,10 @@ class I2CMasterMachine(Module):
 
         fsm.act("STOP0",
             NextValue(self.scl_o, 0),
+            NextValue(self.sda_o, 0),
             NextState("STOP1"))
         fsm.act("STOP1",
             NextValue(self.scl_o, 1),
-            NextValue(self.sda_o, 0),
             NextState("STOP2"))
         fsm.act("STOP2",
             NextValue(self.sda_o, 1),
@@ -133,7 +146,7 @@ class I2CMasterMachine(Module):
         )
         fsm.act("READ2",
             NextValue(self.scl_o, 1),
-            NextValue(self.data[:-1], self.data[1:]),
+            NextValue(self.data[1:], self.data[:-1]),
             NextValue(bits, bits - 1),
             NextState("READ1"),
         )
@@ -142,17 +155,155 @@ class I2CMasterMachine(Module):
             NextState("IDLE"),
         )
 
+        # A slave stretches the clock by holding SCL low after it has been
+        # released: the half period only starts once SCL reads high.
         run = Signal()
+        stretch = Signal()
         self.comb += [
             run.eq(self.start | self.stop | self.write | self.read),
             self.idle.eq(~run & fsm.ongoing("IDLE")),
-            self.cg.ce.eq(~self.idle),
-            fsm.ce.eq(run | self.cg.clk2x),
+            stretch.eq(self.scl_o & ~self.scl_i),
+            self.cg.ce.eq(~self.idle & ~stretch),
+            fsm.ce.eq(run | (self.cg.clk2x & ~stretch)),
+            self.written.eq(fsm.ongoing("READACK1") & fsm.ce),
+            self.nack.eq(self.written & self.sda_i),
+        ]
+
+
+class I2CFramer(Module):
+    def __init__(self, i2c, depth):
+        self.we       = Signal()
+        self.writable = Signal()
+        self.data_in  = Signal(8)
+        self.start_in = Signal()
+        self.stop_in  = Signal()
+        self.read_in  = Signal()
+        self.level    = Signal(max=depth + 1)
+
+        self.idle  = Signal()
+        self.error = Signal()
+        self.clear = Signal()
+        # Last octet read, rdata_stb pulses when it is updated
+        self.rdata = Signal(8)
+        self.rdata_stb = Signal()
+
+        # Commands to I2CMasterMachine, valid for one cycle
+        self.start = Signal()
+        self.stop  = Signal()
+        self.write = Signal()
+        self.read  = Signal()
+        self.ack   = Signal()
+        self.data  = Signal(8)
+
+        ###
+
+        self.submodules.fifo = fifo = SyncFIFO(11, depth)
+        self.comb += [
+            fifo.din.eq(Cat(self.data_in, self.start_in, self.stop_in,
+                            self.read_in)),
+            fifo.we.eq(self.we),
+            self.writable.eq(fifo.writable),
+            self.level.eq(fifo.level),
+        ]
+
+        f_data  = fifo.dout[0:8]
+        f_start = fifo.dout[8]
+        f_stop  = fifo.dout[9]
+        f_read  = fifo.dout[10]
+
+        data     = Signal(8)
+        stop     = Signal()
+        in_frame = Signal()
+        discard  = Signal()
+
+        fsm = FSM("FETCH")
+        self.submodules += fsm
+
+        fsm.act("FETCH",
+            fifo.re.eq(1),
+            If(fifo.readable,
+                NextValue(data, f_data),
+                NextValue(stop, f_stop),
+                If(f_start,
+                    # repeated START if a frame is already open
+                    self.start.eq(1),
+                    self.stop.eq(in_frame),
+                    NextValue(in_frame, 1),
+                    NextState("START"),
+                ).Elif(f_read,
+                    # the last octet of a read frame is NACKed
+                    self.read.eq(1),
+                    self.ack.eq(~f_stop),
+                    NextState("READ"),
+                ).Else(
+                    self.write.eq(1),
+                    self.data.eq(f_data),
+                    NextState("WRITE"),
+                )
+            )
+        )
+        fsm.act("START",
+            If(i2c.idle,
+                self.write.eq(1),
+                self.data.eq(data),
+                NextState("WRITE"),
+            )
+        )
+        fsm.act("WRITE",
+            If(i2c.idle,
+                If(~i2c.ack,
+                    NextValue(self.error, 1),
+                    NextValue(discard, ~stop),
+                    self.stop.eq(1),
+                    NextState("STOP"),
+                ).Elif(stop,
+                    self.stop.eq(1),
+                    NextState("STOP"),
+                ).Else(
+                    NextState("FETCH"),
+                )
+            )
+        )
+        fsm.act("READ",
+            If(i2c.idle,
+                NextValue(self.rdata, i2c.data),
+                If(stop,
+                    self.stop.eq(1),
+                    NextState("STOP"),
+                ).Else(
+                    NextState("FETCH"),
+                )
+            )
+        )
+        fsm.act("STOP",
+            NextValue(in_frame, 0),
+            If(i2c.idle,
+                If(discard,
+                    NextState("DISCARD"),
+                ).Else(
+                    NextState("FETCH"),
+                )
+            )
+        )
+        # drop the rest of a NACKed frame, up to and including its STOP
+        fsm.act("DISCARD",
+            NextValue(discard, 0),
+            fifo.re.eq(1),
+            If(fifo.readable & f_stop,
+                NextState("FETCH"),
+            )
+        )
+
+        self.sync += [
+            If(self.clear, self.error.eq(0)),
+            self.rdata_stb.eq(fsm.ongoing("READ") & i2c.idle),
         ]
+        self.comb += self.idle.eq(fsm.ongoing("FETCH") & ~fifo.readable &
+                                  i2c.idle)
 
 # Registers:
 # config = Record([
-#     ("div",   20),
+#     ("div",   20),  # SCL half period - 1, in cycles
 # ])
 # xfer = Record([
 #     ("data",  8),
@@ -162,30 +313,81 @@ class I2CMasterMachine(Module):
 #     ("start", 1),
 #     ("stop",  1),
 #     ("idle",  1),
+#     ("",      1),
+#     ("refused", 1),  # R: see I2CEngineMux
 # ])
+# fifo = Record([
+#     ("data",  8),  # W: octet to send, R: last octet read
+#     ("error", 1),  # R: a frame was NACKed, W: clear error (no octet queued)
+#     ("read",  1),  # W: read an octet instead, ACKed unless stop is set
+#     ("",      1),
+#     ("start", 1),  # W: (repeated) START before the octet
+#     ("stop",  1),  # W: STOP after the octet
+#     ("idle",  1),  # R: FIFO empty and all frames sent
+#     ("full",  1),  # R
+#     ("refused", 1),  # R: see I2CEngineMux
+#     ("level", 8),  # R
+# ])
+# hold = Record([
+#     ("hold",  8),  # SDA hold time after SCL falls, in cycles (at least 1)
+# ])
+# followed by the performance counters, 32 bits, cleared by writing:
+# octets sent, octets NACKed, cycles with the bus busy, and status reads
+# (XFER or FIFO register) while polling.
+#
+# pipelined: accesses are acked in the cycle they are requested and the
+# registers are read combinationally, so that a master keeping cyc and stb
+# asserted gets one access per cycle. Writes to a full FIFO wait for room
+# in both modes.
 class I2CMaster(Module):
-    def __init__(self, pads, bus=None):
+    def __init__(self, pads, bus=None, fifo_depth=16, clock_stretching=True,
+                 pipelined=False):
         if bus is None:
             bus = wishbone.Interface(data_width=32)
         self.bus = bus
+        # Event: FIFO empty and all frames sent
+        self.idle = Signal()
 
         ###
 
         # Wishbone
         self.submodules.i2c = i2c = I2CMasterMachine(
             clock_width=20)
+        hold = Signal(8)
+        self.submodules.framer = framer = I2CFramer(i2c, fifo_depth)
+        self.comb += self.idle.eq(framer.idle)
+
+        fifo_write = Signal()
+        self.comb += [
+            fifo_write.eq(bus.ack & bus.we & (bus.adr == 2)),
+            framer.we.eq(fifo_write & ~bus.dat_w[8]),
+            framer.clear.eq(fifo_write & bus.dat_w[8]),
+            framer.data_in.eq(bus.dat_w[0:8]),
+            framer.start_in.eq(bus.dat_w[11]),
+            framer.stop_in.eq(bus.dat_w[12]),
+            framer.read_in.eq(bus.dat_w[9]),
+        ]
+
+        stall = Signal()
+        self.comb += stall.eq(bus.we & (bus.adr == 2) & ~framer.writable)
+        if pipelined:
+            self.comb += bus.ack.eq(bus.cyc & bus.stb & ~stall)
+        else:
+            self.sync += [
+                bus.ack.eq(0),
+                If(bus.cyc & bus.stb & ~bus.ack & ~stall,
+                    bus.ack.eq(1),
+                ),
+            ]
+        registers = [
+            (0, Cat(i2c.data, i2c.ack, C(0, 4), i2c.idle)),
+            (1, i2c.cg.load),
+            (2, Cat(framer.rdata, framer.error, C(0, 4), framer.idle,
+                    ~framer.writable, C(0, 1), framer.level)),
+            (3, hold),
+        ]
 
         self.sync += [
-            bus.ack.eq(0),
-            If(bus.cyc & bus.stb & ~bus.ack,
-                bus.ack.eq(1),
-            ),
-            If(bus.adr == 0,
-                bus.dat_r.eq(Cat(i2c.data, i2c.ack, C(0, 4), i2c.idle)),
-            ),
-            If(bus.adr == 1,
-                bus.dat_r.eq(i2c.cg.load),
-            ),
             If(bus.ack & bus.we & (bus.adr == 0),
                 i2c.data.eq(bus.dat_w[0:8]),
                 i2c.ack.eq(bus.dat_w[8]),
@@ -193,6 +395,15 @@ class I2CMaster(Module):
                 i2c.write.eq(bus.dat_w[10]),
                 i2c.start.eq(bus.dat_w[11]),
                 i2c.stop.eq(bus.dat_w[12]),
+            ).Elif(framer.start | framer.stop | framer.write | framer.read,
+                i2c.data.eq(framer.data),
+                i2c.write.eq(framer.write),
+                i2c.read.eq(framer.read),
+                i2c.start.eq(framer.start),
+                i2c.stop.eq(framer.stop),
+                If(framer.read,
+                    i2c.ack.eq(framer.ack),
+                ),
             ).Else(
                 i2c.read.eq(0),
                 i2c.write.eq(0),
@@ -202,8 +413,38 @@ class I2CMaster(Module):
             If(bus.ack & bus.we & (bus.adr == 1),
                 i2c.cg.load.eq(bus.dat_w),
             ),
+            If(bus.ack & bus.we & (bus.adr == 3),
+                hold.eq(bus.dat_w),
+            ),
         ]
 
+        # Performance counters
+        counters = [
+            (I2C_OCTETS_ADDR,      i2c.written),
+            (I2C_NACKS_ADDR,       i2c.nack),
+            (I2C_BUSY_CYCLES_ADDR, ~i2c.idle),
+            (I2C_POLLS_ADDR,       bus.ack & ~bus.we &
+                                   ((bus.adr == I2C_XFER_ADDR) |
+                                    (bus.adr == I2C_FIFO_ADDR))),
+        ]
+        for address, increment in counters:
+            counter = Signal(32)
+            self.sync += [
+                If(bus.ack & bus.we & (bus.adr == address),
+                    counter.eq(0),
+                ).Elif(increment,
+                    counter.eq(counter + 1),
+                ),
+            ]
+            registers.append((address, counter))
+
+        reads = [If(bus.adr == address, bus.dat_r.eq(value))
+                 for address, value in registers]
+        if pipelined:
+            self.comb += reads
+        else:
+            self.sync += reads
+
         # I/O
         self.scl_t = TSTriple()
         self.specials += self.scl_t.get_tristate(pads.scl)
@@ -211,18 +452,140 @@ class I2CMaster(Module):
             self.scl_t.oe.eq(~i2c.scl_o),
             self.scl_t.o.eq(0),
         ]
+        if clock_stretching:
+            self.specials += MultiReg(self.scl_t.i, i2c.scl_i, reset=1)
+        else:
+            self.comb += i2c.scl_i.eq(1)
+
+        # SDA changes are delayed by the hold time, so that they happen
+        # well after SCL has fallen
+        sda_o = Signal(reset=1)
+        hold_cnt = Signal(8)
+        self.sync += [
+            If(sda_o == i2c.sda_o,
+                hold_cnt.eq(hold),
+            ).Elif(hold_cnt <= 1,
+                sda_o.eq(i2c.sda_o),
+            ).Else(
+                hold_cnt.eq(hold_cnt - 1),
+            )
+        ]
 
         self.sda_t = TSTriple()
         self.specials += self.sda_t.get_tristate(pads.sda)
         self.comb += [
-            self.sda_t.oe.eq(~i2c.sda_o),
+            self.sda_t.oe.eq(~sda_o),
             self.sda_t.o.eq(0),
-            i2c.sda_i.eq(self.sda_t.i),
         ]
+        self.specials += MultiReg(self.sda_t.i, i2c.sda_i, reset=1)
+
+
+# Lets an engine (I2CCapture, I2CDMA) take over the bus of an I2CMaster,
+# target, from its user on bus: bus is passed through to target, port
+# instead while grant is set. Accesses on bus are then refused: acked at
+# once, so that the user never holds a shared bus while the engine runs,
+# with reads returning I2C_FULL without I2C_IDLE. A refused write sets
+# I2C_REFUSED in the XFER and FIFO registers read on bus, until cleared
+# with I2C_ERROR, so that the user can tell and retry (i2c_retry() does).
+# The engine sets grant while no access is in progress on bus.
+class I2CEngineMux(Module):
+    def __init__(self, bus, target):
+        self.port = wishbone.Interface()
+        self.grant = Signal()
+
+        ###
+
+        refuse = Signal()
+        refused = Signal()
+        status = Signal()
+        self.comb += [
+            status.eq((bus.adr == I2C_XFER_ADDR) |
+                      (bus.adr == I2C_FIFO_ADDR)),
+            If(self.grant,
+                self.port.connect(target),
+                bus.ack.eq(refuse),
+                bus.dat_r.eq(Mux(refused, I2C_FULL | I2C_REFUSED, I2C_FULL)),
+            ).Else(
+                bus.connect(target),
+                If(status & refused,
+                    bus.dat_r.eq(target.dat_r | I2C_REFUSED),
+                ),
+            ),
+        ]
+        self.sync += [
+            refuse.eq(0),
+            If(self.grant & bus.cyc & bus.stb & ~refuse,
+                refuse.eq(1),
+            ),
+            If(refuse & bus.we,
+                refused.eq(1),
+            ).Elif(~self.grant & bus.ack & bus.we &
+                   (bus.adr == I2C_FIFO_ADDR) & bus.dat_w[8],
+                refused.eq(0),
+            ),
+        ]
+
+
+# Minimum bus timing, in seconds, from the I2C-bus specification (UM10204).
+# t_hd_dat is the SDA hold time used by the master: at least the SCL fall
+# time, it is not required by the specification but keeps SDA transitions
+# clear of the SCL edge.
+I2CTiming = namedtuple("I2CTiming",
+    "scl_freq t_low t_high t_su_dat t_hd_dat t_hd_sta t_su_sta t_su_sto t_buf")
+
+I2C_TIMINGS = {
+    "standard":  I2CTiming(100e3, 4.7e-6, 4.0e-6, 250e-9, 300e-9,
+                           4.0e-6, 4.7e-6, 4.0e-6, 4.7e-6),
+    "fast":      I2CTiming(400e3, 1.3e-6, 0.6e-6, 100e-9, 300e-9,
+                           0.6e-6, 0.6e-6, 0.6e-6, 1.3e-6),
+    "fast_plus": I2CTiming(1e6,   0.5e-6, 0.26e-6, 50e-9, 120e-9,
+                           0.26e-6, 0.26e-6, 0.26e-6, 0.5e-6),
+}
+
+
+def _cycles(t, clk_freq):
+    # rounding guards against t*clk_freq landing just above an integer
+    return math.ceil(round(t*clk_freq, 6))
+
+
+def i2c_hold(clk_freq, mode="standard"):
+    hold = max(_cycles(I2C_TIMINGS[mode].t_hd_dat, clk_freq), 1)
+    if hold >= 1 << 8:
+        raise ValueError("clock too fast for the SDA hold time")
+    return hold
+
+
+# Smallest divider meeting the timing of the mode. SCL is symmetric, every
+# phase of the bus lasts one half period (div + 1 cycles) and SDA changes
+# hold cycles into it. Clock stretching, and the SCL input synchronizer,
+# only lengthen the high phases.
+def i2c_divider(clk_freq, mode="standard"):
+    timing = I2C_TIMINGS[mode]
+    hold = i2c_hold(clk_freq, mode)
+    half = max(
+        _cycles(1/(2*timing.scl_freq), clk_freq),
+        _cycles(timing.t_low, clk_freq),
+        _cycles(timing.t_high, clk_freq),
+        _cycles(timing.t_su_sta, clk_freq),
+        _cycles(timing.t_su_sto, clk_freq),
+        _cycles(timing.t_buf, clk_freq),
+        hold + _cycles(timing.t_su_dat, clk_freq),
+        hold + _cycles(timing.t_hd_sta, clk_freq),
+    )
+    if half - 1 >= 1 << 20:
+        raise ValueError("clock too fast for the I2C divider")
+    return half - 1
+
 
 # Testbench
 
-I2C_XFER_ADDR, I2C_CONFIG_ADDR = range(2)
+I2C_XFER_ADDR, I2C_CONFIG_ADDR, I2C_FIFO_ADDR, I2C_HOLD_ADDR = range(4)
+(
+    I2C_OCTETS_ADDR,
+    I2C_NACKS_ADDR,
+    I2C_BUSY_CYCLES_ADDR,
+    I2C_POLLS_ADDR,
+) = range(4, 8)
 (
     I2C_ACK,
     I2C_READ,
@@ -230,7 +593,10 @@ I2C_XFER_ADDR, I2C_CONFIG_ADDR = range(2)
     I2C_START,
     I2C_STOP,
     I2C_IDLE,
-) = (1 << i for i in range(8, 14))
+    I2C_FULL,
+) = (1 << i for i in range(8, 15))
+I2C_ERROR = I2C_ACK
+I2C_REFUSED = 1 << 15
 
 
 def I2C_DIV_WRITE(i):
@@ -262,28 +628,31 @@ def _test_gen(bus):
     yield from _test_read(bus)
 
 
-class _TestPads:
-    def __init__(self):
-        self.scl = Signal()
-        self.sda = Signal()
-
-
-class _TestTristate(Module):
-    def __init__(self, t):
-        oe = Signal()
-        self.comb += [
-            t.target.eq(t.o),
-            oe.eq(t.oe),
-            t.i.eq(t.o),
-        ]
-
-
 if __name__ == "__main__":
-    from migen.fhdl.specials import Tristate
-
-    pads = _TestPads()
+    import sys
+    from i2c_sim import open_drain, I2CPads, I2CRegisterDevice, i2c_devices
+    from i2c_trace import i2c_monitor, vcd_window
+    # $SIM_BACKEND selects the simulator
+    from cosim import run_simulation
+
+    # Prints the decoded bus. "python i2c.py FIRST LAST" also dumps the
+    # lines and the wishbone port over cycles [FIRST, LAST) to
+    # i2c_master.vcd.
+    pads = I2CPads()
     dut = I2CMaster(pads)
-
-    Tristate.lower = _TestTristate
-    run_simulation(dut, _test_gen(dut.bus), vcd_name="i2c_master.vcd")
-
+    device = I2CRegisterDevice({0x05: 0x5a, 0x06: 0xa5})
+    generators = [
+        _test_gen(dut.bus),
+        i2c_devices(dut, pads, {0x20: device, 0x40: device}),
+        i2c_monitor(dut, log=sys.stdout),
+    ]
+    if len(sys.argv) == 3:
+        first, last = map(int, sys.argv[1:])
+        generators.append(vcd_window(
+            [dut.scl_t.i, dut.sda_t.i,
+             dut.bus.cyc, dut.bus.stb, dut.bus.ack, dut.bus.we,
+             dut.bus.adr, dut.bus.dat_w, dut.bus.dat_r],
+            "i2c_master.vcd", first, last))
+
+    with open_drain():
+        run_simulation(dut, generators)
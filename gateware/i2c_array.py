@@ -0,0 +1,96 @@
+from functools import reduce
+from operator import and_, or_
+
+from migen import *
+from misoc.interconnect import wishbone
+
+from sequencer import *
+from i2c import I2CMaster
+
+
+__all__ = ["I2CMasterArray", "ARRAY_STRIDE"]
+
+
+# Control bus: the Sequencer control registers and program memory of bus i
+# at i*ARRAY_STRIDE. Writes to n*ARRAY_STRIDE + SEQ_CTRL_ADDR (one past the
+# last bus) start all programs at once, reads from there give the combined
+# status:
+# ctrl = Record([
+#     ("running", 1),  # R: a program is running
+#     ("done",    1),  # R: all programs reached InstEnd
+#     ("timeout", 1),  # R: a program stopped by a timeout or InstAbort
+# ])
+ARRAY_STRIDE = 2*SEQ_PROGRAM_BASE
+
+
+# Independent I2C buses, each with its own I2CMaster and Sequencer, so that
+# the devices on different buses are configured concurrently. programs has
+# one program per bus in pads; events[0] of every Sequencer is the idle
+# event of its I2CMaster.
+class I2CMasterArray(Module):
+    def __init__(self, pads, programs, fifo_depth=16, **kwargs):
+        assert len(pads) == len(programs)
+        n = len(pads)
+        self.ctrl = ctrl = wishbone.Interface()
+        self.running = Signal()
+        self.done = Signal()
+        self.timeout = Signal()
+        self.masters = []
+        self.sequencers = []
+
+        ###
+
+        for bus_pads, program in zip(pads, programs):
+            master = I2CMaster(bus_pads, fifo_depth=fifo_depth)
+            sequencer = Sequencer(program, master.bus, **kwargs)
+            self.comb += sequencer.events[0].eq(master.idle)
+            self.submodules += master, sequencer
+            self.masters.append(master)
+            self.sequencers.append(sequencer)
+
+        self.comb += [
+            self.running.eq(reduce(or_, [s.running for s in self.sequencers])),
+            self.done.eq(reduce(and_, [s.done for s in self.sequencers])),
+            self.timeout.eq(reduce(or_, [s.timeout for s in self.sequencers])),
+        ]
+
+        index = Signal(max=n + 1)
+        offset = ctrl.adr[:log2_int(ARRAY_STRIDE)]
+        self.comb += If(ctrl.adr[log2_int(ARRAY_STRIDE):] < n,
+            index.eq(ctrl.adr[log2_int(ARRAY_STRIDE):]),
+        ).Else(
+            index.eq(n),
+        )
+        broadcast = Signal()
+        self.comb += broadcast.eq((index == n) & (offset == SEQ_CTRL_ADDR))
+        for i, sequencer in enumerate(self.sequencers):
+            selected = (index == i) | broadcast & ctrl.we
+            self.comb += [
+                sequencer.ctrl.adr.eq(offset),
+                sequencer.ctrl.dat_w.eq(ctrl.dat_w),
+                sequencer.ctrl.sel.eq(ctrl.sel),
+                sequencer.ctrl.we.eq(ctrl.we),
+                sequencer.ctrl.cyc.eq(ctrl.cyc & selected),
+                sequencer.ctrl.stb.eq(ctrl.stb & selected),
+            ]
+
+        # combined status, and acks for unmapped addresses
+        ack = Signal()
+        self.sync += [
+            ack.eq(0),
+            If(ctrl.cyc & ctrl.stb & ~ack & (index == n) &
+                    ~(broadcast & ctrl.we),
+                ack.eq(1),
+            ),
+        ]
+        acks = Array([s.ctrl.ack for s in self.sequencers] +
+                     [Mux(broadcast & ctrl.we, self.sequencers[0].ctrl.ack,
+                          ack)])
+        status = Signal(32)
+        self.comb += status.eq(Cat(self.running, self.done, self.timeout))
+        dat_rs = Array([s.ctrl.dat_r for s in self.sequencers] +
+                       [Mux(broadcast, status, 0)])
+        self.comb += [
+            ctrl.ack.eq(acks[index]),
+            ctrl.dat_r.eq(dat_rs[index]),
+        ]
@@ -0,0 +1,217 @@
+from migen import *
+from misoc.interconnect import wishbone
+
+from i2c import (I2CEngineMux, I2C_FIFO_ADDR, I2C_ERROR, I2C_READ,
+                 I2C_START, I2C_STOP)
+
+
+__all__ = [
+    "I2CCapture",
+    "CAPTURE_CTRL_ADDR", "CAPTURE_DEV_ADDR", "CAPTURE_REG_ADDR",
+    "CAPTURE_COUNT_ADDR", "CAPTURE_DATA_BASE",
+    "CAPTURE_START", "CAPTURE_BUSY", "CAPTURE_DONE", "CAPTURE_ERROR",
+]
+
+
+# Control interface:
+# ctrl = Record([
+#     ("start", 1),  # W: start a capture, R: capture running
+#     ("done",  1),  # R: capture complete
+#     ("error", 1),  # R: the capture was NACKed, fewer octets than count
+#     ("",      5),
+#     ("level", 9),  # R: octets captured
+# ])
+# dev = Record([
+#     ("dev",   8),  # device, write address
+# ])
+# reg = Record([
+#     ("reg",   8),  # first register
+# ])
+# count = Record([
+#     ("count", 9),  # registers to capture, at most depth
+# ])
+# The registers are not written while a capture runs. The octets captured
+# follow at CAPTURE_DATA_BASE (R), packed four per word, first octet in the
+# LSBs.
+CAPTURE_CTRL_ADDR, CAPTURE_DEV_ADDR, CAPTURE_REG_ADDR, CAPTURE_COUNT_ADDR = \
+    range(4)
+CAPTURE_DATA_BASE = 0x100
+CAPTURE_START = CAPTURE_BUSY = 1 << 0
+CAPTURE_DONE = 1 << 1
+CAPTURE_ERROR = 1 << 2
+
+
+# Reads count registers of a device, from reg, in a single frame using the
+# register address auto-increment, into a block RAM. All the reads of the
+# frame are queued in the I2CMaster FIFO, and each octet is stored as soon
+# as the framer has received it, so the bus runs without gaps.
+#
+# The capture engine sits between the I2CMaster and its user (CPU or
+# Sequencer): bus is passed through to the I2CMaster bus. While a capture
+# runs, accesses on bus are refused without stalling it: a user polling
+# for idle waits for the capture too, and a write sets I2C_REFUSED (see
+# I2CEngineMux).
+# grant is set while the capture owns the I2CMaster. A capture waits for
+# the frames already queued to be sent, and while hold is set.
+# If the capture is NACKed, it clears the I2CMaster error flag again unless
+# the flag was already set.
+class I2CCapture(Module):
+    def __init__(self, master, depth=256):
+        assert depth <= CAPTURE_DATA_BASE and depth % 4 == 0
+        self.bus = wishbone.Interface()
+        self.ctrl = ctrl = wishbone.Interface()
+        self.busy = Signal()
+        self.done = Signal()
+        self.error = Signal()
+        self.hold = Signal()
+        self.grant = grant = Signal()
+
+        ###
+
+        mem = Memory(32, depth//4)
+        self.specials += mem
+        write_port = mem.get_port(write_capable=True, we_granularity=8)
+        read_port = mem.get_port()
+        self.specials += write_port, read_port
+
+        # Arbitration
+        mux = I2CEngineMux(self.bus, master.bus)
+        self.submodules += mux
+        port = mux.port
+        self.comb += mux.grant.eq(grant)
+
+        # Control
+        dev = Signal(8)
+        reg = Signal(8)
+        count = Signal(max=depth + 1)
+        level = Signal(max=depth + 1)
+        start = Signal()
+        ctrl_data = Signal()
+        self.comb += [
+            ctrl_data.eq(ctrl.adr[log2_int(CAPTURE_DATA_BASE)]),
+            read_port.adr.eq(ctrl.adr),
+            If(ctrl_data,
+                ctrl.dat_r.eq(read_port.dat_r),
+            ).Else(
+                Case(ctrl.adr[:log2_int(CAPTURE_DATA_BASE)], {
+                    CAPTURE_CTRL_ADDR:
+                        ctrl.dat_r.eq(Cat(self.busy, self.done, self.error,
+                                          C(0, 5), level)),
+                    CAPTURE_DEV_ADDR:   ctrl.dat_r.eq(dev),
+                    CAPTURE_REG_ADDR:   ctrl.dat_r.eq(reg),
+                    CAPTURE_COUNT_ADDR: ctrl.dat_r.eq(count),
+                    "default":          ctrl.dat_r.eq(0),
+                }),
+            ),
+            start.eq(ctrl.ack & ctrl.we & (ctrl.adr == CAPTURE_CTRL_ADDR) &
+                     ctrl.dat_w[0]),
+        ]
+        self.sync += [
+            ctrl.ack.eq(0),
+            If(ctrl.cyc & ctrl.stb & ~ctrl.ack,
+                ctrl.ack.eq(1),
+            ),
+            If(ctrl.ack & ctrl.we & ~self.busy,
+                Case(ctrl.adr, {
+                    CAPTURE_DEV_ADDR:   dev.eq(ctrl.dat_w),
+                    CAPTURE_REG_ADDR:   reg.eq(ctrl.dat_w),
+                    CAPTURE_COUNT_ADDR: count.eq(ctrl.dat_w),
+                    "default":          [],
+                }),
+            ),
+        ]
+
+        # Octets read
+        store = Signal()
+        self.comb += [
+            store.eq(grant & master.framer.rdata_stb),
+            write_port.adr.eq(level[2:]),
+            write_port.dat_w.eq(Replicate(master.framer.rdata, 4)),
+            If(store,
+                write_port.we.eq(1 << level[:2]),
+            ),
+        ]
+        self.sync += If(store, level.eq(level + 1))
+
+        # Frame: START, DEV, REG, repeated START, DEV | 1, then count reads,
+        # all but the last ACKed
+        n = Signal(max=depth + 3)
+        word = Signal(13)
+        self.comb += [
+            If(n == 0,
+                word.eq(dev | I2C_START),
+            ).Elif(n == 1,
+                word.eq(reg),
+            ).Elif(n == 2,
+                word.eq(dev | 1 | I2C_START),
+            ).Elif(n == count + 2,
+                word.eq(I2C_READ | I2C_STOP),
+            ).Else(
+                word.eq(I2C_READ),
+            ),
+            port.adr.eq(I2C_FIFO_ADDR),
+            port.sel.eq(2**len(port.sel) - 1),
+            port.we.eq(1),
+        ]
+
+        error_set = Signal()
+
+        fsm = FSM("IDLE")
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            If(start,
+                NextValue(self.done, 0),
+                NextValue(self.error, 0),
+                NextValue(level, 0),
+                NextValue(n, 0),
+                If(count == 0,
+                    NextValue(self.done, 1),
+                ).Else(
+                    NextState("ACQUIRE"),
+                )
+            )
+        )
+        fsm.act("ACQUIRE",
+            If(~self.bus.cyc & master.idle & ~self.hold,
+                NextValue(grant, 1),
+                NextValue(error_set, master.framer.error),
+                NextState("QUEUE"),
+            )
+        )
+        fsm.act("QUEUE",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(word),
+            If(port.ack,
+                NextValue(n, n + 1),
+                If(n == count + 2,
+                    NextState("FINISH"),
+                )
+            )
+        )
+        fsm.act("FINISH",
+            If(master.idle,
+                If(level != count,
+                    NextValue(self.error, 1),
+                ),
+                If(master.framer.error & ~error_set,
+                    NextState("CLEAR"),
+                ).Else(
+                    NextValue(grant, 0),
+                    NextValue(self.done, 1),
+                    NextState("IDLE"),
+                )
+            )
+        )
+        fsm.act("CLEAR",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(I2C_ERROR),
+            If(port.ack,
+                NextValue(grant, 0),
+                NextValue(self.done, 1),
+                NextState("IDLE"),
+            )
+        )
+        self.comb += self.busy.eq(~fsm.ongoing("IDLE"))
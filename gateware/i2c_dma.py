@@ -0,0 +1,384 @@
+from migen import *
+from misoc.interconnect import wishbone
+
+from i2c import (I2CEngineMux, I2C_FIFO_ADDR, I2C_ERROR, I2C_READ,
+                 I2C_START, I2C_STOP)
+
+
+__all__ = [
+    "I2CDMA",
+    "DMA_CTRL_ADDR", "DMA_HEAD_ADDR", "DMA_CURRENT_ADDR", "DMA_COUNT_ADDR",
+    "DMA_START", "DMA_BUSY", "DMA_DONE", "DMA_ERROR",
+    "DESC_WORDS", "DESC_READ", "DESC_NO_REG", "DESC_CONTINUE",
+    "DESC_DONE", "DESC_NACK",
+]
+
+
+# Control interface:
+# ctrl = Record([
+#     ("start", 1),  # W: run the list at head, R: list running
+#     ("done",  1),  # R: list complete
+#     ("error", 1),  # R: a descriptor was NACKed
+# ])
+# head = Record([
+#     ("head", 32),  # first descriptor, byte address
+# ])
+# current = Record([
+#     ("current", 32),  # R: descriptor running, or the last one run
+# ])
+# count = Record([
+#     ("count", 32),  # R: descriptors completed
+# ])
+# head is not written while a list runs.
+DMA_CTRL_ADDR, DMA_HEAD_ADDR, DMA_CURRENT_ADDR, DMA_COUNT_ADDR = range(4)
+DMA_START = DMA_BUSY = 1 << 0
+DMA_DONE = 1 << 1
+DMA_ERROR = 1 << 2
+
+# Descriptors are DESC_WORDS words in system memory, word aligned:
+# 0  next descriptor, byte address, 0 ends the list
+# 1  [7:0] device (write address), [15:8] register, then the flags:
+#    DESC_READ: read the buffer from the device instead of writing it
+#    DESC_NO_REG: no register address after the device address
+#    DESC_CONTINUE: run the rest of the list even if this one is NACKed
+# 2  buffer, byte address, word aligned. The octets are packed four per
+#    word, first octet in the MSBs: the byte order of the big-endian CPUs
+#    of the SoC, so that the buffer is an array of octets.
+# 3  length of the buffer in octets, at most 0xffff
+# 4  status, written back: octets of the buffer transferred and ACKed in
+#    [15:0], then DESC_DONE, and DESC_NACK if the device NACKed
+DESC_WORDS = 5
+DESC_READ = 1 << 16
+DESC_NO_REG = 1 << 17
+DESC_CONTINUE = 1 << 18
+DESC_DONE = 1 << 16
+DESC_NACK = 1 << 17
+
+
+# Runs a linked list of I2C transactions described in system memory, one
+# frame per descriptor: START, device, register, then the buffer written,
+# or a repeated START and the buffer read, and STOP. The list stops at the
+# first NACK unless the descriptor has DESC_CONTINUE. The status of every
+# descriptor is written back, busy falls when the list is complete.
+#
+# dma is the master into system memory. Like I2CCapture, the engine sits
+# between the I2CMaster and its user: bus is passed through to target
+# (master.bus by default). While a list runs, grant is set and accesses on
+# bus are refused without stalling it: reads return I2C_FULL without
+# I2C_IDLE and writes set I2C_REFUSED (see I2CEngineMux). A list waits for
+# the frames already queued to be sent, and while hold is set, so that two
+# engines chained on one I2CMaster never own it together. The I2CMaster
+# error flag is cleared after a NACK unless it was already set.
+class I2CDMA(Module):
+    def __init__(self, master, target=None):
+        if target is None:
+            target = master.bus
+        self.bus = wishbone.Interface()
+        self.ctrl = ctrl = wishbone.Interface()
+        self.dma = dma = wishbone.Interface()
+        self.busy = Signal()
+        self.done = Signal()
+        self.error = Signal()
+        self.hold = Signal()
+        self.grant = grant = Signal()
+
+        ###
+
+        # Arbitration
+        mux = I2CEngineMux(self.bus, target)
+        self.submodules += mux
+        port = mux.port
+        self.comb += mux.grant.eq(grant)
+
+        # Control
+        head = Signal(32)
+        current = Signal(32)
+        count = Signal(32)
+        start = Signal()
+        self.comb += [
+            Case(ctrl.adr, {
+                DMA_CTRL_ADDR:
+                    ctrl.dat_r.eq(Cat(self.busy, self.done, self.error)),
+                DMA_HEAD_ADDR:    ctrl.dat_r.eq(head),
+                DMA_CURRENT_ADDR: ctrl.dat_r.eq(current),
+                DMA_COUNT_ADDR:   ctrl.dat_r.eq(count),
+                "default":        ctrl.dat_r.eq(0),
+            }),
+            start.eq(ctrl.ack & ctrl.we & (ctrl.adr == DMA_CTRL_ADDR) &
+                     ctrl.dat_w[0]),
+        ]
+        self.sync += [
+            ctrl.ack.eq(0),
+            If(ctrl.cyc & ctrl.stb & ~ctrl.ack,
+                ctrl.ack.eq(1),
+            ),
+            If(ctrl.ack & ctrl.we & (ctrl.adr == DMA_HEAD_ADDR) & ~self.busy,
+                head.eq(ctrl.dat_w),
+            ),
+        ]
+
+        # Descriptor
+        next_desc = Signal(32)
+        dev = Signal(8)
+        reg = Signal(8)
+        read = Signal()
+        no_reg = Signal()
+        cont = Signal()
+        buf = Signal(32)
+        length = Signal(16)
+        field = Signal(2)
+
+        # n: octets of the buffer queued, level: octets read
+        n = Signal(16)
+        level = Signal(16)
+        last = Signal()
+        data = Signal(32)
+        self.comb += last.eq(n == length - 1)
+
+        # Octets written and ACKed, address and register included, and
+        # whether one was NACKed
+        acked = Signal(16)
+        nacked = Signal()
+        header = Signal(2)
+        transferred = Signal(16)
+        self.comb += [
+            header.eq(Mux(no_reg, 1, 2)),
+            If(read,
+                transferred.eq(level),
+            ).Elif(acked > header,
+                transferred.eq(acked - header),
+            ),
+        ]
+        self.sync += [
+            If(grant & master.i2c.written,
+                If(master.i2c.nack,
+                    nacked.eq(1),
+                ).Else(
+                    acked.eq(acked + 1),
+                ),
+            ),
+        ]
+
+        # Octets read are packed into rword, written to the buffer as soon as
+        # it is complete or the last one, long before the next octet
+        rword = Signal(32)
+        rsel = Signal(4)
+        rindex = Signal(14)
+        pending = Signal()
+        store = Signal()
+        self.comb += store.eq(grant & read & master.framer.rdata_stb)
+        self.sync += [
+            If(store,
+                Case(level[:2], {
+                    i: [
+                        rword[8*(3 - i):8*(4 - i)].eq(master.framer.rdata),
+                        rsel[3 - i].eq(1),
+                    ] for i in range(4)
+                }),
+                rindex.eq(level[2:]),
+                level.eq(level + 1),
+                If((level[:2] == 3) | (level == length - 1),
+                    pending.eq(1),
+                ),
+            ),
+        ]
+        write_back = [
+            If(pending,
+                dma.cyc.eq(1),
+                dma.stb.eq(1),
+                dma.we.eq(1),
+                dma.adr.eq(buf[2:] + rindex),
+                dma.dat_w.eq(rword),
+                dma.sel.eq(rsel),
+                If(dma.ack,
+                    NextValue(pending, 0),
+                    NextValue(rsel, 0),
+                ),
+            ),
+        ]
+
+        self.comb += [
+            port.adr.eq(I2C_FIFO_ADDR),
+            port.sel.eq(2**len(port.sel) - 1),
+            port.we.eq(1),
+        ]
+
+        error_set = Signal()
+
+        fsm = FSM("IDLE")
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            If(start,
+                NextValue(self.done, 0),
+                NextValue(self.error, 0),
+                NextValue(count, 0),
+                NextValue(current, head),
+                If(head == 0,
+                    NextValue(self.done, 1),
+                ).Else(
+                    NextState("ACQUIRE"),
+                )
+            )
+        )
+        fsm.act("ACQUIRE",
+            If(~self.bus.cyc & master.idle & ~self.hold,
+                NextValue(grant, 1),
+                NextValue(error_set, master.framer.error),
+                NextValue(field, 0),
+                NextState("FETCH"),
+            )
+        )
+        fsm.act("FETCH",
+            dma.cyc.eq(1),
+            dma.stb.eq(1),
+            dma.adr.eq(current[2:] + field),
+            dma.sel.eq(0xf),
+            If(dma.ack,
+                Case(field, {
+                    0: NextValue(next_desc, dma.dat_r),
+                    1: [
+                        NextValue(dev, dma.dat_r[0:8]),
+                        NextValue(reg, dma.dat_r[8:16]),
+                        NextValue(read, dma.dat_r[16]),
+                        NextValue(no_reg, dma.dat_r[17]),
+                        NextValue(cont, dma.dat_r[18]),
+                    ],
+                    2: NextValue(buf, dma.dat_r),
+                    3: NextValue(length, dma.dat_r),
+                }),
+                NextValue(field, field + 1),
+                If(field == 3,
+                    NextValue(n, 0),
+                    NextValue(level, 0),
+                    NextValue(acked, 0),
+                    NextValue(nacked, 0),
+                    NextState("DEV"),
+                )
+            )
+        )
+        # A frame without a buffer ends after its last address
+        fsm.act("DEV",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(dev | (read & no_reg) | I2C_START |
+                          Mux(no_reg & (length == 0), I2C_STOP, 0)),
+            If(port.ack,
+                If(~no_reg,
+                    NextState("REG"),
+                ).Elif(length == 0,
+                    NextState("WAIT"),
+                ).Elif(read,
+                    NextState("READ"),
+                ).Else(
+                    NextState("LOAD"),
+                )
+            )
+        )
+        fsm.act("REG",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(reg | Mux(~read & (length == 0), I2C_STOP, 0)),
+            If(port.ack,
+                If(read,
+                    NextState("READ_DEV"),
+                ).Elif(length == 0,
+                    NextState("WAIT"),
+                ).Else(
+                    NextState("LOAD"),
+                )
+            )
+        )
+        fsm.act("READ_DEV",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(dev | 1 | I2C_START |
+                          Mux(length == 0, I2C_STOP, 0)),
+            If(port.ack,
+                If(length == 0,
+                    NextState("WAIT"),
+                ).Else(
+                    NextState("READ"),
+                )
+            )
+        )
+        fsm.act("LOAD",
+            dma.cyc.eq(1),
+            dma.stb.eq(1),
+            dma.adr.eq(buf[2:] + n[2:]),
+            dma.sel.eq(0xf),
+            If(dma.ack,
+                NextValue(data, dma.dat_r),
+                NextState("WRITE"),
+            )
+        )
+        fsm.act("WRITE",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(
+                Array(data[8*(3 - i):8*(4 - i)] for i in range(4))[n[:2]] |
+                Mux(last, I2C_STOP, 0)),
+            If(port.ack,
+                NextValue(n, n + 1),
+                If(last,
+                    NextState("WAIT"),
+                ).Elif(n[:2] == 3,
+                    NextState("LOAD"),
+                )
+            )
+        )
+        # the last read is NACKed by the framer
+        fsm.act("READ",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(I2C_READ | Mux(last, I2C_STOP, 0)),
+            If(port.ack,
+                NextValue(n, n + 1),
+                If(last,
+                    NextState("WAIT"),
+                )
+            ),
+            *write_back
+        )
+        fsm.act("WAIT",
+            If(master.idle & ~pending,
+                If(master.framer.error & ~error_set,
+                    NextState("CLEAR"),
+                ).Else(
+                    NextState("STATUS"),
+                )
+            ),
+            *write_back
+        )
+        fsm.act("CLEAR",
+            port.cyc.eq(1),
+            port.stb.eq(1),
+            port.dat_w.eq(I2C_ERROR),
+            If(port.ack,
+                NextState("STATUS"),
+            )
+        )
+        fsm.act("STATUS",
+            dma.cyc.eq(1),
+            dma.stb.eq(1),
+            dma.we.eq(1),
+            dma.adr.eq(current[2:] + DESC_WORDS - 1),
+            dma.dat_w.eq(Cat(transferred, C(1, 1), nacked)),
+            dma.sel.eq(0xf),
+            If(dma.ack,
+                NextValue(count, count + 1),
+                If(nacked,
+                    NextValue(self.error, 1),
+                ),
+                If((nacked & ~cont) | (next_desc == 0),
+                    NextValue(grant, 0),
+                    NextValue(self.done, 1),
+                    NextState("IDLE"),
+                ).Else(
+                    NextValue(current, next_desc),
+                    NextValue(field, 0),
+                    NextState("FETCH"),
+                )
+            )
+        )
+        self.comb += self.busy.eq(~fsm.ongoing("IDLE"))
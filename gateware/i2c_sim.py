@@ -0,0 +1,268 @@
+# Simulated I2C devices for migen simulations of I2CMaster. The bus is
+# open-drain: simulate within open_drain(), which lowers Tristate with
+# OpenDrainTristate, so that the pads stand for the other devices on the
+# bus. Test cases use OpenDrainMixin. I2CSequencerSystem and with_divider()
+# are the system under test shared by the tests and the benchmarks.
+
+from contextlib import contextmanager
+
+from migen import *
+from migen.fhdl.specials import Tristate
+
+from i2c import I2CMaster, I2C_CONFIG_ADDR, I2C_HOLD_ADDR
+from sequencer import Sequencer, InstWrite
+
+
+__all__ = ["OpenDrainTristate", "open_drain", "OpenDrainMixin", "I2CPads",
+           "I2CSwitch", "I2CRegisterDevice", "i2c_devices", "ack_address",
+           "i2c_ack_slave", "I2CSequencerSystem", "with_divider"]
+
+
+class OpenDrainTristate(Module):
+    # Driving the pad low pulls the line down, the master can only pull it
+    # down too.
+    def __init__(self, t):
+        self.comb += t.i.eq(~t.oe & t.target)
+
+
+# Lowers Tristate with OpenDrainTristate within the block
+@contextmanager
+def open_drain():
+    lower = Tristate.lower
+    Tristate.lower = OpenDrainTristate
+    try:
+        yield
+    finally:
+        Tristate.lower = lower
+
+
+# unittest.TestCase mixin running every test within open_drain()
+class OpenDrainMixin:
+    def setUp(self):
+        super().setUp()
+        context = open_drain()
+        context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+
+
+class I2CPads:
+    def __init__(self):
+        self.scl = Signal(reset=1)
+        self.sda = Signal(reset=1)
+
+
+# Device protocol: start() at a (repeated) START addressing the device,
+# write(octet) for every following octet, returning True to ACK it, read()
+# for every octet read by the master, and stop() at the end of the frame.
+class I2CSwitch:
+    # PCA9548-like: a single control register
+    def __init__(self):
+        self.control = 0
+
+    def start(self):
+        pass
+
+    def write(self, octet):
+        self.control = octet
+        return True
+
+    def read(self):
+        return self.control
+
+    def stop(self):
+        pass
+
+
+class I2CRegisterDevice:
+    # Register address, then data with auto-increment, like the Si5324.
+    # Reads start at the register address of the previous write frame.
+    def __init__(self, registers=None):
+        self.registers = {} if registers is None else dict(registers)
+        self.pointer = 0
+        self.addressed = False
+        self.writes = 0
+        self.reads = 0
+
+    def start(self):
+        self.addressed = False
+
+    def write(self, octet):
+        if not self.addressed:
+            self.pointer = octet
+            self.addressed = True
+        else:
+            self.registers[self.pointer] = octet
+            self.pointer = (self.pointer + 1) & 0xff
+            self.writes += 1
+        return True
+
+    def read(self):
+        octet = self.registers.get(self.pointer, 0)
+        self.pointer = (self.pointer + 1) & 0xff
+        self.reads += 1
+        return octet
+
+    def stop(self):
+        pass
+
+
+# devices maps 7-bit addresses to devices, frames collects all octets
+# written on the bus per frame
+@passive
+def i2c_devices(master, pads, devices, frames=None):
+    if frames is None:
+        frames = []
+    scl_p, sda_p = 1, 1
+    bits = None
+    octets = []
+    device = None
+    in_ack = False
+    # while reading, bits counts the bits sent, 9 during the master ACK
+    reading = False
+    out = 0
+    acked = False
+
+    def end_frame():
+        if octets:
+            frames.append(octets)
+        if device is not None:
+            device.stop()
+
+    while True:
+        scl = yield master.scl_t.i
+        sda = yield master.sda_t.i
+        if scl and scl_p and sda_p and not sda:
+            # START
+            end_frame()
+            bits, octet, octets, device = 0, 0, [], None
+            reading = False
+        elif scl and scl_p and not sda_p and sda:
+            # STOP
+            end_frame()
+            bits, octets, device = None, [], None
+            reading = False
+        elif bits is not None and scl and not scl_p and not in_ack:
+            if not reading:
+                octet = (octet << 1) | sda
+                bits += 1
+            elif bits == 9:
+                acked = not sda
+            else:
+                bits += 1
+        elif bits is not None and not scl and scl_p:
+            if in_ack:
+                in_ack = False
+                if reading:
+                    out = device.read()
+                    yield pads.sda.eq(out >> 7)
+                else:
+                    yield pads.sda.eq(1)
+            elif reading:
+                if bits == 8:
+                    yield pads.sda.eq(1)
+                    bits = 9
+                elif bits == 9:
+                    if acked:
+                        out = device.read()
+                        yield pads.sda.eq(out >> 7)
+                        bits = 0
+                    else:
+                        reading = False
+                        bits = None
+                else:
+                    yield pads.sda.eq((out >> (7 - bits)) & 1)
+            elif bits == 8:
+                octets.append(octet)
+                if len(octets) == 1:
+                    device = devices.get(octet >> 1)
+                    if device is not None:
+                        device.start()
+                        reading = bool(octet & 1)
+                    ack = device is not None
+                else:
+                    ack = device is not None and device.write(octet)
+                if ack:
+                    yield pads.sda.eq(0)
+                in_ack = True
+                bits, octet = 0, 0
+        scl_p, sda_p = scl, sda
+        yield
+
+
+# ack policy of i2c_ack_slave() and I2CMasterModel: ACK every octet of the
+# frames addressed to address
+def ack_address(address):
+    return lambda octets: octets[0] >> 1 == address
+
+
+# A bus of write-only devices described by an ack policy, like
+# I2CMasterModel: ack(octets) decides whether the last octet of the frame
+# so far is ACKed. frames collects all octets written per frame.
+@passive
+def i2c_ack_slave(master, pads, ack, frames=None):
+    if frames is None:
+        frames = []
+    scl_p, sda_p = 1, 1
+    bits = None
+    octets = []
+    in_ack = False
+    while True:
+        scl = yield master.scl_t.i
+        sda = yield master.sda_t.i
+        if scl and scl_p and sda_p and not sda:
+            if octets:
+                frames.append(octets)
+            bits, octet, octets = 0, 0, []
+        elif scl and scl_p and not sda_p and sda:
+            if octets:
+                frames.append(octets)
+            bits, octets = None, []
+        elif bits is not None and scl and not scl_p and not in_ack:
+            octet = (octet << 1) | sda
+            bits += 1
+        elif bits is not None and not scl and scl_p:
+            if in_ack:
+                yield pads.sda.eq(1)
+                in_ack = False
+            elif bits == 8:
+                octets.append(octet)
+                if ack(octets):
+                    yield pads.sda.eq(0)
+                in_ack = True
+                bits, octet = 0, 0
+        scl_p, sda_p = scl, sda
+        yield
+
+
+# An I2CMaster driven by a Sequencer running program, with the idle flag of
+# the master as event 0, and a PCA9548 and a Si5324 (with registers) on the
+# bus. kwargs are passed to the Sequencer.
+class I2CSequencerSystem(Module):
+    def __init__(self, program, fifo_depth=16, pipelined=False,
+                 registers=None, **kwargs):
+        self.pads = I2CPads()
+        self.submodules.i2c_master = I2CMaster(self.pads,
+                                               fifo_depth=fifo_depth,
+                                               pipelined=pipelined)
+        self.submodules.sequencer = Sequencer(program, self.i2c_master.bus,
+                                              **kwargs)
+        self.comb += self.sequencer.events[0].eq(self.i2c_master.idle)
+        self.switch = I2CSwitch()
+        self.si5324 = I2CRegisterDevice(registers)
+
+    def devices(self, frames=None):
+        return i2c_devices(self.i2c_master, self.pads, {
+            0x74: self.switch,
+            0x68: self.si5324,
+        }, frames)
+
+
+# Sets the I2C divider and hold time of the InstWrites of program to the
+# configuration registers. The SDA hold time must stay within the shortened
+# half period.
+def with_divider(program, divider, hold=1):
+    values = {I2C_CONFIG_ADDR: divider, I2C_HOLD_ADDR: hold}
+    return [InstWrite(inst.address, values[inst.address])
+            if isinstance(inst, InstWrite) and inst.address in values
+            else inst
+            for inst in program]
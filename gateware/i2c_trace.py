@@ -0,0 +1,116 @@
+# Protocol-level trace of I2CMaster simulations. i2c_monitor() decodes SCL
+# and SDA into START, address and data octets with their ACK, and STOP, and
+# records the wishbone accesses to the master, all stamped with the cycle
+# number. The records are a fraction of the size of a VCD of the design,
+# and tests can compare them directly. vcd_window() dumps a few signals
+# over a window of cycles when the waveforms are needed.
+
+from collections import namedtuple
+
+from migen import *
+from migen.fhdl.namer import build_namespace
+from migen.sim.vcd import vcd_codes
+
+
+__all__ = ["I2CEvent", "format_event", "i2c_monitor", "vcd_window"]
+
+
+# kind is "start", "restart", "addr", "data" or "stop" on the bus, value
+# the octet and ack whether it was acknowledged. Wishbone accesses are
+# "read" and "write", with value the (address, data) pair.
+I2CEvent = namedtuple("I2CEvent", "cycle kind value ack")
+
+
+def format_event(event):
+    fields = []
+    if event.kind in ("addr", "data"):
+        fields = ["0x{:02x}".format(event.value),
+                  "ACK" if event.ack else "NACK"]
+    elif event.kind in ("read", "write"):
+        fields = ["0x{:03x}".format(event.value[0]),
+                  "0x{:08x}".format(event.value[1])]
+    return " ".join(["{:>10}".format(event.cycle),
+                     "{:<7}".format(event.kind.upper())] + fields).rstrip()
+
+
+# Appends the events to events, and writes them to the file log if given.
+# The monitor samples the lines as the master sees them.
+@passive
+def i2c_monitor(master, events=None, log=None, wishbone=True):
+    if events is None:
+        events = []
+    bus = master.bus
+    cycle = 0
+    scl_p, sda_p = 1, 1
+    # bits counts the bits of the octet, then the ACK
+    bits = None
+    octet = 0
+    first = False
+    in_frame = False
+
+    def emit(kind, value=None, ack=None):
+        event = I2CEvent(cycle, kind, value, ack)
+        events.append(event)
+        if log is not None:
+            log.write(format_event(event) + "\n")
+
+    while True:
+        if (wishbone and (yield bus.cyc) and (yield bus.stb) and
+                (yield bus.ack)):
+            adr = yield bus.adr
+            if (yield bus.we):
+                emit("write", (adr, (yield bus.dat_w)))
+            else:
+                emit("read", (adr, (yield bus.dat_r)))
+
+        scl = yield master.scl_t.i
+        sda = yield master.sda_t.i
+        if scl and scl_p and sda_p and not sda:
+            emit("restart" if in_frame else "start")
+            in_frame = True
+            bits, octet, first = 0, 0, True
+        elif scl and scl_p and not sda_p and sda:
+            emit("stop")
+            in_frame = False
+            bits = None
+        elif bits is not None and scl and not scl_p:
+            if bits == 8:
+                emit("addr" if first else "data", octet, not sda)
+                bits, octet, first = 0, 0, False
+            else:
+                octet = (octet << 1) | sda
+                bits += 1
+        scl_p, sda_p = scl, sda
+        cycle += 1
+        yield
+
+
+# Writes the values of signals during the cycles [first, last) to the VCD
+# file filename, with the time scale of migen's VCDs.
+@passive
+def vcd_window(signals, filename, first, last, period=10):
+    signals = list(signals)
+    ns = build_namespace(signals)
+    codes = dict(zip(signals, vcd_codes()))
+    values = {}
+    for i in range(first):
+        yield
+    with open(filename, "w") as f:
+        for signal in signals:
+            f.write("$var wire {} {} {} $end\n".format(
+                len(signal), codes[signal], ns.get_name(signal)))
+        f.write("$enddefinitions $end\n")
+        for cycle in range(first, last):
+            f.write("#{}\n".format(cycle*period))
+            for signal in signals:
+                value = yield signal
+                if values.get(signal) == value:
+                    continue
+                values[signal] = value
+                if value < 0:
+                    value += 2**len(signal)
+                if len(signal) > 1:
+                    f.write("b{:b} {}\n".format(value, codes[signal]))
+                else:
+                    f.write("{}{}\n".format(value, codes[signal]))
+            yield
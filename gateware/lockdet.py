@@ -0,0 +1,108 @@
+from migen import *
+from migen.genlib.cdc import MultiReg, GrayCounter, GrayDecoder
+from misoc.interconnect import wishbone
+
+
+__all__ = ["LockDetector",
+           "LOCK_STATUS_ADDR", "LOCK_COUNT_ADDR", "LOCK_CYCLES_ADDR",
+           "LOCK_LOCKED", "LOCK_LOL"]
+
+
+# Registers:
+# status = Record([
+#     ("locked", 1),  # R: the last gate counted the expected frequency
+#     ("lol",    1),  # R: lock was lost since the last clear, W: clear
+# ])
+# count = Record([
+#     ("count", 32),  # R: measured clock cycles in the last gate
+# ])
+# lock_cycles = Record([
+#     ("cycles", 32), # R: system clock cycles from reset to the first lock
+# ])
+LOCK_STATUS_ADDR, LOCK_COUNT_ADDR, LOCK_CYCLES_ADDR = range(3)
+LOCK_LOCKED = 1 << 0
+LOCK_LOL = 1 << 1
+
+
+# Counts the cycles of the clock domain cd during gates of 2**gate_width
+# system clock cycles. The clock is locked while the count is within
+# tolerance of the one expected at freq.
+class LockDetector(Module):
+    def __init__(self, clk_freq, freq, cd="clean", gate_width=16,
+                 tolerance=2, bus=None):
+        if bus is None:
+            bus = wishbone.Interface()
+        self.bus = bus
+        self.locked = Signal()
+        self.lol = Signal()
+        self.count = Signal(32)
+        self.lock_cycles = Signal(32)
+
+        ###
+
+        expected = round(freq/clk_freq*2**gate_width)
+        # wide enough not to wrap during a gate
+        width = bits_for(expected + tolerance) + 1
+
+        counter = ClockDomainsRenamer(cd)(GrayCounter(width))
+        self.submodules += counter
+        self.comb += counter.ce.eq(1)
+
+        gray = Signal(width)
+        self.specials += MultiReg(counter.q, gray)
+        self.submodules.decoder = decoder = GrayDecoder(width)
+        self.comb += decoder.i.eq(gray)
+
+        gate = Signal(gate_width)
+        last = Signal(width)
+        delta = Signal(width)
+        valid = Signal()
+        self.comb += delta.eq(decoder.o - last)
+        self.sync += [
+            gate.eq(gate + 1),
+            If(gate == 0,
+                last.eq(decoder.o),
+                valid.eq(1),
+                If(valid,
+                    self.count.eq(delta),
+                    self.locked.eq((delta >= expected - tolerance) &
+                                   (delta <= expected + tolerance)),
+                )
+            ),
+        ]
+
+        lock_cnt = Signal(32)
+        locked_once = Signal()
+        self.sync += [
+            If(~locked_once,
+                lock_cnt.eq(lock_cnt + 1),
+            ),
+            If(self.locked,
+                locked_once.eq(1),
+                If(~locked_once,
+                    self.lock_cycles.eq(lock_cnt),
+                ),
+            ),
+        ]
+
+        # Wishbone
+        locked_p = Signal()
+        self.sync += [
+            locked_p.eq(self.locked),
+            bus.ack.eq(0),
+            If(bus.cyc & bus.stb & ~bus.ack,
+                bus.ack.eq(1),
+            ),
+            If(bus.ack & bus.we & (bus.adr == LOCK_STATUS_ADDR) &
+                    bus.dat_w[1],
+                self.lol.eq(0),
+            ).Elif(locked_p & ~self.locked,
+                self.lol.eq(1),
+            ),
+            Case(bus.adr, {
+                LOCK_STATUS_ADDR: bus.dat_r.eq(Cat(self.locked, self.lol)),
+                LOCK_COUNT_ADDR:  bus.dat_r.eq(self.count),
+                LOCK_CYCLES_ADDR: bus.dat_r.eq(self.lock_cycles),
+                "default":        bus.dat_r.eq(0),
+            }),
+        ]
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3.5
+
+# Patches a new Sequencer program into a built bitstream with Vivado's
+# updatemem, without synthesis or place and route. The program memory is
+# constrained to a single, known RAMB36 so that its content can be located
+# in the bitstream. The memory map (.mmi) describes that block RAM, the
+# data file (.mem) carries the new program.
+
+import os, argparse, shutil, subprocess
+
+from sequencer import encode_program, unpack_program
+from si5324 import bringup_program
+
+
+__all__ = ["PROGRAM_NAME", "PROGRAM_DEPTH", "PROGRAM_PLACEMENT",
+           "program_constraints", "mem_data", "init_data", "mmi_data",
+           "updatemem_command", "patch"]
+
+
+PROGRAM_NAME = "sequencer_program"
+# 1Kx32 fits one RAMB36 in 1Kx36 mode
+PROGRAM_DEPTH = 1024
+PROGRAM_PLACEMENT = "X0Y0"
+PROGRAM_PROC = "sequencer"
+
+KC705_PART = "xc7k325tffg900-2"
+
+
+def program_constraints(name=PROGRAM_NAME, placement=PROGRAM_PLACEMENT):
+    cells = "[get_cells {}_reg]".format(name)
+    return "\n".join([
+        "set_property RAM_STYLE BLOCK " + cells,
+        "set_property LOC RAMB36_{} ".format(placement) + cells,
+    ])
+
+
+def _words(program, depth):
+    if isinstance(program, bytes):
+        words = unpack_program(program)
+    else:
+        words = encode_program(program)
+    if len(words) > depth:
+        raise ValueError("program of {} words does not fit {} words"
+                         .format(len(words), depth))
+    return words + [0]*(depth - len(words))
+
+
+def mem_data(program, depth=PROGRAM_DEPTH):
+    # One 32 bit word per line from byte address 0
+    lines = ["@00000000"]
+    lines += ["{:08X}".format(w) for w in _words(program, depth)]
+    return "\n".join(lines) + "\n"
+
+
+def init_data(program, depth=PROGRAM_DEPTH):
+    # Same format as the $readmemh file written by migen, so that the
+    # sources stay in sync with the patched bitstream
+    return "".join("{:08X}\n".format(w) for w in _words(program, depth))
+
+
+def mmi_data(part=KC705_PART, placement=PROGRAM_PLACEMENT,
+             depth=PROGRAM_DEPTH, proc=PROGRAM_PROC):
+    return """\
+<?xml version="1.0" encoding="UTF-8"?>
+<MemInfo Version="1" Minor="0">
+  <Processor Endianness="Little" InstPath="{proc}">
+    <AddressSpace Name="{proc}_program" Begin="0" End="{end}">
+      <BusBlock>
+        <BitLane MemType="RAMB36" Placement="{placement}">
+          <DataWidth MSB="31" LSB="0"/>
+          <AddressRange Begin="0" End="{last}"/>
+          <Parity ON="false" NumBits="0"/>
+        </BitLane>
+      </BusBlock>
+    </AddressSpace>
+  </Processor>
+  <Config>
+    <Option Name="Part" Val="{part}"/>
+  </Config>
+</MemInfo>
+""".format(proc=proc, end=4*depth - 1, placement=placement,
+           last=depth - 1, part=part)
+
+
+def updatemem_command(build_dir, bit="top.bit", out="top_patched.bit",
+                      proc=PROGRAM_PROC):
+    return ["updatemem", "-force",
+            "-meminfo", os.path.join(build_dir, proc + ".mmi"),
+            "-data", os.path.join(build_dir, proc + ".mem"),
+            "-proc", proc,
+            "-bit", os.path.join(build_dir, bit),
+            "-out", os.path.join(build_dir, out)]
+
+
+def patch(build_dir, program, part=KC705_PART, run=True):
+    with open(os.path.join(build_dir, PROGRAM_PROC + ".mmi"), "w") as f:
+        f.write(mmi_data(part))
+    with open(os.path.join(build_dir, PROGRAM_PROC + ".mem"), "w") as f:
+        f.write(mem_data(program))
+    with open(os.path.join(build_dir, PROGRAM_NAME + ".init"), "w") as f:
+        f.write(init_data(program))
+
+    command = updatemem_command(build_dir)
+    if run and shutil.which(command[0]):
+        subprocess.check_call(command)
+        return None
+    return command
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Patch a Sequencer program into a built bitstream")
+    parser.add_argument("build_dir", nargs="?", default="/tmp/si5324_test")
+    parser.add_argument("--clk-freq", type=float, default=62.5e6,
+                        help="system clock frequency (default: %(default)s)")
+    parser.add_argument("--fout", type=float, default=None,
+                        help="Si5324 output frequency (default: clk-freq)")
+    parser.add_argument("--program", default=None,
+                        help="packed program to load instead")
+    parser.add_argument("--no-run", action="store_true",
+                        help="only write the .mmi/.mem files")
+    args = parser.parse_args()
+
+    if args.program is None:
+        program = bringup_program(args.clk_freq, args.fout)
+    else:
+        with open(args.program, "rb") as f:
+            program = f.read()
+    command = patch(args.build_dir, program, run=not args.no_run)
+    if command is not None:
+        print(" ".join(command))
+
+
+if __name__ == "__main__":
+    main()
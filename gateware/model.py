@@ -0,0 +1,778 @@
+# Transaction-level model of Sequencer driving I2CMaster, with
+# events[0] = I2CMaster.idle. The state of both cores is kept in plain
+# integers and stepped with the same cycle timing as the gateware, but
+# cycles in which only the I2C clock divider and the timers count are
+# skipped in one go. Cycle counts, bus transactions and I2C frames match
+# the migen simulation (see test_model.py).
+
+from sequencer import encode_program
+from i2c import (I2C_ACK, I2C_READ, I2C_START, I2C_STOP, I2C_IDLE,
+                 I2C_ERROR, I2C_OCTETS_ADDR, I2C_NACKS_ADDR,
+                 I2C_BUSY_CYCLES_ADDR, I2C_POLLS_ADDR)
+
+
+__all__ = ["I2CMasterModel", "SequencerModel", "SystemModel"]
+
+
+class I2CMasterModel:
+    # ack(frame) -> bool decides whether the last octet of the current
+    # frame is ACKed, read() -> octet gives the octets read by the master.
+    # The SDA input otherwise reads 0, slaves do not stretch the clock.
+    def __init__(self, fifo_depth=16, ack=None, clock_stretching=True,
+                 read=None):
+        self.fifo_depth = fifo_depth
+        self.ack_policy = ack
+        self.read_policy = read
+        self.clock_stretching = clock_stretching
+
+        # wishbone
+        self.ack = 0
+        self.dat_r = 0
+
+        # I2CMasterMachine
+        self.state = "IDLE"
+        self.c_start = self.c_stop = self.c_write = self.c_read = 0
+        self.data = 0
+        self.i2c_ack = 0
+        self.bits = 0
+        self.octet_in = 0
+        self.load = 0
+        self.hold = 0
+        self.cnt = 0
+        self.scl_o = 1
+        # SCL input synchronizer
+        self.scl_i = [1, 1]
+
+        # I2CFramer
+        self.fifo = []
+        self.f_state = "FETCH"
+        self.f_data = 0
+        self.f_stop = 0
+        self.rdata = 0
+        self.in_frame = 0
+        self.discard = 0
+        self.error = 0
+
+        # Performance counters
+        self.octets = 0
+        self.nacks = 0
+        self.busy_cycles = 0
+        self.polls = 0
+
+        self.frame = []
+        self.frames = []
+
+    def running(self):
+        return self.c_start | self.c_stop | self.c_write | self.c_read
+
+    def i2c_idle(self):
+        return not self.running() and self.state == "IDLE"
+
+    def idle(self):
+        return (self.f_state == "FETCH" and not self.fifo and
+                self.i2c_idle())
+
+    def read_value(self, adr):
+        if adr == 0:
+            return self.data | (self.i2c_ack << 8) | (self.i2c_idle() << 13)
+        elif adr == 1:
+            return self.load
+        elif adr == 3:
+            return self.hold
+        elif adr == 2:
+            return (self.rdata | (self.error << 8) | (self.idle() << 13) |
+                    ((len(self.fifo) == self.fifo_depth) << 14) |
+                    (len(self.fifo) << 16))
+        elif adr == I2C_OCTETS_ADDR:
+            return self.octets
+        elif adr == I2C_NACKS_ADDR:
+            return self.nacks
+        elif adr == I2C_BUSY_CYCLES_ADDR:
+            return self.busy_cycles
+        elif adr == I2C_POLLS_ADDR:
+            return self.polls
+        else:
+            return None
+
+    def step(self, cyc, we, adr, dat_w):
+        run = self.running()
+        i2c_idle = not run and self.state == "IDLE"
+        writable = len(self.fifo) < self.fifo_depth
+        readable = bool(self.fifo)
+
+        # Framer
+        f_start = f_stop = f_write = f_read = f_ack = 0
+        f_data = 0
+        re = 0
+        f_state = self.f_state
+        nack = 0
+        if self.f_state == "FETCH":
+            re = 1
+            if readable:
+                data, start, stop, read = self.fifo[0]
+                self.f_data, self.f_stop = data, stop
+                if start:
+                    f_start, f_stop = 1, self.in_frame
+                    self.in_frame = 1
+                    f_state = "START"
+                elif read:
+                    f_read, f_ack = 1, int(not stop)
+                    f_state = "READ"
+                else:
+                    f_write, f_data = 1, data
+                    f_state = "WRITE"
+        elif self.f_state == "START":
+            if i2c_idle:
+                f_write, f_data = 1, self.f_data
+                f_state = "WRITE"
+        elif self.f_state == "WRITE":
+            if i2c_idle:
+                if not self.i2c_ack:
+                    nack = 1
+                    self.discard = int(not self.f_stop)
+                    f_stop = 1
+                    f_state = "STOP"
+                elif self.f_stop:
+                    f_stop = 1
+                    f_state = "STOP"
+                else:
+                    f_state = "FETCH"
+        elif self.f_state == "READ":
+            if i2c_idle:
+                self.rdata = self.data
+                if self.f_stop:
+                    f_stop = 1
+                    f_state = "STOP"
+                else:
+                    f_state = "FETCH"
+        elif self.f_state == "STOP":
+            self.in_frame = 0
+            if i2c_idle:
+                f_state = "DISCARD" if self.discard else "FETCH"
+        elif self.f_state == "DISCARD":
+            self.discard = 0
+            re = 1
+            if readable and self.fifo[0][2]:
+                f_state = "FETCH"
+
+        # Wishbone
+        value = self.read_value(adr)
+        if value is not None:
+            self.dat_r = value
+        access = self.ack and we
+        fifo_write = access and adr == 2
+        if fifo_write and dat_w & I2C_ACK:
+            self.error = 0
+        if nack:
+            self.error = 1
+        if access and adr == I2C_OCTETS_ADDR:
+            self.octets = 0
+        if access and adr == I2C_NACKS_ADDR:
+            self.nacks = 0
+        if access and adr == I2C_BUSY_CYCLES_ADDR:
+            self.busy_cycles = 0
+        elif not i2c_idle:
+            self.busy_cycles += 1
+        if access and adr == I2C_POLLS_ADDR:
+            self.polls = 0
+        elif self.ack and not we and adr in (0, 2):
+            self.polls += 1
+        self.ack = int(bool(cyc and not self.ack and
+                            not (we and adr == 2 and not writable)))
+        if re and readable:
+            del self.fifo[0]
+        if fifo_write and not dat_w & I2C_ACK and writable:
+            self.fifo.append((dat_w & 0xff, (dat_w >> 11) & 1,
+                              (dat_w >> 12) & 1, (dat_w >> 9) & 1))
+        self.f_state = f_state
+
+        # Machine
+        c_start, c_stop, c_write = self.c_start, self.c_stop, self.c_write
+        c_read = self.c_read
+        data = self.data
+        if access and adr == 0:
+            self.data = dat_w & 0xff
+            self.i2c_ack = (dat_w >> 8) & 1
+            self.c_read = (dat_w >> 9) & 1
+            self.c_write = (dat_w >> 10) & 1
+            self.c_start = (dat_w >> 11) & 1
+            self.c_stop = (dat_w >> 12) & 1
+        elif f_start or f_stop or f_write or f_read:
+            self.data = f_data
+            self.c_write, self.c_start, self.c_stop = f_write, f_start, f_stop
+            self.c_read = f_read
+            if f_read:
+                self.i2c_ack = f_ack
+        else:
+            self.c_read = self.c_write = self.c_start = self.c_stop = 0
+        clk2x = self.cnt == 0
+        stretch = (self.clock_stretching and
+                   self.scl_o and not self.scl_i[1])
+        self.scl_i = [self.scl_o, self.scl_i[0]]
+        if not i2c_idle and not stretch:
+            self.cnt = self.load if clk2x else self.cnt - 1
+        if access and adr == 1:
+            self.load = dat_w & 0xfffff
+        if access and adr == 3:
+            self.hold = dat_w & 0xff
+        if run or (clk2x and not stretch):
+            self._step_machine(c_start, c_stop, c_write, c_read, data)
+
+    def _step_machine(self, start, stop, write, read, data):
+        state = self.state
+        if state == "IDLE":
+            if stop and start:
+                self._end_frame()
+                self.state = "RESTART0"
+            elif start:
+                self._end_frame()
+                self.state = "START0"
+            elif stop:
+                self._end_frame()
+                self.state = "STOP0"
+            elif write:
+                self.frame.append(data)
+                self.bits = 8
+                self.state = "WRITE0"
+            elif read:
+                if self.read_policy is not None:
+                    self.octet_in = self.read_policy()
+                self.bits = 8
+                self.state = "READ0"
+        elif state == "START0":
+            self.scl_o = 1
+            self.state = "START1"
+        elif state == "RESTART0":
+            self.scl_o = 0
+            self.state = "RESTART1"
+        elif state == "RESTART1":
+            self.state = "START0"
+        elif state == "STOP0":
+            self.scl_o = 0
+            self.state = "STOP1"
+        elif state == "STOP1":
+            self.scl_o = 1
+            self.state = "STOP2"
+        elif state in ("START1", "STOP2", "READACK1", "WRITEACK0"):
+            if state == "READACK1":
+                if self.ack_policy is None:
+                    self.i2c_ack = 1
+                else:
+                    self.i2c_ack = int(bool(self.ack_policy(self.frame)))
+                self.octets += 1
+                self.nacks += not self.i2c_ack
+            elif state == "WRITEACK0":
+                self.scl_o = 1
+            self.state = "IDLE"
+        elif state == "WRITE0":
+            self.scl_o = 0
+            self.state = "READACK0" if self.bits == 0 else "WRITE1"
+        elif state == "WRITE1":
+            self.scl_o = 1
+            self.data = (data << 1) & 0xff
+            self.bits -= 1
+            self.state = "WRITE0"
+        elif state == "READACK0":
+            self.scl_o = 1
+            self.state = "READACK1"
+        elif state == "READ0":
+            self.scl_o = 0
+            self.state = "READ1"
+        elif state == "READ1":
+            self.scl_o = 0
+            # the slave drives the MSB from the falling edge before the
+            # first bit
+            self.data = ((data & ~1) |
+                         (self.octet_in >> min(self.bits, 7)) & 1)
+            self.state = "WRITEACK0" if self.bits == 0 else "READ2"
+        elif state == "READ2":
+            self.scl_o = 1
+            self.data = (data << 1) & 0xff
+            self.bits -= 1
+            self.state = "READ1"
+
+    def _end_frame(self):
+        if self.frame:
+            self.frames.append(self.frame)
+        self.frame = []
+
+    def quiet(self):
+        # Cycles during which nothing but the clock divider counts,
+        # None if forever.
+        if self.running():
+            return 0
+        if self.clock_stretching and self.scl_i != [self.scl_o]*2:
+            return 0
+        if self.state == "IDLE":
+            n = None
+            if self.f_state in ("START", "WRITE", "READ", "STOP"):
+                return 0
+        else:
+            n = self.cnt
+        if self.fifo and self.f_state in ("FETCH", "DISCARD"):
+            return 0
+        if ((self.f_state == "STOP" and self.in_frame) or
+                (self.f_state == "DISCARD" and self.discard)):
+            return 0
+        return n
+
+    def skip(self, n):
+        if self.state != "IDLE":
+            self.cnt -= n
+            self.busy_cycles += n
+
+
+class SequencerModel:
+    def __init__(self, program, mirror=None, mirror_dev=None, n_counters=4,
+                 call_depth=4):
+        self.mem = encode_program(program)
+        self.loop_counters = [0]*n_counters
+        self.stack = [0]*call_depth
+        self.sp = 0
+        self.branch_mask = 0
+        if mirror is None:
+            self.mirror = None
+        else:
+            self.mirror = [mirror.get(reg, 0) for reg in range(256)]
+        self.mirror_dev = mirror_dev
+        self.mirror_ptr = 0
+        self.write_data = 0
+        self.write_mirror = 0
+        self.state = "FETCH"
+        self.pc = 0
+        self.i2c_address = 0
+        self.octets = 0
+        self.octets_left = 0
+        self.word_left = 0
+        self.reload = 0
+        self.poll_dev = 0
+        self.poll_reg = 0
+        self.poll_step = 0
+        self.timer = 0
+        self.timeout = 0
+
+        # Performance counters
+        self.retired = 0
+        self.wait_cycles = 0
+        self.write_cycles = 0
+        self.run_cycles = 0
+
+    def done(self):
+        return self.state == "END"
+
+    def _decode(self):
+        inst = self.mem[self.pc]
+        return inst >> 28, (inst >> 20) & 0xff, inst & 0xfffff
+
+    # Returns the bus request (cyc, we, adr, dat_w) of this cycle
+    def step(self, ack, dat_r, events):
+        opcode, address, data_mask = self._decode()
+        cyc = we = 0
+        adr = dat_w = 0
+        advance = retire = False
+        jump = None
+        if self.state != "END":
+            self.run_cycles += 1
+        if self.state == "RUN":
+            if opcode in (0b0010, 0b0100, 0b0101, 0b0110, 0b1001, 0b1110):
+                self.wait_cycles += 1
+            elif opcode in (0b0001, 0b0011, 0b0111):
+                self.write_cycles += 1
+        elif self.state in ("WAIT_EVENT", "I2C_POLL_LOAD", "I2C_POLL",
+                            "I2C_POLL_WAIT", "I2C_POLL_CLEAR", "I2C_READ",
+                            "I2C_READ_NEXT", "I2C_READ_WAIT",
+                            "I2C_READ_ABORT", "BRANCH", "DELAY"):
+            self.wait_cycles += 1
+        elif self.state in ("I2C_WRITE", "I2C_UPDATE", "I2C_UPDATE_WRITE"):
+            self.write_cycles += 1
+        if self.state == "FETCH":
+            self.state = "RUN"
+        elif self.state == "RUN":
+            adr, dat_w = address, data_mask
+            if opcode == 0b0000:
+                retire = True
+                self.state = "END"
+            elif opcode == 0b0001:
+                cyc = we = 1
+                advance = retire = ack
+            elif opcode == 0b0010:
+                cyc = 1
+                advance = retire = ack and dat_r & data_mask == data_mask
+            elif opcode == 0b0011:
+                cyc = we = 1
+                dat_w = ((data_mask >> 8) & 0xff) | I2C_START
+                if ack:
+                    self.i2c_address = address
+                    self.mirror_ptr = data_mask & 0xff
+                    self.write_data = 0
+                    self.write_mirror = ((data_mask >> 8) & 0xff ==
+                                         self.mirror_dev)
+                    self.octets = data_mask & 0xff
+                    self.octets_left = ((data_mask >> 16) & 0xf) + 1
+                    self.word_left = 1
+                    self.reload = 0
+                    self.state = "I2C_WRITE"
+            elif opcode == 0b0100:
+                if (events >> address) & 1:
+                    advance = retire = True
+                else:
+                    self.timer = data_mask << 12
+                    self.state = "WAIT_EVENT"
+            elif opcode == 0b0101:
+                self.i2c_address = address
+                self.poll_dev = (data_mask >> 8) & 0xff
+                self.poll_reg = data_mask & 0xff
+                advance = True
+                self.state = "I2C_POLL_LOAD"
+            elif opcode in (0b0110, 0b0111):
+                self.i2c_address = address
+                self.poll_dev = (data_mask >> 8) & 0xff
+                self.mirror_ptr = data_mask & 0xff
+                self.octets_left = (data_mask >> 16) & 0xf
+                if opcode == 0b0110:
+                    self.poll_step = 0
+                    self.state = "I2C_READ"
+                else:
+                    self.word_left = 4
+                    self.reload = 1
+                    advance = True
+                    self.state = "I2C_UPDATE"
+            elif opcode == 0b1000:
+                jump = data_mask
+                retire = True
+            elif opcode == 0b1001:
+                self.i2c_address = address
+                self.branch_mask = data_mask
+                advance = True
+                self.state = "BRANCH"
+            elif opcode == 0b1010:
+                if address < len(self.loop_counters):
+                    self.loop_counters[address] = data_mask
+                advance = retire = True
+            elif opcode == 0b1011:
+                counters = self.loop_counters
+                if counters[min(address, len(counters) - 1)]:
+                    if address < len(counters):
+                        counters[address] -= 1
+                    jump = data_mask
+                else:
+                    advance = True
+                retire = True
+            elif opcode == 0b1100:
+                self.stack[self.sp] = self.pc + 1
+                self.sp = (self.sp + 1) % len(self.stack)
+                jump = data_mask
+                retire = True
+            elif opcode == 0b1101:
+                self.sp = (self.sp - 1) % len(self.stack)
+                jump = self.stack[self.sp]
+                retire = True
+            elif opcode == 0b1110:
+                self.timer = (address << 20) | data_mask
+                self.state = "DELAY"
+            elif opcode == 0b1111:
+                retire = True
+                self.timeout = 1
+                self.state = "END"
+        elif self.state == "BRANCH":
+            cyc = 1
+            adr = self.i2c_address
+            if ack:
+                payload = self.mem[self.pc]
+                if dat_r & self.branch_mask == payload & 0xfffff:
+                    jump = payload >> 20
+                else:
+                    advance = True
+                retire = True
+                self.state = "RUN"
+        elif self.state == "DELAY":
+            timer = self.timer
+            self.timer = (timer - 1) & 0xffffffff
+            if timer == 0:
+                advance = retire = True
+                self.state = "RUN"
+        elif self.state == "I2C_WRITE":
+            cyc = we = 1
+            adr = self.i2c_address
+            word = self.mem[self.pc] if self.reload else self.octets
+            last = self.octets_left == 1
+            dat_w = (word & 0xff) | (I2C_STOP if last else 0)
+            if ack:
+                if self.write_data:
+                    if self.write_mirror and self.mirror is not None:
+                        self.mirror[self.mirror_ptr] = word & 0xff
+                    self.mirror_ptr = (self.mirror_ptr + 1) & 0xff
+                self.write_data = 1
+                self.octets = word >> 8
+                self.octets_left -= 1
+                self.word_left -= 1
+                self.reload = 0
+                if last:
+                    advance = retire = True
+                    self.state = "RUN"
+                elif self.word_left == 0:
+                    advance = True
+                    self.reload = 1
+                    self.word_left = 4
+        elif self.state == "WAIT_EVENT":
+            timer = self.timer
+            self.timer = (timer - 1) & 0xffffffff
+            if (events >> address) & 1:
+                advance = retire = True
+                self.state = "RUN"
+            elif data_mask and timer == 0:
+                self.timeout = 1
+                self.state = "END"
+        elif self.state == "I2C_POLL_LOAD":
+            self.timer = (self.mem[self.pc] >> 16) << 12
+            self.poll_step = 0
+            self.state = "I2C_POLL"
+        elif self.state in ("I2C_POLL", "I2C_POLL_WAIT", "I2C_POLL_CLEAR"):
+            payload = self.mem[self.pc]
+            timer = self.timer
+            if timer:
+                self.timer -= 1
+            adr = self.i2c_address
+            cyc = 1
+            if self.state == "I2C_POLL":
+                we = 1
+                dat_w = [self.poll_dev | I2C_START, self.poll_reg,
+                         self.poll_dev | 1 | I2C_START,
+                         I2C_READ | I2C_STOP][self.poll_step]
+                if ack:
+                    self.poll_step = (self.poll_step + 1) & 3
+                    if self.poll_step == 0:
+                        self.state = "I2C_POLL_WAIT"
+            elif self.state == "I2C_POLL_WAIT":
+                if ack and dat_r & I2C_IDLE:
+                    if dat_r & I2C_ERROR:
+                        self.state = "I2C_POLL_CLEAR"
+                    elif dat_r & payload & 0xff == (payload >> 8) & 0xff:
+                        advance = retire = True
+                        self.state = "RUN"
+                    else:
+                        self.state = "I2C_POLL"
+                elif payload >> 16 and timer == 0:
+                    self.timeout = 1
+                    self.state = "END"
+            else:
+                we = 1
+                dat_w = I2C_ERROR
+                if ack:
+                    self.state = "I2C_POLL"
+        elif self.state in ("I2C_READ", "I2C_READ_NEXT", "I2C_READ_WAIT",
+                            "I2C_READ_ABORT"):
+            adr = self.i2c_address
+            cyc = 1
+            last = self.octets_left == 1
+            if self.state == "I2C_READ":
+                we = 1
+                dat_w = [I2C_ERROR, self.poll_dev | I2C_START,
+                         self.mirror_ptr,
+                         self.poll_dev | 1 | I2C_START][self.poll_step]
+                if ack:
+                    self.poll_step = (self.poll_step + 1) & 3
+                    if self.poll_step == 0:
+                        self.state = "I2C_READ_NEXT"
+            elif self.state == "I2C_READ_NEXT":
+                we = 1
+                dat_w = I2C_READ | (I2C_STOP if last else 0)
+                if ack:
+                    self.state = "I2C_READ_WAIT"
+            elif self.state == "I2C_READ_WAIT":
+                if ack and dat_r & I2C_IDLE:
+                    if dat_r & I2C_ERROR:
+                        advance = retire = True
+                        self.state = "RUN"
+                    else:
+                        self.mirror[self.mirror_ptr] = dat_r & 0xff
+                        self.mirror_ptr = (self.mirror_ptr + 1) & 0xff
+                        self.octets_left -= 1
+                        if last:
+                            advance = retire = True
+                            self.state = "RUN"
+                        else:
+                            self.state = "I2C_READ_NEXT"
+                elif ack and dat_r & I2C_ERROR and not last:
+                    self.state = "I2C_READ_ABORT"
+            else:
+                we = 1
+                dat_w = I2C_READ | I2C_STOP
+                if ack:
+                    self.octets_left = 1
+                    self.state = "I2C_READ_WAIT"
+        elif self.state == "I2C_UPDATE":
+            word = self.mem[self.pc] if self.reload else self.octets
+            if word & 0xff == self.mirror[self.mirror_ptr]:
+                last = self.octets_left == 1
+                self.octets = word >> 8
+                self.octets_left -= 1
+                self.word_left -= 1
+                self.reload = 0
+                self.mirror_ptr = (self.mirror_ptr + 1) & 0xff
+                if last:
+                    retire = True
+                    self.state = "RUN"
+                if last or self.word_left == 0:
+                    advance = True
+                    self.reload = 1
+                    self.word_left = 4
+            else:
+                self.poll_step = 0
+                self.state = "I2C_UPDATE_WRITE"
+        elif self.state == "I2C_UPDATE_WRITE":
+            word = self.mem[self.pc] if self.reload else self.octets
+            cyc = we = 1
+            adr = self.i2c_address
+            dat_w = [self.poll_dev | I2C_START, self.mirror_ptr,
+                     (word & 0xff) | I2C_STOP][self.poll_step]
+            if ack:
+                self.poll_step += 1
+                if self.poll_step == 3:
+                    self.mirror[self.mirror_ptr] = word & 0xff
+                    self.state = "I2C_UPDATE"
+        if jump is not None:
+            self.pc = jump
+        elif advance:
+            self.pc += 1
+        if retire:
+            self.retired += 1
+        return cyc, we, adr, dat_w
+
+
+class SystemModel:
+    def __init__(self, program, fifo_depth=16, ack=None,
+                 clock_stretching=True, read=None, mirror=None,
+                 mirror_dev=None, **kwargs):
+        self.sequencer = SequencerModel(program, mirror, mirror_dev, **kwargs)
+        self.i2c_master = I2CMasterModel(fifo_depth, ack, clock_stretching,
+                                         read)
+        self.cycle = 0
+        self.reads = 0
+        self.writes = []
+
+    @property
+    def frames(self):
+        return self.i2c_master.frames
+
+    def done(self):
+        return self.sequencer.done()
+
+    def step(self):
+        seq, master = self.sequencer, self.i2c_master
+        ack = master.ack
+        cyc, we, adr, dat_w = seq.step(ack, master.dat_r, int(master.idle()))
+        if ack:
+            if we:
+                self.writes.append((adr, dat_w))
+            else:
+                self.reads += 1
+        master.step(cyc, we, adr, dat_w)
+        self.cycle += 1
+
+    def quiet(self):
+        seq, master = self.sequencer, self.i2c_master
+        n = master.quiet()
+        if n == 0:
+            return 0
+        opcode, address, data_mask = seq._decode()
+        if seq.state in ("END", "WAIT_EVENT", "DELAY") and master.ack:
+            return 0
+        if seq.state == "END":
+            pass
+        elif seq.state == "DELAY":
+            if seq.timer == 0:
+                return 0
+            n = seq.timer if n is None else min(n, seq.timer)
+        elif seq.state == "WAIT_EVENT":
+            if (int(master.idle()) >> address) & 1:
+                return 0
+            if data_mask:
+                n = seq.timer if n is None else min(n, seq.timer)
+        elif seq.state == "I2C_POLL_WAIT":
+            # polling the FIFO register until the read is complete
+            value = master.read_value(seq.i2c_address)
+            if value != master.dat_r or master.dat_r & I2C_IDLE:
+                return 0
+            if seq.mem[seq.pc] >> 16:
+                if seq.timer == 0:
+                    return 0
+                n = seq.timer if n is None else min(n, seq.timer)
+        elif seq.state == "I2C_READ_WAIT":
+            value = master.read_value(seq.i2c_address)
+            if value != master.dat_r or master.dat_r & I2C_IDLE:
+                return 0
+            if master.dat_r & I2C_ERROR and seq.octets_left != 1:
+                return 0
+        elif seq.state in ("RUN", "I2C_WRITE", "I2C_UPDATE_WRITE"):
+            full = len(master.fifo) == master.fifo_depth
+            if seq.state != "RUN" or opcode in (0b0001, 0b0011):
+                # stalled on a full FIFO
+                adr = address if seq.state == "RUN" else seq.i2c_address
+                if master.ack or adr != 2 or not full:
+                    return 0
+            elif opcode == 0b0010:
+                # polling a condition that does not change
+                value = master.read_value(address)
+                if (value not in (None, master.dat_r) or
+                        (value is not None and address > 3) or
+                        master.dat_r & data_mask == data_mask):
+                    return 0
+            else:
+                return 0
+        else:
+            return 0
+        return n
+
+    def skip(self, n):
+        seq, master = self.sequencer, self.i2c_master
+        opcode, address, data_mask = seq._decode()
+        if seq.state in ("WAIT_EVENT", "DELAY"):
+            seq.timer = (seq.timer - n) & 0xffffffff
+            seq.wait_cycles += n
+        elif (seq.state == "RUN" and opcode == 0b0010 or
+                seq.state in ("I2C_POLL_WAIT", "I2C_READ_WAIT")):
+            reads = (n + master.ack)//2
+            self.reads += reads
+            if seq.state != "RUN" or address in (0, 2):
+                master.polls += reads
+            master.ack ^= n & 1
+            seq.wait_cycles += n
+            if seq.state == "I2C_POLL_WAIT":
+                seq.timer = max(seq.timer - n, 0)
+        elif (seq.state in ("I2C_WRITE", "I2C_UPDATE_WRITE") or
+                seq.state == "RUN" and opcode in (0b0001, 0b0011)):
+            seq.write_cycles += n
+        if seq.state != "END":
+            seq.run_cycles += n
+        master.skip(n)
+        if seq.state == "RUN":
+            adr = address
+        elif seq.state in ("I2C_WRITE", "I2C_POLL_WAIT", "I2C_READ_WAIT",
+                           "I2C_UPDATE_WRITE"):
+            adr = seq.i2c_address
+        else:
+            adr = 0
+        value = master.read_value(adr)
+        if value is not None:
+            master.dat_r = value
+        self.cycle += n
+
+    # Runs until InstEnd or max_cycles, returns the cycle count
+    def run(self, max_cycles=None):
+        while not self.done():
+            if max_cycles is not None and self.cycle >= max_cycles:
+                break
+            n = self.quiet()
+            if n is None:
+                if max_cycles is None:
+                    raise RuntimeError("program stalled at pc {}"
+                                       .format(self.sequencer.pc))
+                n = max_cycles - self.cycle
+            elif max_cycles is not None:
+                n = min(n, max_cycles - self.cycle)
+            if n:
+                self.skip(n)
+            else:
+                self.step()
+        return self.cycle
@@ -0,0 +1,46 @@
+__all__ = ["compile_writes", "i2c_cost", "cost_report"]
+
+
+# Turns register maps into I2C write frames [dev, reg, data...].
+# Phases are written in order; within a phase, registers are written in
+# ascending order using the register address auto-increment. Registers that
+# keep their reset value are skipped. Gaps of up to max_gap registers that
+# also have a target value are bridged instead of starting a new frame, which
+# would cost the device and register address octets.
+def compile_writes(dev, phases, defaults=None, max_burst=15, max_gap=2):
+    defaults = {} if defaults is None else defaults
+    sequence = []
+    for phase in phases:
+        bursts = []
+        for reg in sorted(phase):
+            if defaults.get(reg) == phase[reg]:
+                continue
+            if bursts:
+                start, data = bursts[-1]
+                gap = range(start + len(data), reg)
+                if (len(gap) <= max_gap and all(r in phase for r in gap) and
+                        len(data) + len(gap) < max_burst):
+                    data += [phase[r] for r in gap] + [phase[reg]]
+                    continue
+            bursts.append((reg, [phase[reg]]))
+        sequence += [[dev, reg] + data for reg, data in bursts]
+    return sequence
+
+
+# Frames, octets and bus time of a write sequence
+def i2c_cost(sequence, scl_freq):
+    frames = len(sequence)
+    octets = sum(len(frame) for frame in sequence)
+    # 8 data bits and ACK per octet, START and STOP per frame
+    bits = 9*octets + 2*frames
+    return frames, octets, bits/scl_freq
+
+
+# Side by side i2c_cost() of two sequences, one line each
+def cost_report(before, after, scl_freq):
+    lines = []
+    for name, sequence in ("before", before), ("after", after):
+        frames, octets, time = i2c_cost(sequence, scl_freq)
+        lines.append("{:6}: {:3} frames, {:4} octets, {:8.3f} ms".format(
+            name, frames, octets, time*1e3))
+    return "\n".join(lines)
@@ -1,28 +1,95 @@
+import struct
 from collections import namedtuple
 
 from migen import *
 from migen.genlib.fsm import *
 from misoc.interconnect import wishbone
 
+from i2c import (I2C_START, I2C_STOP, I2C_READ, I2C_IDLE, I2C_ERROR,
+                 I2C_REFUSED, I2C_FIFO_ADDR)
+
 
 __all__ = ["Sequencer",
-           "InstEnd", "InstWrite", "InstWait"]
+           "InstEnd", "InstWrite", "InstWait", "InstI2CWrite",
+           "InstWaitEvent", "InstI2CPoll", "InstI2CRead", "InstI2CUpdate",
+           "InstJump", "InstBranch", "InstLoad", "InstLoop", "InstCall",
+           "InstReturn", "InstDelay", "InstAbort", "Label", "i2c_retry",
+           "SEQ_CTRL_ADDR", "SEQ_RETIRED_ADDR", "SEQ_WAIT_CYCLES_ADDR",
+           "SEQ_WRITE_CYCLES_ADDR", "SEQ_RUN_CYCLES_ADDR", "SEQ_MIRROR_BASE",
+           "SEQ_PROGRAM_BASE",
+           "SEQ_START", "SEQ_RUNNING", "SEQ_DONE", "SEQ_TIMEOUT"]
 
 
 # Instruction set:
-#  <2> OP  <1> ADDRESS  <20> DATA_MASK
+#  <4> OP  <8> ADDRESS  <20> DATA_MASK
 #
 # OP=00: end program, ADDRESS=don't care, DATA_MASK=don't care
 # OP=01: write, ADDRESS=address, DATA_MASK=data
 # OP=10: wait until masked bits set, ADDRESS=address, DATA_MASK=mask
+# OP=11: I2C register write, ADDRESS=I2CMaster FIFO address,
+#        DATA_MASK=<4> COUNT <8> DEV <8> REG, followed by COUNT data octets
+#        packed four per word, first octet in the LSBs.
+#        Queues START, DEV, REG, data octets, STOP into the FIFO.
+# OP=0100: wait until event line set, ADDRESS=event, DATA_MASK=timeout in
+#          units of 4096 cycles (0: no timeout). Does not use the bus.
+#          On timeout, the program is stopped and the timeout flag set.
+# OP=0101: I2C register poll, ADDRESS=I2CMaster FIFO address,
+#          DATA_MASK=<4> 0 <8> DEV <8> REG, followed by a word
+#          <16> TIMEOUT <8> VALUE <8> MASK.
+#          Reads REG of DEV (write address) with a repeated START until
+#          the octet read, masked with MASK, equals VALUE. NACKed reads
+#          are retried. TIMEOUT as for OP=0100.
+# OP=0110: I2C register read, ADDRESS=I2CMaster FIFO address,
+#          DATA_MASK=<4> COUNT <8> DEV <8> REG.
+#          Clears the I2CMaster error flag, then reads COUNT registers from
+#          REG into the register mirror. A NACK ends the instruction with
+#          the error flag set.
+# OP=0111: I2C register update, as OP=11 but writes each data octet that
+#          differs from the register mirror as a separate frame
+#          START, DEV, REG, octet, STOP, and updates the mirror.
+# OP=1000: jump, DATA_MASK=target.
+# OP=1001: branch, ADDRESS=address, DATA_MASK=mask, followed by a word
+#          <12> TARGET <20> VALUE.
+#          Reads the address and jumps to TARGET if the masked data equals
+#          VALUE.
+# OP=1010: load loop counter, ADDRESS=counter, DATA_MASK=count.
+# OP=1011: loop, ADDRESS=counter, DATA_MASK=target.
+#          Decrements the counter and jumps to target if it was not zero.
+# OP=1100: call, DATA_MASK=target. Pushes the address of the next
+#          instruction on the return stack, and jumps.
+# OP=1101: return to the address popped from the return stack.
+# OP=1110: delay, ADDRESS:DATA_MASK=cycles. Does not use the bus.
+# OP=1111: abort, stops the program and sets the timeout flag.
+#
+# With a register mirror, OP=11 also records the octets written in it. The
+# mirror holds the registers of a single device, it is not updated when a
+# write is NACKed.
+#
+# Targets are instruction addresses in words, or the name of a Label in the
+# program, that takes no space, resolved by encode_program.
 
 
 InstEnd = namedtuple("InstEnd", "")
 InstWrite = namedtuple("InstWrite", "address data")
 InstWait = namedtuple("InstWait", "address mask")
+InstI2CWrite = namedtuple("InstI2CWrite", "address dev reg data")
+InstWaitEvent = namedtuple("InstWaitEvent", "event timeout")
+InstI2CPoll = namedtuple("InstI2CPoll", "address dev reg mask value timeout")
+InstI2CRead = namedtuple("InstI2CRead", "address dev reg count")
+InstI2CUpdate = namedtuple("InstI2CUpdate", "address dev reg data")
+InstJump = namedtuple("InstJump", "target")
+InstBranch = namedtuple("InstBranch", "address mask value target")
+InstLoad = namedtuple("InstLoad", "counter count")
+InstLoop = namedtuple("InstLoop", "counter target")
+InstCall = namedtuple("InstCall", "target")
+InstReturn = namedtuple("InstReturn", "")
+InstDelay = namedtuple("InstDelay", "cycles")
+InstAbort = namedtuple("InstAbort", "")
+Label = namedtuple("Label", "name")
 
 def encode(inst):
     address, data_mask = 0, 0
+    payload = []
     if isinstance(inst, InstEnd):
         opcode = 0b00
     elif isinstance(inst, InstWrite):
@@ -33,65 +100,727 @@ def encode(inst):
         opcode = 0b10
         address = inst.address
         data_mask = inst.mask
+    elif isinstance(inst, (InstI2CWrite, InstI2CUpdate)):
+        if len(inst.data) > 15:
+            raise ValueError
+        if isinstance(inst, InstI2CWrite):
+            opcode = 0b11
+        elif inst.data:
+            opcode = 0b0111
+        else:
+            raise ValueError
+        address = inst.address
+        data_mask = (len(inst.data) << 16) | (inst.dev << 8) | inst.reg
+        for i in range(0, len(inst.data), 4):
+            payload.append(sum(octet << 8*j
+                               for j, octet in enumerate(inst.data[i:i+4])))
+    elif isinstance(inst, InstWaitEvent):
+        opcode = 0b0100
+        address = inst.event
+        data_mask = inst.timeout
+    elif isinstance(inst, InstI2CPoll):
+        if inst.timeout >= 1 << 16:
+            raise ValueError
+        opcode = 0b0101
+        address = inst.address
+        data_mask = (inst.dev << 8) | inst.reg
+        payload.append((inst.timeout << 16) | (inst.value << 8) | inst.mask)
+    elif isinstance(inst, InstI2CRead):
+        if not 1 <= inst.count <= 15:
+            raise ValueError
+        opcode = 0b0110
+        address = inst.address
+        data_mask = (inst.count << 16) | (inst.dev << 8) | inst.reg
+    elif isinstance(inst, (InstJump, InstCall)):
+        opcode = 0b1000 if isinstance(inst, InstJump) else 0b1100
+        data_mask = inst.target
+    elif isinstance(inst, InstBranch):
+        if inst.target >= 1 << 12 or inst.value >= 1 << 20:
+            raise ValueError
+        opcode = 0b1001
+        address = inst.address
+        data_mask = inst.mask
+        payload.append((inst.target << 20) | inst.value)
+    elif isinstance(inst, InstLoad):
+        opcode = 0b1010
+        address = inst.counter
+        data_mask = inst.count
+    elif isinstance(inst, InstLoop):
+        opcode = 0b1011
+        address = inst.counter
+        data_mask = inst.target
+    elif isinstance(inst, InstReturn):
+        opcode = 0b1101
+    elif isinstance(inst, InstDelay):
+        if inst.cycles >= 1 << 28:
+            raise ValueError
+        opcode = 0b1110
+        address = inst.cycles >> 20
+        data_mask = inst.cycles & 0xfffff
+    elif isinstance(inst, InstAbort):
+        opcode = 0b1111
+    elif isinstance(inst, Label):
+        return []
     else:
         raise ValueError
-    return (opcode << 21) | (address << 20) | data_mask
+    return [(opcode << 28) | (address << 20) | data_mask] + payload
+
+
+def encode_program(program):
+    labels = {}
+    pc = 0
+    for inst in program:
+        if isinstance(inst, Label):
+            if inst.name in labels:
+                raise ValueError("duplicate label " + inst.name)
+            labels[inst.name] = pc
+        elif "target" in inst._fields:
+            pc += len(encode(inst._replace(target=0)))
+        else:
+            pc += len(encode(inst))
+    words = []
+    for inst in program:
+        if "target" in inst._fields and isinstance(inst.target, str):
+            try:
+                inst = inst._replace(target=labels[inst.target])
+            except KeyError:
+                raise ValueError("undefined label " + inst.target)
+        words += encode(inst)
+    return words
+
+
+def pack_program(program):
+    words = encode_program(program)
+    return struct.pack("<{}I".format(len(words)), *words)
 
 
+def unpack_program(blob):
+    return list(struct.unpack("<{}I".format(len(blob)//4), blob))
+
+
+# Runs the I2C instructions in body until none of their frames is NACKed
+# or refused (see I2CEngineMux), at most retries + 1 times, waiting delay
+# cycles between attempts. Jumps to the label fail after the last failed
+# attempt. name must be unique in the program, it labels the first attempt.
+def i2c_retry(name, body, retries, delay, fail, address=I2C_FIFO_ADDR,
+              counter=0):
+    return [
+        InstLoad(counter, retries),
+        Label(name),
+        InstWrite(address, I2C_ERROR),
+    ] + list(body) + [
+        InstWait(address, I2C_IDLE),
+        InstBranch(address, I2C_ERROR | I2C_REFUSED, 0, name + "_done"),
+        InstDelay(delay),
+        InstLoop(counter, name),
+        InstJump(fail),
+        Label(name + "_done"),
+    ]
+
+
+# Control interface:
+# ctrl = Record([
+#     ("start",   1),  # W: (re)start program from address 0
+#     ("running", 1),  # R: started, and not stopped yet
+#     ("done",    1),  # R: InstEnd reached
+#     ("timeout", 1),  # R: program stopped by a timeout or InstAbort
+# ])
+# followed by the performance counters, 32 bits, cleared on start:
+# instructions retired, cycles spent waiting (InstWait, InstWaitEvent,
+# InstI2CPoll, InstI2CRead, InstBranch, InstDelay) and writing (InstWrite,
+# InstI2CWrite, InstI2CUpdate), and cycles from start to InstEnd; then the
+# register mirror at SEQ_MIRROR_BASE (R) and the program memory at
+# SEQ_PROGRAM_BASE (R/W).
+SEQ_CTRL_ADDR = 0
+(
+    SEQ_RETIRED_ADDR,
+    SEQ_WAIT_CYCLES_ADDR,
+    SEQ_WRITE_CYCLES_ADDR,
+    SEQ_RUN_CYCLES_ADDR,
+) = range(1, 5)
+SEQ_MIRROR_BASE = 0x100
+SEQ_PROGRAM_BASE = 0x1000
+SEQ_START = SEQ_RUNNING = 1 << 0
+SEQ_DONE = 1 << 1
+SEQ_TIMEOUT = 1 << 2
+
+
+# mirror: initial register values (dict) of the register mirror used by
+# InstI2CRead and InstI2CUpdate, mirror_dev: device (write address) whose
+# InstI2CWrite data octets are recorded in the mirror, n_counters: loop
+# counters, call_depth: return stack depth (calls beyond wrap around).
+# running, done and timeout are the bits of the control register.
 class Sequencer(Module):
-    def __init__(self, program, bus=None):
+    def __init__(self, program, bus=None, n_events=8, depth=None,
+                 autostart=True, name=None, mirror=None, mirror_dev=None,
+                 n_counters=4, call_depth=4):
         if bus is None:
             bus = wishbone.Interface()
         self.bus = bus
+        self.ctrl = ctrl = wishbone.Interface()
+        self.events = Signal(n_events)
+        self.start = Signal()
+        self.running = Signal()
+        self.done = Signal()
+        self.timeout = Signal()
 
         ###
 
-        assert isinstance(program[-1], InstEnd)
-        program_e = [encode(inst) for inst in program]
-        mem = Memory(32, len(program), init=program_e)
+        assert any(isinstance(inst, (InstEnd, InstAbort)) for inst in program)
+        assert mirror is not None or not any(
+            isinstance(inst, (InstI2CRead, InstI2CUpdate)) for inst in program)
+        program_e = encode_program(program)
+        if depth is None:
+            depth = len(program_e)
+        assert len(program_e) <= depth <= SEQ_PROGRAM_BASE
+        mem = Memory(32, depth, init=program_e, name=name)
         self.specials += mem
 
         mem_port = mem.get_port()
         self.specials += mem_port
 
-        fsm = FSM(reset_state="FETCH")
+        # Control
+        load_port = mem.get_port(write_capable=True)
+        self.specials += load_port
+
+        # Register mirror
+        mirror_ptr = Signal(8)
+        mirror_we = Signal()
+        mirror_dat_w = Signal(8)
+        mirror_dat_r = Signal(8)
+        ctrl_mirror_dat_r = Signal(8)
+        if mirror is not None:
+            mirror_mem = Memory(8, 256, init=[mirror.get(reg, 0)
+                                              for reg in range(256)])
+            self.specials += mirror_mem
+            mirror_port = mirror_mem.get_port(write_capable=True,
+                                              async_read=True)
+            ctrl_mirror_port = mirror_mem.get_port()
+            self.specials += mirror_port, ctrl_mirror_port
+            self.comb += [
+                mirror_port.adr.eq(mirror_ptr),
+                mirror_port.we.eq(mirror_we),
+                mirror_port.dat_w.eq(mirror_dat_w),
+                mirror_dat_r.eq(mirror_port.dat_r),
+                ctrl_mirror_port.adr.eq(ctrl.adr),
+                ctrl_mirror_dat_r.eq(ctrl_mirror_port.dat_r),
+            ]
+
+        ctrl_program = Signal()
+        ctrl_mirror = Signal()
+        self.comb += [
+            ctrl_program.eq(ctrl.adr[log2_int(SEQ_PROGRAM_BASE)]),
+            ctrl_mirror.eq(ctrl.adr[log2_int(SEQ_MIRROR_BASE)]),
+            load_port.adr.eq(ctrl.adr),
+            load_port.dat_w.eq(ctrl.dat_w),
+            load_port.we.eq(ctrl.ack & ctrl.we & ctrl_program),
+        ]
+        self.sync += [
+            ctrl.ack.eq(0),
+            If(ctrl.cyc & ctrl.stb & ~ctrl.ack,
+                ctrl.ack.eq(1),
+            ),
+        ]
+        retired = Signal(32)
+        wait_cycles = Signal(32)
+        write_cycles = Signal(32)
+        run_cycles = Signal(32)
+        self.comb += [
+            If(ctrl_program,
+                ctrl.dat_r.eq(load_port.dat_r),
+            ).Elif(ctrl_mirror,
+                ctrl.dat_r.eq(ctrl_mirror_dat_r),
+            ).Else(
+                Case(ctrl.adr[:log2_int(SEQ_MIRROR_BASE)], {
+                    SEQ_CTRL_ADDR:
+                        ctrl.dat_r.eq(Cat(self.running, self.done,
+                                          self.timeout)),
+                    SEQ_RETIRED_ADDR:      ctrl.dat_r.eq(retired),
+                    SEQ_WAIT_CYCLES_ADDR:  ctrl.dat_r.eq(wait_cycles),
+                    SEQ_WRITE_CYCLES_ADDR: ctrl.dat_r.eq(write_cycles),
+                    SEQ_RUN_CYCLES_ADDR:   ctrl.dat_r.eq(run_cycles),
+                    "default":             ctrl.dat_r.eq(0),
+                }),
+            ),
+            If(ctrl.ack & ctrl.we & (ctrl.adr == SEQ_CTRL_ADDR),
+                self.start.eq(ctrl.dat_w[0]),
+            ),
+        ]
+
+        # The read port address is the PC of the next cycle, so that dat_r
+        # always holds the current instruction and a new one can be issued
+        # in the cycle following the completion of the previous one.
+        pc = Signal(max=depth)
+        next_pc = Signal.like(pc)
+        advance = Signal()
+        jump = Signal()
+        jump_target = Signal.like(pc)
+        self.comb += [
+            If(self.start,
+                next_pc.eq(0),
+            ).Elif(jump,
+                next_pc.eq(jump_target),
+            ).Elif(advance,
+                next_pc.eq(pc + 1),
+            ).Else(
+                next_pc.eq(pc),
+            ),
+            mem_port.adr.eq(next_pc),
+        ]
+        self.sync += pc.eq(next_pc)
+
+        # start resets the FSM to FETCH, which waits for the first start
+        # without autostart
+        fsm = ResetInserter()(FSM(reset_state="FETCH"))
         self.submodules += fsm
+        self.comb += fsm.reset.eq(self.start)
+        started = Signal(reset=autostart)
+        self.sync += If(self.start, started.eq(1))
 
-        i_opcode = mem_port.dat_r[21:23]
-        i_address = mem_port.dat_r[20:21]
+        i_opcode = mem_port.dat_r[28:32]
+        i_address = mem_port.dat_r[20:28]
         i_data_mask = mem_port.dat_r[0:20]
+        i_count = mem_port.dat_r[16:20]
+        i_dev = mem_port.dat_r[8:16]
+        i_reg = mem_port.dat_r[0:8]
 
-        self.sync += [
-            self.bus.adr.eq(i_address),
+        # I2C write octet stream
+        i2c_address = Signal.like(i_address)
+        octets = Signal(32)
+        octets_left = Signal(5)
+        word_left = Signal(3)
+        reload = Signal()
+        octet_word = Signal(32)
+        last = Signal()
+        self.comb += [
+            octet_word.eq(Mux(reload, mem_port.dat_r, octets)),
+            last.eq(octets_left == 1),
+        ]
+
+        # I2C register poll, the payload word is current once the
+        # instruction has been decoded
+        poll_dev = Signal(8)
+        poll_reg = Signal(8)
+        poll_step = Signal(2)
+        poll_mask = mem_port.dat_r[0:8]
+        poll_value = mem_port.dat_r[8:16]
+        poll_timeout = mem_port.dat_r[16:32]
+        poll_words = Array([
+            poll_dev | I2C_START,
+            poll_reg,
+            poll_dev | 1 | I2C_START,
+            I2C_READ | I2C_STOP,
+        ])
+
+        # I2C register read and update
+        read_words = Array([
+            I2C_ERROR,
+            poll_dev | I2C_START,
+            mirror_ptr,
+            poll_dev | 1 | I2C_START,
+        ])
+        update_words = Array([
+            poll_dev | I2C_START,
+            mirror_ptr,
+            octet_word[0:8] | I2C_STOP,
+        ])
+        # the current octet of I2C_WRITE is data, not the register address
+        write_data = Signal()
+        if mirror_dev is not None:
+            write_mirror = Signal()
+            self.sync += If(fsm.ongoing("RUN"),
+                write_mirror.eq(i_dev == mirror_dev)
+            )
+        else:
+            write_mirror = 0
+
+        # Control flow
+        branch_mask = Signal(len(i_data_mask))
+        branch_target = mem_port.dat_r[20:32]
+        branch_value = mem_port.dat_r[0:20]
+        loop_counters = [Signal(len(i_data_mask)) for _ in range(n_counters)]
+        loop_counter = Array(loop_counters)[i_address]
+        stack = [Signal.like(pc) for _ in range(call_depth)]
+        sp = Signal(max=call_depth)
+        stack_top = Array(stack)[sp - 1]
+
+        event = Signal()
+        timer = Signal(len(i_data_mask) + 12)
+        events = Array(self.events[i] for i in range(n_events))
+        self.comb += event.eq(events[i_address])
+
+        self.comb += [
             self.bus.sel.eq(1),
-            self.bus.dat_w.eq(i_data_mask),
+            self.running.eq(started & ~fsm.ongoing("END")),
+        ]
+
+        # Performance counters
+        retire = Signal()
+        waiting = Signal()
+        writing = Signal()
+        self.comb += [
+            waiting.eq(fsm.ongoing("RUN") &
+                       ((i_opcode == 0b0010) | (i_opcode == 0b0100) |
+                        (i_opcode == 0b0101)) |
+                       fsm.ongoing("WAIT_EVENT") |
+                       fsm.ongoing("I2C_POLL_LOAD") |
+                       fsm.ongoing("I2C_POLL") |
+                       fsm.ongoing("I2C_POLL_WAIT") |
+                       fsm.ongoing("I2C_POLL_CLEAR") |
+                       fsm.ongoing("RUN") & (i_opcode == 0b0110) |
+                       fsm.ongoing("I2C_READ") |
+                       fsm.ongoing("I2C_READ_NEXT") |
+                       fsm.ongoing("I2C_READ_WAIT") |
+                       fsm.ongoing("I2C_READ_ABORT") |
+                       fsm.ongoing("RUN") & ((i_opcode == 0b1001) |
+                                             (i_opcode == 0b1110)) |
+                       fsm.ongoing("BRANCH") |
+                       fsm.ongoing("DELAY")),
+            writing.eq(fsm.ongoing("RUN") &
+                       ((i_opcode == 0b0001) | (i_opcode == 0b0011) |
+                        (i_opcode == 0b0111)) |
+                       fsm.ongoing("I2C_WRITE") |
+                       fsm.ongoing("I2C_UPDATE") |
+                       fsm.ongoing("I2C_UPDATE_WRITE")),
         ]
+        for counter, increment in [
+                (retired, retire),
+                (wait_cycles, waiting),
+                (write_cycles, writing),
+                (run_cycles, self.running)]:
+            self.sync += [
+                If(self.start,
+                    counter.eq(0),
+                ).Elif(increment,
+                    counter.eq(counter + 1),
+                )
+            ]
 
-        fsm.act("FETCH", NextState("DECODE"))
-        fsm.act("DECODE",
+        fsm.act("FETCH", If(started, NextState("RUN")))
+        fsm.act("RUN",
+            self.bus.adr.eq(i_address),
+            self.bus.dat_w.eq(i_data_mask),
             If(i_opcode == 0b00,
+                retire.eq(1),
+                NextValue(self.done, 1),
                 NextState("END")
             ).Elif(i_opcode == 0b01,
-                NextState("WRITE")
+                self.bus.cyc.eq(1),
+                self.bus.stb.eq(1),
+                self.bus.we.eq(1),
+                If(self.bus.ack,
+                    advance.eq(1),
+                    retire.eq(1)
+                )
             ).Elif(i_opcode == 0b10,
-                NextState("WAIT")
+                self.bus.cyc.eq(1),
+                self.bus.stb.eq(1),
+                If(self.bus.ack &
+                        ((self.bus.dat_r & i_data_mask) == i_data_mask),
+                    advance.eq(1),
+                    retire.eq(1)
+                )
+            ).Elif(i_opcode == 0b11,
+                self.bus.cyc.eq(1),
+                self.bus.stb.eq(1),
+                self.bus.we.eq(1),
+                self.bus.dat_w.eq(i_dev | I2C_START),
+                If(self.bus.ack,
+                    NextValue(i2c_address, i_address),
+                    NextValue(mirror_ptr, i_reg),
+                    NextValue(write_data, 0),
+                    NextValue(octets, i_reg),
+                    NextValue(octets_left, i_count + 1),
+                    NextValue(word_left, 1),
+                    NextValue(reload, 0),
+                    NextState("I2C_WRITE")
+                )
+            ).Elif(i_opcode == 0b0100,
+                If(event,
+                    advance.eq(1),
+                    retire.eq(1)
+                ).Else(
+                    NextValue(timer, Cat(C(0, 12), i_data_mask)),
+                    NextState("WAIT_EVENT")
+                )
+            ).Elif(i_opcode == 0b0101,
+                NextValue(i2c_address, i_address),
+                NextValue(poll_dev, i_dev),
+                NextValue(poll_reg, i_reg),
+                advance.eq(1),
+                NextState("I2C_POLL_LOAD")
+            ).Elif(i_opcode == 0b0110,
+                NextValue(i2c_address, i_address),
+                NextValue(poll_dev, i_dev),
+                NextValue(mirror_ptr, i_reg),
+                NextValue(octets_left, i_count),
+                NextValue(poll_step, 0),
+                NextState("I2C_READ")
+            ).Elif(i_opcode == 0b0111,
+                NextValue(i2c_address, i_address),
+                NextValue(poll_dev, i_dev),
+                NextValue(mirror_ptr, i_reg),
+                NextValue(octets_left, i_count),
+                NextValue(word_left, 4),
+                NextValue(reload, 1),
+                advance.eq(1),
+                NextState("I2C_UPDATE")
+            ).Elif(i_opcode == 0b1000,
+                jump.eq(1),
+                jump_target.eq(i_data_mask),
+                retire.eq(1)
+            ).Elif(i_opcode == 0b1001,
+                NextValue(i2c_address, i_address),
+                NextValue(branch_mask, i_data_mask),
+                advance.eq(1),
+                NextState("BRANCH")
+            ).Elif(i_opcode == 0b1010,
+                [If(i_address == i,
+                    NextValue(counter, i_data_mask)
+                ) for i, counter in enumerate(loop_counters)],
+                advance.eq(1),
+                retire.eq(1)
+            ).Elif(i_opcode == 0b1011,
+                If(loop_counter != 0,
+                    [If(i_address == i,
+                        NextValue(counter, counter - 1)
+                    ) for i, counter in enumerate(loop_counters)],
+                    jump.eq(1),
+                    jump_target.eq(i_data_mask)
+                ).Else(
+                    advance.eq(1)
+                ),
+                retire.eq(1)
+            ).Elif(i_opcode == 0b1100,
+                [If(sp == i,
+                    NextValue(entry, pc + 1)
+                ) for i, entry in enumerate(stack)],
+                NextValue(sp, sp + 1),
+                jump.eq(1),
+                jump_target.eq(i_data_mask),
+                retire.eq(1)
+            ).Elif(i_opcode == 0b1101,
+                NextValue(sp, sp - 1),
+                jump.eq(1),
+                jump_target.eq(stack_top),
+                retire.eq(1)
+            ).Elif(i_opcode == 0b1110,
+                NextValue(timer, Cat(i_data_mask, i_address)),
+                NextState("DELAY")
+            ).Elif(i_opcode == 0b1111,
+                retire.eq(1),
+                NextValue(self.timeout, 1),
+                NextState("END")
+            )
+        )
+        fsm.act("BRANCH",
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.adr.eq(i2c_address),
+            If(self.bus.ack,
+                If((self.bus.dat_r & branch_mask) == branch_value,
+                    jump.eq(1),
+                    jump_target.eq(branch_target)
+                ).Else(
+                    advance.eq(1)
+                ),
+                retire.eq(1),
+                NextState("RUN")
+            )
+        )
+        fsm.act("DELAY",
+            NextValue(timer, timer - 1),
+            If(timer == 0,
+                advance.eq(1),
+                retire.eq(1),
+                NextState("RUN")
+            )
+        )
+        fsm.act("I2C_WRITE",
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.we.eq(1),
+            self.bus.adr.eq(i2c_address),
+            self.bus.dat_w.eq(octet_word[0:8] | Mux(last, I2C_STOP, 0)),
+            mirror_dat_w.eq(octet_word[0:8]),
+            If(self.bus.ack,
+                NextValue(write_data, 1),
+                If(write_data,
+                    mirror_we.eq(write_mirror),
+                    NextValue(mirror_ptr, mirror_ptr + 1),
+                ),
+                NextValue(octets, octet_word[8:]),
+                NextValue(octets_left, octets_left - 1),
+                NextValue(word_left, word_left - 1),
+                NextValue(reload, 0),
+                If(last,
+                    advance.eq(1),
+                    retire.eq(1),
+                    NextState("RUN")
+                ).Elif(word_left == 1,
+                    advance.eq(1),
+                    NextValue(reload, 1),
+                    NextValue(word_left, 4)
+                )
+            )
+        )
+        fsm.act("WAIT_EVENT",
+            NextValue(timer, timer - 1),
+            If(event,
+                advance.eq(1),
+                retire.eq(1),
+                NextState("RUN")
+            ).Elif((i_data_mask != 0) & (timer == 0),
+                NextValue(self.timeout, 1),
+                NextState("END")
+            )
+        )
+        fsm.act("I2C_POLL_LOAD",
+            NextValue(timer, Cat(C(0, 12), poll_timeout)),
+            NextValue(poll_step, 0),
+            NextState("I2C_POLL")
+        )
+        fsm.act("I2C_POLL",
+            If(timer != 0, NextValue(timer, timer - 1)),
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.we.eq(1),
+            self.bus.adr.eq(i2c_address),
+            self.bus.dat_w.eq(poll_words[poll_step]),
+            If(self.bus.ack,
+                NextValue(poll_step, poll_step + 1),
+                If(poll_step == 3,
+                    NextState("I2C_POLL_WAIT")
+                )
+            )
+        )
+        fsm.act("I2C_POLL_WAIT",
+            If(timer != 0, NextValue(timer, timer - 1)),
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.adr.eq(i2c_address),
+            If(self.bus.ack & ((self.bus.dat_r & I2C_IDLE) != 0),
+                If((self.bus.dat_r & I2C_ERROR) != 0,
+                    NextState("I2C_POLL_CLEAR")
+                ).Elif((self.bus.dat_r[0:8] & poll_mask) == poll_value,
+                    advance.eq(1),
+                    retire.eq(1),
+                    NextState("RUN")
+                ).Else(
+                    NextState("I2C_POLL")
+                )
+            ).Elif((poll_timeout != 0) & (timer == 0),
+                NextValue(self.timeout, 1),
+                NextState("END")
+            )
+        )
+        fsm.act("I2C_POLL_CLEAR",
+            If(timer != 0, NextValue(timer, timer - 1)),
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.we.eq(1),
+            self.bus.adr.eq(i2c_address),
+            self.bus.dat_w.eq(I2C_ERROR),
+            If(self.bus.ack,
+                NextState("I2C_POLL")
+            )
+        )
+        fsm.act("I2C_READ",
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.we.eq(1),
+            self.bus.adr.eq(i2c_address),
+            self.bus.dat_w.eq(read_words[poll_step]),
+            If(self.bus.ack,
+                NextValue(poll_step, poll_step + 1),
+                If(poll_step == 3,
+                    NextState("I2C_READ_NEXT")
+                )
+            )
+        )
+        fsm.act("I2C_READ_NEXT",
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.we.eq(1),
+            self.bus.adr.eq(i2c_address),
+            self.bus.dat_w.eq(I2C_READ | Mux(last, I2C_STOP, 0)),
+            If(self.bus.ack,
+                NextState("I2C_READ_WAIT")
+            )
+        )
+        fsm.act("I2C_READ_WAIT",
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
+            self.bus.adr.eq(i2c_address),
+            mirror_dat_w.eq(self.bus.dat_r[0:8]),
+            If(self.bus.ack & ((self.bus.dat_r & I2C_IDLE) != 0),
+                If((self.bus.dat_r & I2C_ERROR) != 0,
+                    advance.eq(1),
+                    retire.eq(1),
+                    NextState("RUN")
+                ).Else(
+                    mirror_we.eq(1),
+                    NextValue(mirror_ptr, mirror_ptr + 1),
+                    NextValue(octets_left, octets_left - 1),
+                    If(last,
+                        advance.eq(1),
+                        retire.eq(1),
+                        NextState("RUN")
+                    ).Else(
+                        NextState("I2C_READ_NEXT")
+                    )
+                )
+            ).Elif(self.bus.ack & ((self.bus.dat_r & I2C_ERROR) != 0) & ~last,
+                # the framer discards the rest of the NACKed frame up to a
+                # STOP, that has not been queued yet
+                NextState("I2C_READ_ABORT")
             )
         )
-        fsm.act("WRITE",
+        fsm.act("I2C_READ_ABORT",
             self.bus.cyc.eq(1),
             self.bus.stb.eq(1),
             self.bus.we.eq(1),
+            self.bus.adr.eq(i2c_address),
+            self.bus.dat_w.eq(I2C_READ | I2C_STOP),
             If(self.bus.ack,
-                NextValue(mem_port.adr, mem_port.adr + 1),
-                NextState("FETCH")
+                NextValue(octets_left, 1),
+                NextState("I2C_READ_WAIT")
+            )
+        )
+        fsm.act("I2C_UPDATE",
+            If(octet_word[0:8] == mirror_dat_r,
+                NextValue(octets, octet_word[8:]),
+                NextValue(octets_left, octets_left - 1),
+                NextValue(word_left, word_left - 1),
+                NextValue(reload, 0),
+                NextValue(mirror_ptr, mirror_ptr + 1),
+                If(last,
+                    retire.eq(1),
+                    NextState("RUN")
+                ),
+                If(last | (word_left == 1),
+                    advance.eq(1),
+                    NextValue(reload, 1),
+                    NextValue(word_left, 4)
+                )
+            ).Else(
+                NextValue(poll_step, 0),
+                NextState("I2C_UPDATE_WRITE")
             )
         )
-        fsm.act("WAIT",
+        fsm.act("I2C_UPDATE_WRITE",
             self.bus.cyc.eq(1),
             self.bus.stb.eq(1),
-            If(self.bus.ack & ((self.bus.dat_r & i_data_mask) == i_data_mask),
-                NextValue(mem_port.adr, mem_port.adr + 1),
-                NextState("FETCH")
+            self.bus.we.eq(1),
+            self.bus.adr.eq(i2c_address),
+            self.bus.dat_w.eq(update_words[poll_step]),
+            mirror_dat_w.eq(octet_word[0:8]),
+            If(self.bus.ack,
+                NextValue(poll_step, poll_step + 1),
+                If(poll_step == 2,
+                    mirror_we.eq(1),
+                    NextState("I2C_UPDATE")
+                )
             )
         )
         fsm.act("END", NextState("END"))
@@ -0,0 +1,187 @@
+from sequencer import *
+from i2c import *
+from regmap import *
+from si5324_plan import *
+
+
+__all__ = ["SI5324_DEFAULTS", "si5324_registers", "i2c_sequence",
+           "i2c_program", "bringup_program", "register_runs",
+           "retune_program"]
+
+
+# Reset values, from the datasheet register map
+SI5324_DEFAULTS = {
+    0:   0x14, 1:   0xe4, 2:   0x42, 3:   0x05, 5:   0xed, 6:   0x2d,
+    7:   0x2a, 8:   0x00, 9:   0xc0, 10:  0x00, 11:  0x40, 19:  0x29,
+    20:  0x3e, 21:  0xff, 22:  0xdf, 23:  0x1f, 24:  0x3f, 31:  0x00,
+    32:  0x00, 34:  0x00, 35:  0x00, 40:  0xc0, 41:  0x00, 42:  0xf9,
+    43:  0x00, 44:  0x00, 45:  0x09, 46:  0x00, 47:  0x00, 48:  0x09,
+    55:  0x00, 131: 0x1f, 132: 0x02, 136: 0x00, 137: 0x00, 138: 0x0f,
+    139: 0xff, 142: 0x00, 143: 0x00,
+}
+
+
+def si5324_registers(N1_HS, NC1_LS, N2_HS, N2_LS, N31):
+    return [
+        {
+            2:   0b0010 | (4 << 4), # BWSEL=4
+            3:   0b0101 | 0x10,     # SQ_ICAL=1
+            6:            0x07,     # SFOUT1_REG=b111
+            25:  (N1_HS  << 5 ) & 0xff,
+            31:  (NC1_LS >> 16) & 0xff,
+            32:  (NC1_LS >> 8 ) & 0xff,
+            33:  (NC1_LS)       & 0xff,
+            40:  (N2_HS  << 5 ) & 0xff |
+                 (N2_LS  >> 16) & 0xff,
+            41:  (N2_LS  >> 8 ) & 0xff,
+            42:  (N2_LS)        & 0xff,
+            43:  (N31    >> 16) & 0xff,
+            44:  (N31    >> 8)  & 0xff,
+            45:  (N31)          & 0xff,
+            137:          0x01,     # FASTLOCK=1
+        },
+        # calibration is started once everything else is set up
+        {
+            136:          0x40,     # ICAL=1
+        },
+    ]
+
+
+def i2c_sequence(N1_HS, NC1_LS, N2_HS, N2_LS, N31, compile=True):
+    phases = si5324_registers(N1_HS, NC1_LS, N2_HS, N2_LS, N31)
+    if compile:
+        si5324 = compile_writes((0x68 << 1), phases, SI5324_DEFAULTS)
+    else:
+        si5324 = [[(0x68 << 1), reg, value]
+                  for phase in phases for reg, value in sorted(phase.items())]
+    return [
+        # PCA9548: select channel 7
+        [(0x74 << 1), 1 << 7],
+    ] + si5324
+
+
+def i2c_program(i2c_sequence, address=I2C_FIFO_ADDR, event=None, timeout=0):
+    program = []
+    for dev, reg, *data in i2c_sequence:
+        program += [
+            InstI2CWrite(address, dev, reg, data),
+        ]
+    if event is None:
+        program += [
+            InstWait(address, I2C_IDLE),
+        ]
+    else:
+        program += [
+            InstWaitEvent(event, timeout),
+        ]
+    return program
+
+
+# The Si5324 and the PCA9548 both support Fast-mode. With lock, the program
+# proceeds as soon as the Si5324 answers after reset, and ends once LOL_INT
+# is cleared after calibration, instead of relying on fixed delays. With
+# retries, all frames are sent again 100us after a NACK, and the program
+# is aborted (timeout flag set) after the last attempt.
+def bringup_program(clk_freq, fout=None, event=0, compile=True,
+                    i2c_mode="fast", lock=True, retries=0):
+    # NOTE: the logical parameters DO NOT MAP to physical values written
+    # into registers. plan_registers() maps them; see the datasheet.
+    if fout is None:
+        fout = clk_freq
+    plan = solve(clk_freq, fout)
+    sequence = i2c_sequence(*plan_registers(plan), compile=compile)
+
+    # 4s, or as long as the 16 bit poll timeout allows (2.1s at 125MHz)
+    timeout = min(int(4*clk_freq) >> 12, 0xffff)
+    program = [
+        InstWrite(I2C_CONFIG_ADDR, i2c_divider(clk_freq, i2c_mode)),
+        InstWrite(I2C_HOLD_ADDR, i2c_hold(clk_freq, i2c_mode)),
+    ]
+    writes = i2c_program(sequence, event=event, timeout=timeout)
+    if lock:
+        # after the PCA9548 channel select, wait for the Si5324 to ACK
+        writes[1:1] = [
+            InstI2CPoll(I2C_FIFO_ADDR, (0x68 << 1), 134, 0x00, 0x00,
+                        timeout),
+        ]
+    if retries:
+        writes = i2c_retry("bringup", writes[:-1], retries,
+                           int(100e-6*clk_freq), "fail")
+    program += writes
+    if lock:
+        program += [
+            InstI2CPoll(I2C_FIFO_ADDR, (0x68 << 1), 130, 0x01, 0x00, # LOL_INT
+                        timeout),
+        ]
+    program += [
+        InstEnd(),
+    ]
+    if retries:
+        program += [
+            Label("fail"),
+            InstAbort(),
+        ]
+    return program
+
+
+# Splits a register map into runs of consecutive registers (reg, data)
+def register_runs(registers, max_count=15):
+    runs = []
+    for reg in sorted(registers):
+        if runs:
+            start, data = runs[-1]
+            if start + len(data) == reg and len(data) < max_count:
+                data.append(registers[reg])
+                continue
+        runs.append((reg, [registers[reg]]))
+    return runs
+
+
+# Changes the output frequency of a Si5324 brought up by bringup_program
+# (the PCA9548 channel stays selected), using the register mirror of a
+# Sequencer with mirror_dev=(0x68 << 1): only the registers that differ
+# from the mirror are written. With snapshot, the mirror is first loaded
+# from the Si5324 instead of relying on the registers written previously.
+def retune_program(clk_freq, fout, snapshot=False, event=0, i2c_mode="fast",
+                   lock=True):
+    plan = solve(clk_freq, fout)
+    phases = si5324_registers(*plan_registers(plan))
+    dev = 0x68 << 1
+
+    # 4s, or as long as the 16 bit poll timeout allows (2.1s at 125MHz)
+    timeout = min(int(4*clk_freq) >> 12, 0xffff)
+    program = [
+        InstWrite(I2C_CONFIG_ADDR, i2c_divider(clk_freq, i2c_mode)),
+        InstWrite(I2C_HOLD_ADDR, i2c_hold(clk_freq, i2c_mode)),
+    ]
+    if snapshot:
+        program += [
+            InstI2CRead(I2C_FIFO_ADDR, dev, reg, len(data))
+            for reg, data in register_runs(phases[0])
+        ]
+    program += [
+        InstI2CUpdate(I2C_FIFO_ADDR, dev, reg, data)
+        for reg, data in register_runs(phases[0])
+    ]
+    # ICAL is written even if the mirror already holds it
+    program += [
+        InstI2CWrite(I2C_FIFO_ADDR, dev, reg, data)
+        for phase in phases[1:] for reg, data in register_runs(phase)
+    ]
+    if event is None:
+        program += [
+            InstWait(I2C_FIFO_ADDR, I2C_IDLE),
+        ]
+    else:
+        program += [
+            InstWaitEvent(event, timeout),
+        ]
+    if lock:
+        program += [
+            InstI2CPoll(I2C_FIFO_ADDR, dev, 130, 0x01, 0x00, # LOL_INT
+                        timeout),
+        ]
+    program += [
+        InstEnd(),
+    ]
+    return program
@@ -0,0 +1,133 @@
+import os
+import json
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+
+__all__ = ["Si5324Plan", "solve", "check_plan", "plan_registers"]
+
+
+# Logical divider values, see the Si5324 datasheet:
+#  fOSC = fIN * N2_HS * N2_LS / N31
+#  fOUT = fOSC / (N1_HS * NC1_LS)
+Si5324Plan = namedtuple("Si5324Plan", "N1_HS NC1_LS N2_HS N2_LS N31")
+
+F3_MIN, F3_MAX = 2000, 2000000
+FOSC_MIN, FOSC_MAX = 4850000000, 5670000000
+HS_MIN, HS_MAX = 4, 11
+LS_MAX = 1 << 20
+N31_MAX = 1 << 19
+
+# Candidates evaluated at once, growing from the first to the second
+_CHUNK = 1 << 12, 1 << 20
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                                 "si5324_test")
+
+
+def _hz(f):
+    if int(f) != f or f <= 0:
+        raise ValueError("frequencies must be positive integers in Hz")
+    return int(f)
+
+
+def check_plan(fin, fout, plan):
+    fin, fout = _hz(fin), _hz(fout)
+    n2 = plan.N2_HS*plan.N2_LS
+    n1 = plan.N1_HS*plan.NC1_LS
+    return (HS_MIN <= plan.N1_HS <= HS_MAX and
+            HS_MIN <= plan.N2_HS <= HS_MAX and
+            (plan.NC1_LS == 1 or plan.NC1_LS % 2 == 0) and
+            1 <= plan.NC1_LS <= LS_MAX and
+            plan.N2_LS % 2 == 0 and 2 <= plan.N2_LS <= LS_MAX and
+            1 <= plan.N31 <= N31_MAX and
+            F3_MIN*plan.N31 <= fin <= F3_MAX*plan.N31 and
+            FOSC_MIN*plan.N31 <= fin*n2 <= FOSC_MAX*plan.N31 and
+            fin*n2 == fout*n1*plan.N31)
+
+
+def _split(n2, n1):
+    # For each candidate, the largest valid high speed dividers (0 if none)
+    hs = np.arange(HS_MIN, HS_MAX + 1)
+    n2_ls, n2_rem = np.divmod(n2[:, None], hs)
+    n2_ok = (n2_rem == 0) & (n2_ls % 2 == 0) & (n2_ls <= LS_MAX)
+    n1_ls, n1_rem = np.divmod(n1[:, None], hs)
+    n1_ok = ((n1_rem == 0) & ((n1_ls % 2 == 0) | (n1_ls == 1)) &
+             (n1_ls <= LS_MAX))
+    return (np.max(np.where(n2_ok, hs, 0), axis=1),
+            np.max(np.where(n1_ok, hs, 0), axis=1))
+
+
+def _solve(fin, fout):
+    n31 = np.arange(max(1, -(-fin // F3_MAX)), min(N31_MAX, fin // F3_MIN) + 1,
+                    dtype=np.int64)
+    # fOSC must be a multiple of fOUT, i.e. N2 a multiple of m
+    m = n31*fout // np.gcd(n31*fout, fin)
+    k_min = -(-(-(-FOSC_MIN*n31 // fin)) // m)
+    k_max = (FOSC_MAX*n31 // fin) // m
+    count = np.maximum(k_max - k_min + 1, 0)
+    end = np.cumsum(count)
+
+    # Lowest N31 (highest phase detector frequency) first, stop at the first
+    # chunk that has a solution.
+    first = 0
+    chunk = _CHUNK[0]
+    while first < len(n31):
+        done = end[first] - count[first]
+        last = max(np.searchsorted(end, done + chunk, side="right"), first + 1)
+        chunk = min(2*chunk, _CHUNK[1])
+        c = count[first:last]
+        i = np.repeat(np.arange(first, last), c)
+        k = k_min[i] + np.arange(len(i)) - (end[i] - count[i] - done)
+        n2 = k*m[i]
+        n1 = fin*n2 // (n31[i]*fout)
+        n2_hs, n1_hs = _split(n2, n1)
+        valid = np.flatnonzero((n2_hs != 0) & (n1_hs != 0))
+        if len(valid):
+            # then lowest fOSC, then largest high speed dividers
+            best = valid[np.lexsort((-n2_hs[valid], -n1_hs[valid],
+                                     n1[valid], n31[i[valid]]))[0]]
+            return [int(n1_hs[best]), int(n1[best] // n1_hs[best]),
+                    int(n2_hs[best]), int(n2[best] // n2_hs[best]),
+                    int(n31[i[best]])]
+        first = last
+    return None
+
+
+def solve(fin, fout, cache_dir=DEFAULT_CACHE_DIR):
+    fin, fout = _hz(fin), _hz(fout)
+    key = "{}:{}".format(fin, fout)
+
+    cache = {}
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "plans.json")
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+    if key in cache:
+        plan = cache[key]
+    else:
+        plan = _solve(fin, fout)
+        if cache_dir is not None:
+            cache[key] = plan
+            os.makedirs(cache_dir, exist_ok=True)
+            # unique, for concurrent batch builds
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, cache_file)
+
+    if plan is None:
+        raise ValueError("no Si5324 frequency plan for {} Hz -> {} Hz"
+                         .format(fin, fout))
+    return Si5324Plan(*plan)
+
+
+def plan_registers(plan):
+    # Register encoding of the dividers, in the order of i2c_sequence()
+    return (plan.N1_HS - 4, plan.NC1_LS - 1,
+            plan.N2_HS - 4, plan.N2_LS - 1, plan.N31 - 1)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3.5
 
-import os, argparse
+import os, sys, argparse
 
 from migen import *
 from migen.build.generic_platform import *
@@ -12,6 +12,17 @@ from misoc.targets.kc705 import _CRG
 
 from sequencer import *
 from i2c import *
+from si5324 import *
+from lockdet import *
+from mempatch import PROGRAM_NAME, PROGRAM_DEPTH, program_constraints
+from buildcache import design_params, cached_build
+from batch import *
+from asm import program_stats
+
+
+# 62.5MHz, see Si5324CRG
+SYS_CLK_FREQ = 62.5e6
+PLL_VCO_FREQ = 1e9
 
 
 class Si5324ClockRouting(Module):
@@ -22,6 +33,9 @@ class Si5324ClockRouting(Module):
         user_sma_clock_p = platform.request("user_sma_clock_p")
         user_sma_clock_n = platform.request("user_sma_clock_n")
 
+        # Si5324 output clock
+        self.clock_domains.cd_clean = ClockDomain(reset_less=True)
+
         self.comb += [
             si5324_reset.eq(~ResetSignal("sys")),
         ]
@@ -37,22 +51,27 @@ class Si5324ClockRouting(Module):
         ]
 
         clean_clk = Signal()
-        clean_clk2 = Signal()
         self.specials += [
             Instance("IBUFDS_GTE2",
                      i_I=si5324_clkout.p, i_IB=si5324_clkout.n,
                      o_O=clean_clk),
             Instance("BUFG",
                      i_I=clean_clk,
-                     o_O=clean_clk2),
+                     o_O=self.cd_clean.clk),
             Instance("OBUF",
-                     i_I=clean_clk2,
+                     i_I=self.cd_clean.clk,
                      o_O=user_sma_clock_p)
         ]
 
 
 class Si5324CRG(Module):
-    def __init__(self, platform):
+    def __init__(self, platform, clk_freq=SYS_CLK_FREQ):
+        # the system clock is also the Si5324 reference
+        divide = PLL_VCO_FREQ/clk_freq
+        if divide != int(divide) or not 1 <= divide <= 128:
+            raise ValueError("no PLL output divider for {:.0f} Hz"
+                             .format(clk_freq))
+
         self.clock_domains.cd_sys = ClockDomain()
         self.clock_domains.cd_clk200 = ClockDomain()
 
@@ -73,10 +92,9 @@ class Si5324CRG(Module):
                      p_CLKFBOUT_MULT=5, p_DIVCLK_DIVIDE=1,
                      i_CLKIN1=clk200_se, i_CLKFBIN=pll_fb, o_CLKFBOUT=pll_fb,
 
-                     # 125MHz
-                     # p_CLKOUT0_DIVIDE=8, p_CLKOUT0_PHASE=0.0, o_CLKOUT0=pll_sys,
-                     # 62.5MHz
-                     p_CLKOUT0_DIVIDE=16, p_CLKOUT0_PHASE=0.0, o_CLKOUT0=pll_sys,
+                     # clk_freq, 62.5MHz by default
+                     p_CLKOUT0_DIVIDE=int(divide), p_CLKOUT0_PHASE=0.0,
+                     o_CLKOUT0=pll_sys,
 
                      # 200MHz
                      p_CLKOUT1_DIVIDE=5, p_CLKOUT1_PHASE=0.0, o_CLKOUT1=pll_clk200,
@@ -85,9 +103,11 @@ class Si5324CRG(Module):
             Instance("BUFG", i_I=pll_clk200, o_O=self.cd_clk200.clk),
         ]
 
-        self.freq = 62.5e6
+        self.freq = clk_freq
 
-        reset_ctr = Signal(32, reset=int(self.freq / 20e3)) # 20ms
+        # ~16us at 200MHz, whatever clk_freq, the sequencer then polls the
+        # Si5324 until it answers instead of waiting for the worst case
+        reset_ctr = Signal(32, reset=int(16e-6*200e6))
         reset = Signal(reset=1)
         self.sync.clk200 += [
             If(reset_ctr != 0,
@@ -101,8 +121,12 @@ class Si5324CRG(Module):
         ]
 
 
+def si5324_test_program(clk_freq, fout):
+    return bringup_program(clk_freq, fout, retries=3)
+
+
 class Si5324Test(Module):
-    def __init__(self, platform):
+    def __init__(self, platform, fout=None, clk_freq=SYS_CLK_FREQ):
         self.platform = platform
         self.platform.add_extension([
             ("i2c_debug", 0, Pins("XADC:GPIO0 XADC:GPIO1"), IOStandard("LVCMOS25")),
@@ -115,10 +139,15 @@ class Si5324Test(Module):
         if isinstance(self.platform.toolchain, XilinxISEToolchain):
             self.platform.toolchain.bitgen_opt += " -g compress"
 
-        self.submodules.crg = Si5324CRG(self.platform)
+        self.submodules.crg = Si5324CRG(self.platform, clk_freq)
         clk_freq = self.crg.freq
 
         self.submodules.si5324_clock_routing = Si5324ClockRouting(self.platform)
+        if fout is None:
+            fout = clk_freq
+        self.submodules.lock_detector = LockDetector(clk_freq, fout)
+        self.comb += self.platform.request("user_led", 0).eq(
+            self.lock_detector.locked)
 
         i2c = self.platform.request("i2c")
         self.submodules.i2c_master = I2CMaster(i2c)
@@ -129,72 +158,81 @@ class Si5324Test(Module):
             i2c_debug[1].eq(self.i2c_master.sda_t.i),
         ]
 
-        # NOTE: the logical parameters DO NOT MAP to physical values written
-        # into registers. They have to be mapped; see the datasheet.
-        # DSPLLsim reports the logical parameters in the design summary, not
-        # the physical register values (but those are present separately).
-        if clk_freq == 125e6:
-            N1_HS  = 1   # 5
-            NC1_LS = 7   # 8
-            N2_HS  = 3   # 7
-            N2_LS  = 359 # 360
-            N31    = 62  # 63
-        elif clk_freq == 62.5e6:
-            N1_HS  = 0   # 4
-            NC1_LS = 19  # 20
-            N2_HS  = 1   # 5
-            N2_LS  = 511 # 512
-            N31    = 31  # 32
-        else:
-            assert False
-
-        i2c_sequence = [
-            # PCA9548: select channel 7
-            [(0x74 << 1), 1 << 7],
-            # Si5324: configure
-            [(0x68 << 1), 2,   0b0010 | (4 << 4)], # BWSEL=4
-            [(0x68 << 1), 3,   0b0101 | 0x10],     # SQ_ICAL=1
-            [(0x68 << 1), 6,            0x07],     # SFOUT1_REG=b111
-            [(0x68 << 1), 25,  (N1_HS  << 5 ) & 0xff],
-            [(0x68 << 1), 31,  (NC1_LS >> 16) & 0xff],
-            [(0x68 << 1), 32,  (NC1_LS >> 8 ) & 0xff],
-            [(0x68 << 1), 33,  (NC1_LS)       & 0xff],
-            [(0x68 << 1), 40,  (N2_HS  << 5 ) & 0xff |
-                               (N2_LS  >> 16) & 0xff],
-            [(0x68 << 1), 41,  (N2_LS  >> 8 ) & 0xff],
-            [(0x68 << 1), 42,  (N2_LS)        & 0xff],
-            [(0x68 << 1), 43,  (N31    >> 16) & 0xff],
-            [(0x68 << 1), 44,  (N31    >> 8)  & 0xff],
-            [(0x68 << 1), 45,  (N31)          & 0xff],
-            [(0x68 << 1), 137,          0x01],     # FASTLOCK=1
-            [(0x68 << 1), 136,          0x40],     # ICAL=1
-        ]
-
-        program = [
-            InstWrite(I2C_CONFIG_ADDR, int(clk_freq / 1e3)),
-        ]
-        for subseq in i2c_sequence:
-            program += [
-                InstWrite(I2C_XFER_ADDR, I2C_START),
-                InstWait(I2C_XFER_ADDR, I2C_IDLE),
-            ]
-            for octet in subseq:
-                program += [
-                    InstWrite(I2C_XFER_ADDR, I2C_WRITE | octet),
-                    InstWait(I2C_XFER_ADDR, I2C_IDLE),
-                ]
-            program += [
-                InstWrite(I2C_XFER_ADDR, I2C_STOP),
-                InstWait(I2C_XFER_ADDR, I2C_IDLE),
-            ]
-        program += [
-            InstEnd(),
+        program = si5324_test_program(clk_freq, fout)
+        # The register mirror tracks the Si5324 from bring-up on, so that
+        # a retune_program() patched in later only writes what changes.
+        self.submodules.sequencer = Sequencer(program, self.i2c_master.bus,
+                                              depth=PROGRAM_DEPTH,
+                                              name=PROGRAM_NAME,
+                                              mirror=SI5324_DEFAULTS,
+                                              mirror_dev=0x68 << 1)
+        # Keep the program in a known block RAM for mempatch.py
+        if isinstance(self.platform.toolchain, XilinxVivadoToolchain):
+            self.platform.add_platform_command(program_constraints())
+        self.comb += [
+            self.sequencer.events[0].eq(self.i2c_master.idle),
+            self.sequencer.events[1].eq(self.lock_detector.locked),
+            # bring-up failed
+            self.platform.request("user_led", 1).eq(self.sequencer.timeout),
         ]
-        self.submodules.sequencer = Sequencer(program, self.i2c_master.bus)
 
 
-if __name__ == "__main__":
+# Builds the variant into build_dir, for run_batch()
+def build_variant(variant, build_dir, run=True, cache=True):
+    clk_freq, fout = variant
     platform = kc705.Platform()
-    top = Si5324Test(platform)
-    platform.build(top, build_dir="/tmp/si5324_test")
+    program = si5324_test_program(clk_freq, fout)
+    row = program_stats(program, clk_freq=clk_freq)
+    if not cache:
+        platform.build(Si5324Test(platform, fout, clk_freq),
+                       build_dir=build_dir, run=run)
+        row["sources"] = "elaborated"
+        row["bitstream"] = "built" if run else "not built"
+        return row
+    params = design_params(clk_freq, fout, program, device=platform.device)
+    result = cached_build(platform,
+                          lambda: Si5324Test(platform, fout, clk_freq),
+                          params, build_dir, run=run)
+    row["sources"] = "elaborated" if result.elaborated else "cached"
+    row["bitstream"] = ("built" if result.built else
+                        "cached" if run else "not built")
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Si5324 test design")
+    parser.add_argument("--fout", type=float, default=SYS_CLK_FREQ,
+                        help="Si5324 output frequency (default: %(default)s)")
+    parser.add_argument("--build-dir", default="/tmp/si5324_test",
+                        help="build directory, or parent of the variant "
+                             "directories (default: %(default)s)")
+    parser.add_argument("--no-compile", action="store_true",
+                        help="only generate the sources")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always elaborate and run the toolchain")
+    parser.add_argument("--variant", action="append", default=[],
+                        metavar="FIN:FOUT",
+                        help="build this reference/output frequency variant "
+                             "instead, in a process pool (repeatable)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="variants built in parallel (default: cores)")
+    args = parser.parse_args()
+
+    kwargs = dict(run=not args.no_compile, cache=not args.no_cache)
+    if args.variant:
+        try:
+            variants = [parse_variant(text) for text in args.variant]
+        except ValueError as e:
+            parser.error(str(e))
+        rows = run_batch(build_variant, variants, args.build_dir,
+                         args.jobs, **kwargs)
+        print(format_summary(rows))
+        if any("error" in row for row in rows):
+            sys.exit(1)
+        return
+    row = build_variant((SYS_CLK_FREQ, args.fout), args.build_dir, **kwargs)
+    print("sources {}, bitstream {}".format(row["sources"], row["bitstream"]))
 
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import unittest
+
+from migen import Memory
+
+from sequencer import *
+from sequencer import encode_program, pack_program
+from i2c import *
+from si5324 import *
+from asm import *
+from model import SystemModel
+
+
+def _registers(program):
+    # register values written by a program, per device
+    registers = {}
+    for inst in program:
+        if isinstance(inst, InstI2CWrite):
+            for i, octet in enumerate(inst.data):
+                registers[(inst.dev, inst.reg + i)] = octet
+    return registers
+
+
+class TestAsm(unittest.TestCase):
+    def programs(self):
+        return [
+            bringup_program(62.5e6),
+            retune_program(62.5e6, 125e6, snapshot=True),
+        ]
+
+    def retry_program(self):
+        return i2c_retry("select", [
+            InstI2CWrite(I2C_FIFO_ADDR, 0xe8, 0x80, []),
+            InstCall("ical"),
+        ], 3, 1000, "fail") + [
+            InstEnd(),
+            Label("fail"),
+            InstAbort(),
+            Label("ical"),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 136, [0x40]),
+            InstReturn(),
+        ]
+
+    def test_text(self):
+        for program in self.programs() + [self.retry_program()]:
+            text = format_program(program)
+            self.assertEqual(parse_program(text), program)
+        self.assertEqual(parse_program("""
+            # comment
+            write 0x1, 4  # divider
+            i2c_write 2, 0xe8, 0x80,
+            i2c_write 2, 0xd0, 0x88, 0x40
+            end
+        """), [
+            InstWrite(I2C_CONFIG_ADDR, 4),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xe8, 0x80, []),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 0x88, [0x40]),
+            InstEnd(),
+        ])
+        with self.assertRaises(ValueError):
+            parse_program("goto 0")
+        with self.assertRaises(ValueError):
+            parse_program("wait 2")
+
+    def test_decode(self):
+        for program in self.programs():
+            words = encode_program(program)
+            self.assertEqual(decode_program(words), program)
+            self.assertEqual(decode_program(pack_program(program)), program)
+            mem = Memory(32, 64, init=words)
+            self.assertEqual(decode_program(mem), program)
+        with self.assertRaises(ValueError):
+            decode_program([0x90000000])
+        program = self.retry_program()
+        words = encode_program(program)
+        decoded = decode_program(words)
+        self.assertEqual(encode_program(decoded), words)
+        self.assertEqual(len(decoded), len(program) - 4)
+
+    def test_optimize(self):
+        # one frame per register, each behind a channel select and followed
+        # by a wait
+        naive = [InstWrite(I2C_CONFIG_ADDR, 4)]
+        for dev, reg, *data in i2c_sequence(0, 19, 1, 511, 31,
+                                            compile=False)[1:]:
+            naive += [
+                InstI2CWrite(I2C_FIFO_ADDR, 0x74 << 1, 1 << 7, []),
+                InstI2CWrite(I2C_FIFO_ADDR, dev, reg, data),
+                InstWait(I2C_FIFO_ADDR, I2C_IDLE),
+            ]
+        naive += [InstEnd()]
+        optimized = optimize(naive)
+        self.assertEqual(optimized[:2], [
+            InstWrite(I2C_CONFIG_ADDR, 4),
+            InstI2CWrite(I2C_FIFO_ADDR, 0x74 << 1, 1 << 7, []),
+        ])
+        self.assertEqual(optimized[-2:], [
+            InstWait(I2C_FIFO_ADDR, I2C_IDLE),
+            InstEnd(),
+        ])
+        self.assertEqual(_registers(optimized), _registers(naive))
+        # ICAL is still written last
+        self.assertEqual(optimized[-3].reg, 136)
+
+        before = program_stats(naive)
+        after = program_stats(optimized)
+        self.assertLess(4*after["instructions"], before["instructions"])
+        self.assertLess(2*after["rom_bits"], before["rom_bits"])
+        self.assertLess(2*after["cycles"], before["cycles"])
+        self.assertEqual(len(optimize_report(naive, optimized).splitlines()),
+                         2)
+
+    def test_optimize_keep(self):
+        program = [
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 1, [0x01]),
+            # the divider is changed once the frame is sent
+            InstWait(I2C_FIFO_ADDR, I2C_IDLE),
+            InstWrite(I2C_CONFIG_ADDR, 5),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 2, [0x02]),
+            # the switch may have been reset by the write
+            InstI2CWrite(I2C_FIFO_ADDR, 0xe8, 0x80, []),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xe8, 0x40, [0x00]),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xe8, 0x80, []),
+            InstEnd(),
+        ]
+        self.assertEqual(optimize(program), program)
+        self.assertEqual(optimize(self.programs()[0]), self.programs()[0])
+        # the switch select in the retry loop is kept
+        self.assertEqual(optimize(self.retry_program()), self.retry_program())
+        with self.assertRaises(ValueError):
+            optimize(decode_program(encode_program(self.retry_program())))
+
+    def test_program_stats(self):
+        program = bringup_program(62.5e6, retries=3)
+        stats = program_stats(program, clk_freq=62.5e6)
+        self.assertEqual(stats["words"], len(encode_program(program)))
+        self.assertEqual(stats["cycles"], SystemModel(program).run())
+        self.assertEqual(stats["time"], stats["cycles"]/62.5e6)
+        self.assertNotIn("time", program_stats(program))
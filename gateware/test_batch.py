@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from migen.build.platforms import kc705
+
+from si5324 import bringup_program
+from asm import program_stats
+from batch import *
+from test_buildcache import _Blinker
+
+
+def _build(variant, build_dir, width=24):
+    program = bringup_program(*variant)
+    row = program_stats(program, clk_freq=variant.clk_freq)
+    platform = kc705.Platform()
+    platform.build(_Blinker(platform, width), build_dir=build_dir, run=False)
+    row["sources"] = "elaborated"
+    row["bitstream"] = "not built"
+    row["pid"] = os.getpid()
+    return row
+
+
+def _failing_build(variant, build_dir):
+    if variant.fout == 125e6:
+        raise OSError("toolchain not found")
+    return {"pid": os.getpid()}
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_variant(self):
+        variant = parse_variant("62.5e6:125e6")
+        self.assertEqual(variant, (62.5e6, 125e6))
+        self.assertEqual(variant_name(variant), "62500000_125000000")
+        with self.assertRaises(ValueError):
+            parse_variant("62.5e6")
+
+    def test_batch(self):
+        variants = [(62.5e6, 62.5e6), (62.5e6, 125e6), (62.5e6, 1)]
+        rows = run_batch(_build, variants, self.tmp, processes=2, width=20)
+        self.assertEqual([row["name"] for row in rows],
+                         [variant_name(variant) for variant in variants])
+        for row in rows[:2]:
+            self.assertNotIn("error", row)
+            self.assertNotEqual(row["pid"], os.getpid())
+            with open(os.path.join(row["build_dir"], "top.v")) as f:
+                self.assertIn("[19:0]", f.read())
+        self.assertIn("no Si5324 frequency plan", rows[2]["error"])
+        self.assertFalse(os.path.exists(rows[2]["build_dir"]))
+
+        lines = format_summary(rows).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0].split()[:3], ["variant", "ROM", "words"])
+        self.assertEqual(lines[1].split()[:2],
+                         ["62500000_62500000", str(rows[0]["words"])])
+        self.assertIn("error: no Si5324 frequency plan", lines[3])
+
+        with self.assertRaises(ValueError):
+            run_batch(_build, variants[:1]*2, self.tmp)
+
+    def test_failed_build(self):
+        variants = [(62.5e6, 125e6), (62.5e6, 62.5e6)]
+        rows = run_batch(_failing_build, variants, self.tmp, processes=2)
+        self.assertEqual(rows[0]["error"], "toolchain not found")
+        self.assertNotIn("error", rows[1])
@@ -0,0 +1,40 @@
+import json
+import unittest
+
+from si5324 import *
+from model import SystemModel
+from i2c_sim import with_divider
+from bench import *
+
+
+class TestBench(unittest.TestCase):
+    def test_bringup(self):
+        clk_freq = 62.5e6
+        program = bringup_program(clk_freq)
+        result = run_benchmark(program, clk_freq, divider=3)
+        self.assertTrue(result["registers_ok"])
+        self.assertFalse(result["timeout"])
+        # including the ready and lock polls, a write and a read frame each
+        self.assertEqual(result["frames"], 8 + 4)
+        self.assertEqual(result["octets"], 26 + 6)
+        self.assertEqual(result["bus_writes"], 2 + 26 + 2*4)
+        self.assertGreater(result["bus_reads"], 0)
+        self.assertEqual(result["cycles"],
+                         SystemModel(with_divider(program, 3)).run())
+        self.assertEqual(result["model_cycles"], SystemModel(program).run())
+        json.dumps(result)
+
+    def test_fout(self):
+        clk_freq = 62.5e6
+        program = bringup_program(clk_freq, 2*clk_freq)
+        result = run_benchmark(program, clk_freq, divider=3, fout=2*clk_freq)
+        self.assertTrue(result["registers_ok"])
+        # checked against the plan for fout
+        result = run_benchmark(program, clk_freq, divider=3)
+        self.assertFalse(result["registers_ok"])
+
+    def test_compare(self):
+        old = {"benchmarks": {"a": {"cycles": 100, "registers_ok": True}}}
+        new = {"benchmarks": {"a": {"cycles": 90, "registers_ok": True},
+                              "b": {"cycles": 10}}}
+        self.assertEqual(compare(old, new), ["a.cycles: 100 -> 90 (-10.0%)"])
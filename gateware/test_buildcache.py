@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from migen import *
+from migen.build.platforms import kc705
+
+from si5324 import bringup_program
+from buildcache import *
+
+
+class _Blinker(Module):
+    def __init__(self, platform, width):
+        counter = Signal(width)
+        self.sync += counter.eq(counter + 1)
+        self.comb += platform.request("user_led", 0).eq(counter[-1])
+
+
+class TestBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = BuildCache(os.path.join(self.tmp, "cache"))
+        self.elaborations = 0
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def toolchain(self, build_dir, build_name):
+        self.builds += 1
+        with open(os.path.join(build_dir, build_name + ".v")) as f:
+            verilog = f.read()
+        with open(os.path.join(build_dir, build_name + ".bit"), "w") as f:
+            f.write(verilog[::-1])
+
+    def build(self, params, build_dir, width=24, run=True):
+        platform = kc705.Platform()
+
+        def elaborate():
+            self.elaborations += 1
+            return _Blinker(platform, width)
+
+        return cached_build(platform, elaborate, params,
+                            os.path.join(self.tmp, build_dir), run=run,
+                            cache=self.cache, toolchain=self.toolchain)
+
+    def read(self, build_dir, name):
+        with open(os.path.join(self.tmp, build_dir, name)) as f:
+            return f.read()
+
+    def test_key(self):
+        program = bringup_program(62.5e6)
+        params = design_params(62.5e6, 62.5e6, program)
+        self.assertEqual(design_key(params),
+                         design_key(design_params(62.5e6, 62.5e6, program)))
+        for other in [
+            design_params(62.5e6, 125e6, program),
+            design_params(62.5e6, 62.5e6, program[1:]),
+            design_params(62.5e6, 62.5e6, program, device="xc7k160t"),
+        ]:
+            self.assertNotEqual(design_key(other), design_key(params))
+        self.assertNotEqual(design_key(params, digest=""),
+                            design_key(params))
+
+    def test_sources(self):
+        first = self.build({"width": 24}, "a")
+        self.assertEqual((first.elaborated, first.built), (True, True))
+        second = self.build({"width": 24}, "b")
+        self.assertEqual((second.elaborated, second.built), (False, False))
+        self.assertEqual(self.elaborations, 1)
+        self.assertEqual(self.builds, 1)
+        for name in "top.v", "top.xdc", "top.tcl", "top.bit":
+            self.assertEqual(self.read("a", name), self.read("b", name))
+
+        # different sources
+        third = self.build({"width": 25}, "b", width=25)
+        self.assertEqual((third.elaborated, third.built), (True, True))
+        self.assertNotEqual(third.output_key, first.output_key)
+        self.assertNotEqual(self.read("a", "top.bit"),
+                            self.read("b", "top.bit"))
+
+    def test_outputs(self):
+        first = self.build({"width": 24}, "a")
+        # the parameter does not change the design
+        second = self.build({"width": 24, "comment": "rebuild"}, "a")
+        self.assertEqual((second.elaborated, second.built), (True, False))
+        self.assertEqual(second.output_key, first.output_key)
+        self.assertEqual(self.builds, 1)
+
+        sources = self.build({"width": 26}, "c", width=26, run=False)
+        self.assertEqual(sources.built, False)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "c",
+                                                     "top.bit")))
+
+    def test_build_dir(self):
+        build_dir = os.path.join(self.tmp, "d")
+        os.makedirs(build_dir)
+        for name in "keep.py", "top.bit", "old.init":
+            with open(os.path.join(build_dir, name), "w") as f:
+                f.write(name)
+        result = self.build({"width": 24}, "d", run=False)
+        self.assertTrue(result.elaborated)
+        # only the files of the previous build are replaced
+        self.assertEqual(self.read("d", "keep.py"), "keep.py")
+        self.assertFalse(os.path.exists(os.path.join(build_dir, "top.bit")))
+        self.assertFalse(os.path.exists(os.path.join(build_dir, "old.init")))
+        self.assertTrue(os.path.exists(os.path.join(build_dir, "top.v")))
+        # and do not end up in the cache
+        self.build({"width": 24}, "e", run=False)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "e",
+                                                     "keep.py")))
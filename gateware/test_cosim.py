@@ -0,0 +1,83 @@
+import unittest
+
+from migen import *
+
+from sequencer import *
+from i2c import *
+from i2c_sim import *
+from si5324 import *
+from model import SystemModel
+from cosim import *
+from cosim import _Design
+
+
+class _Counter(Module):
+    def __init__(self):
+        self.enable = Signal()
+        self.count = Signal(8, reset=5)
+        self.wide = Signal(72)
+        self.sync += [
+            If(self.enable, self.count.eq(self.count + 1)),
+            self.wide.eq(self.wide + 1),
+        ]
+
+
+class _Adder(Module):
+    def __init__(self, k):
+        self.i = Signal(8)
+        self.o = Signal(8)
+        self.sync += self.o.eq(self.i + k)
+
+
+class TestCosim(OpenDrainMixin, unittest.TestCase):
+    def test_design(self):
+        dut = _Counter()
+        design = _Design(dut)
+        self.assertIn(dut.enable, design.inputs)
+        self.assertNotIn(dut.count, design.inputs)
+        self.assertIn(dut.count, design.ids)
+        # too wide for the harness
+        self.assertNotIn(dut.wide, design.ids)
+        self.assertIn("output [7:0] probe", design.sources["top.v"])
+        with self.assertRaises(ValueError):
+            run_simulation(dut, [], backend="vhdl")
+
+    def test_key(self):
+        key = _Design(_Adder(5)).key(False)
+        # the same design elaborated again
+        self.assertEqual(_Design(_Adder(5)).key(False), key)
+        # designs differing only by a constant
+        self.assertNotEqual(_Design(_Adder(7)).key(False), key)
+        self.assertNotEqual(_Design(_Adder(5)).key(True), key)
+
+    def run_program(self, program, backend):
+        dut = I2CSequencerSystem(program)
+        frames = []
+        result = {}
+
+        def gen():
+            n = 0
+            while (yield dut.sequencer.running):
+                n += 1
+                yield
+            result["cycles"] = n
+            result["retired"] = yield from dut.sequencer.ctrl.read(
+                SEQ_RETIRED_ADDR)
+
+        run_simulation(dut, [gen(), dut.devices(frames)], backend=backend)
+        result["frames"] = frames
+        result["registers"] = dut.si5324.registers
+        return result
+
+    @unittest.skipUnless(verilator_available(), "verilator not found")
+    def test_equivalence(self):
+        program = with_divider(bringup_program(62.5e6, lock=False), 4)
+        self.assertEqual(self.run_program(program, "verilator"),
+                         self.run_program(program, "migen"))
+
+    @unittest.skipUnless(verilator_available(), "verilator not found")
+    def test_bringup(self):
+        # The full bring-up at the real SCL rate
+        program = bringup_program(62.5e6)
+        result = self.run_program(program, "verilator")
+        self.assertEqual(result["cycles"], SystemModel(program).run())
@@ -0,0 +1,265 @@
+import unittest
+
+from migen import *
+
+from i2c import *
+from i2c_sim import *
+
+
+class TestI2CMaster(OpenDrainMixin, unittest.TestCase):
+    def run_fifo(self, octets, fifo_depth=4):
+        pads = I2CPads()
+        dut = I2CMaster(pads, fifo_depth=fifo_depth)
+        frames = []
+        status = []
+
+        def gen():
+            yield from dut.bus.write(I2C_CONFIG_ADDR, 1)
+            for octet in octets:
+                yield from dut.bus.write(I2C_FIFO_ADDR, octet)
+            while True:
+                r = yield from dut.bus.read(I2C_FIFO_ADDR)
+                if r & I2C_IDLE:
+                    break
+            status.append(r)
+
+        devices = i2c_ack_slave(dut, pads, ack_address(0x68), frames)
+        run_simulation(dut, [gen(), devices])
+        return frames, status[0]
+
+    def test_frames(self):
+        frames, status = self.run_fifo([
+            I2C_START | 0xd0, 0x01, I2C_STOP | 0x02,
+            I2C_START | 0xd0, 0x03, 0x04, 0x05, 0x06, I2C_STOP | 0x07,
+        ])
+        self.assertEqual(frames, [[0xd0, 0x01, 0x02],
+                                  [0xd0, 0x03, 0x04, 0x05, 0x06, 0x07]])
+        self.assertFalse(status & I2C_ERROR)
+        self.assertFalse(status & I2C_FULL)
+        self.assertEqual(status >> 16, 0)
+
+    def test_nack(self):
+        frames, status = self.run_fifo([
+            I2C_START | 0xe8, 0x01, I2C_STOP | 0x02,
+            I2C_START | 0xd0, I2C_STOP | 0x03,
+        ])
+        # the NACKed frame is aborted after its address
+        self.assertEqual(frames, [[0xe8], [0xd0, 0x03]])
+        self.assertTrue(status & I2C_ERROR)
+
+    def test_read(self):
+        pads = I2CPads()
+        dut = I2CMaster(pads)
+        device = I2CRegisterDevice({0x10: 0xa5, 0x11: 0x3c, 0x82: 0x01})
+        reads = []
+
+        def gen():
+            yield from dut.bus.write(I2C_CONFIG_ADDR, 1)
+            for reg, n in [(0x10, 1), (0x11, 1), (0x82, 1), (0x10, 2)]:
+                for word in [I2C_START | 0xd0, reg, I2C_START | 0xd1]:
+                    yield from dut.bus.write(I2C_FIFO_ADDR, word)
+                # all but the last octet are ACKed
+                for word in [I2C_READ]*(n - 1) + [I2C_READ | I2C_STOP]:
+                    yield from dut.bus.write(I2C_FIFO_ADDR, word)
+                while True:
+                    r = yield from dut.bus.read(I2C_FIFO_ADDR)
+                    if r & I2C_IDLE:
+                        break
+                reads.append(r)
+
+        run_simulation(dut, [gen(), i2c_devices(dut, pads, {0x68: device})])
+        self.assertEqual([r & 0xff for r in reads], [0xa5, 0x3c, 0x01, 0x3c])
+        self.assertFalse(any(r & I2C_ERROR for r in reads))
+        self.assertEqual(device.reads, 5)
+
+    def test_counters(self):
+        pads = I2CPads()
+        dut = I2CMaster(pads)
+        frames = []
+        counters = {}
+        busy = []
+
+        @passive
+        def monitor():
+            n = 0
+            while True:
+                n += not (yield dut.i2c.idle)
+                busy[:] = [n]
+                yield
+
+        def gen():
+            yield from dut.bus.write(I2C_CONFIG_ADDR, 1)
+            for octet in [I2C_START | 0xe8, 0x01, I2C_STOP | 0x02,
+                          I2C_START | 0xd0, 0x03, I2C_STOP | 0x04]:
+                yield from dut.bus.write(I2C_FIFO_ADDR, octet)
+            polls = 0
+            while True:
+                polls += 1
+                if (yield from dut.bus.read(I2C_FIFO_ADDR)) & I2C_IDLE:
+                    break
+            for address in (I2C_OCTETS_ADDR, I2C_NACKS_ADDR,
+                            I2C_BUSY_CYCLES_ADDR, I2C_POLLS_ADDR):
+                counters[address] = yield from dut.bus.read(address)
+            self.assertEqual(counters[I2C_POLLS_ADDR], polls)
+            self.assertEqual(counters[I2C_BUSY_CYCLES_ADDR], busy[0])
+            yield from dut.bus.write(I2C_OCTETS_ADDR, 0)
+            self.assertEqual((yield from dut.bus.read(I2C_OCTETS_ADDR)), 0)
+
+        devices = i2c_ack_slave(dut, pads, ack_address(0x68), frames)
+        run_simulation(dut, [gen(), monitor(), devices])
+        self.assertEqual(frames, [[0xe8], [0xd0, 0x03, 0x04]])
+        self.assertEqual(counters[I2C_OCTETS_ADDR], 4)
+        self.assertEqual(counters[I2C_NACKS_ADDR], 1)
+        self.assertGreater(counters[I2C_BUSY_CYCLES_ADDR], 4*9*2*2)
+
+    def run_accesses(self, pipelined):
+        pads = I2CPads()
+        dut = I2CMaster(pads, fifo_depth=4, pipelined=pipelined)
+        bus = dut.bus
+        frames = []
+        cycles = {}
+
+        cycle = [0]
+
+        @passive
+        def clock():
+            while True:
+                cycle[0] += 1
+                yield
+
+        def timed(transaction):
+            start = cycle[0]
+            yield from transaction
+            return cycle[0] - start
+
+        def burst(words):
+            # cyc and stb stay asserted from one access to the next
+            yield bus.cyc.eq(1)
+            yield bus.stb.eq(1)
+            yield bus.we.eq(1)
+            yield bus.adr.eq(I2C_FIFO_ADDR)
+            for word in words:
+                yield bus.dat_w.eq(word)
+                yield
+                while not (yield bus.ack):
+                    yield
+            yield bus.cyc.eq(0)
+            yield bus.stb.eq(0)
+
+        def gen():
+            yield from bus.write(I2C_CONFIG_ADDR, 1)
+            cycles["write"] = yield from timed(bus.write(I2C_HOLD_ADDR, 1))
+            cycles["read"] = yield from timed(bus.read(I2C_CONFIG_ADDR))
+            cycles["burst"] = yield from timed(burst([
+                I2C_START | 0xd0, 0x01, 0x02, I2C_STOP | 0x03]))
+            # the FIFO is full until the first octet is sent
+            cycles["full"] = yield from timed(burst([I2C_START | 0xd0,
+                                                     I2C_STOP | 0x04]))
+            while not (yield from bus.read(I2C_FIFO_ADDR)) & I2C_IDLE:
+                pass
+            # the status is up to date right after a command
+            yield from bus.write(I2C_XFER_ADDR, I2C_START)
+            cycles["idle"] = (yield from bus.read(I2C_XFER_ADDR)) & I2C_IDLE
+            while not (yield from bus.read(I2C_XFER_ADDR)) & I2C_IDLE:
+                pass
+            yield from bus.write(I2C_XFER_ADDR, I2C_STOP)
+            while not (yield from bus.read(I2C_XFER_ADDR)) & I2C_IDLE:
+                pass
+
+        devices = i2c_ack_slave(dut, pads, ack_address(0x68), frames)
+        run_simulation(dut, [gen(), clock(), devices])
+        self.assertEqual(frames, [[0xd0, 0x01, 0x02, 0x03], [0xd0, 0x04]])
+        self.assertFalse(cycles.pop("idle"))
+        return cycles
+
+    def test_pipelined(self):
+        classic = self.run_accesses(False)
+        pipelined = self.run_accesses(True)
+        self.assertEqual(classic["write"], 2)
+        self.assertEqual(classic["read"], 2)
+        self.assertEqual(classic["burst"], 2*4)
+        # acked in the cycle of the request
+        self.assertEqual(pipelined["write"], 1)
+        self.assertEqual(pipelined["read"], 1)
+        self.assertEqual(pipelined["burst"], 4)
+        self.assertGreater(pipelined["full"], 2)
+
+    def run_stretch(self, clock_stretching, stretch=12, div=1, hold=1):
+        pads = I2CPads()
+        dut = I2CMaster(pads, clock_stretching=clock_stretching)
+        frames = []
+        phases = {"low": [], "high": [], "hold": []}
+
+        @passive
+        def slave():
+            # holds SCL low for a while after every falling edge
+            scl_p = 1
+            while True:
+                scl = yield dut.scl_t.i
+                if scl_p and not scl:
+                    yield pads.scl.eq(0)
+                    for _ in range(stretch):
+                        yield
+                    yield pads.scl.eq(1)
+                scl_p = scl
+                yield
+
+        @passive
+        def monitor():
+            scl_p, sda_oe_p = 1, 0
+            n = fall = 0
+            while True:
+                scl = yield dut.scl_t.i
+                sda_oe = yield dut.sda_t.oe
+                if scl != scl_p:
+                    phases["high" if scl_p else "low"].append(n)
+                    n = 0
+                    if not scl:
+                        fall = 0
+                if not scl and sda_oe != sda_oe_p:
+                    phases["hold"].append(fall)
+                n += 1
+                fall += 1
+                scl_p, sda_oe_p = scl, sda_oe
+                yield
+
+        def gen():
+            yield from dut.bus.write(I2C_CONFIG_ADDR, div)
+            yield from dut.bus.write(I2C_HOLD_ADDR, hold)
+            for octet in [I2C_START | 0xd0, 0x01, I2C_STOP | 0x02]:
+                yield from dut.bus.write(I2C_FIFO_ADDR, octet)
+            while not (yield from dut.bus.read(I2C_FIFO_ADDR)) & I2C_IDLE:
+                pass
+
+        devices = i2c_ack_slave(dut, pads, ack_address(0x68), frames)
+        run_simulation(dut, [gen(), slave(), monitor(), devices])
+        return frames, phases
+
+    def test_clock_stretching(self):
+        frames, phases = self.run_stretch(True)
+        self.assertEqual(frames, [[0xd0, 0x01, 0x02]])
+        self.assertGreaterEqual(min(phases["low"]), 12)
+        # the high phase, div + 1 cycles, is counted from when SCL actually
+        # rose and went through the synchronizer
+        self.assertEqual(min(phases["high"]), 2 + 2)
+
+        frames, phases = self.run_stretch(False)
+        self.assertNotEqual(frames, [[0xd0, 0x01, 0x02]])
+
+    def test_hold(self):
+        frames, phases = self.run_stretch(True, stretch=0, div=7, hold=3)
+        self.assertEqual(frames, [[0xd0, 0x01, 0x02]])
+        self.assertEqual(min(phases["hold"]), 3)
+
+    def test_divider(self):
+        clk_freq = 62.5e6
+        for mode, timing in I2C_TIMINGS.items():
+            div = i2c_divider(clk_freq, mode)
+            hold = i2c_hold(clk_freq, mode)
+            half = (div + 1)/clk_freq
+            self.assertLessEqual(1/(2*half), timing.scl_freq)
+            self.assertGreaterEqual(half, timing.t_low)
+            self.assertGreaterEqual(half - hold/clk_freq, timing.t_su_dat)
+            self.assertGreaterEqual(hold/clk_freq, timing.t_hd_dat)
+        self.assertEqual(i2c_divider(clk_freq, "fast"), 81)
+        self.assertEqual(i2c_divider(clk_freq, "fast_plus"), 31)
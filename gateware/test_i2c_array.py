@@ -0,0 +1,107 @@
+import unittest
+
+from migen import *
+
+from sequencer import *
+from sequencer import encode
+from i2c import *
+from i2c_array import *
+from i2c_sim import *
+from si5324 import *
+from si5324_plan import *
+
+
+class _TestSystem(Module):
+    def __init__(self, programs):
+        self.pads = [I2CPads() for _ in programs]
+        self.submodules.array = I2CMasterArray(self.pads, programs)
+        self.switches = [I2CSwitch() for _ in programs]
+        self.si5324s = [I2CRegisterDevice(SI5324_DEFAULTS) for _ in programs]
+
+    def devices(self):
+        return [i2c_devices(master, pads, {0x74: switch, 0x68: si5324})
+                for master, pads, switch, si5324 in zip(
+                    self.array.masters, self.pads, self.switches,
+                    self.si5324s)]
+
+
+class TestI2CMasterArray(OpenDrainMixin, unittest.TestCase):
+    def run_array(self, programs):
+        dut = _TestSystem(programs)
+        cycles = []
+
+        def gen():
+            n = 0
+            while (yield dut.array.running):
+                n += 1
+                yield
+            cycles.append(n)
+
+        run_simulation(dut, [gen()] + dut.devices())
+        return dut, cycles[0]
+
+    def test_concurrent(self):
+        clk_freq = 62.5e6
+        fouts = [clk_freq, 2*clk_freq, clk_freq/2]
+        programs = [with_divider(bringup_program(clk_freq, fout, lock=False),
+                                 4)
+                    for fout in fouts]
+        _, cycles_one = self.run_array(programs[:1])
+        dut, cycles = self.run_array(programs)
+        # the buses only differ in the divider values
+        self.assertLess(cycles, 1.1*cycles_one)
+        for fout, switch, si5324 in zip(fouts, dut.switches, dut.si5324s):
+            self.assertEqual(switch.control, 1 << 7)
+            for phase in si5324_registers(
+                    *plan_registers(solve(clk_freq, fout))):
+                for reg, value in phase.items():
+                    self.assertEqual(si5324.registers[reg], value)
+
+    def test_ctrl(self):
+        programs = [
+            [InstWrite(I2C_CONFIG_ADDR, 10 + i), InstEnd()]
+            for i in range(2)
+        ]
+        dut = _TestSystem(programs)
+        ctrl = dut.array.ctrl
+        result = {}
+
+        def gen():
+            while (yield dut.array.running):
+                yield
+            result["status"] = yield from ctrl.read(2*ARRAY_STRIDE)
+            result["retired"] = yield from ctrl.read(
+                ARRAY_STRIDE + SEQ_RETIRED_ADDR)
+            yield from ctrl.write(ARRAY_STRIDE + SEQ_PROGRAM_BASE,
+                                  encode(InstWrite(I2C_CONFIG_ADDR, 20))[0])
+            yield from ctrl.write(2*ARRAY_STRIDE, SEQ_START)
+            result["running"] = yield from ctrl.read(2*ARRAY_STRIDE)
+            while (yield dut.array.running):
+                yield
+            result["loads"] = []
+            for master in dut.array.masters:
+                result["loads"].append((yield master.i2c.cg.load))
+
+        run_simulation(dut, gen())
+        self.assertEqual(result["status"], SEQ_DONE)
+        self.assertEqual(result["retired"], 2)
+        self.assertEqual(result["running"], SEQ_RUNNING)
+        self.assertEqual(result["loads"], [10, 20])
+
+    def test_timeout(self):
+        programs = [
+            [InstWrite(I2C_CONFIG_ADDR, 10), InstEnd()],
+            [InstWrite(I2C_CONFIG_ADDR, 11), InstAbort()],
+        ]
+        dut = _TestSystem(programs)
+        result = {}
+
+        def gen():
+            while (yield dut.array.running):
+                yield
+            result["done"] = yield dut.array.done
+            result["status"] = yield from dut.array.ctrl.read(2*ARRAY_STRIDE)
+
+        run_simulation(dut, gen())
+        self.assertFalse(result["done"])
+        self.assertEqual(result["status"], SEQ_TIMEOUT)
@@ -0,0 +1,166 @@
+import unittest
+
+from migen import *
+
+from sequencer import *
+from i2c import *
+from i2c_capture import *
+from i2c_sim import *
+from si5324 import SI5324_DEFAULTS
+
+
+class _TestSystem(Module):
+    def __init__(self, depth=256):
+        self.pads = I2CPads()
+        self.submodules.master = I2CMaster(self.pads)
+        self.submodules.capture = I2CCapture(self.master, depth)
+        # with the device identification
+        self.registers = dict(SI5324_DEFAULTS)
+        self.registers.update({134: 0x01, 135: 0x82})
+        self.si5324 = I2CRegisterDevice(self.registers)
+
+    def devices(self, frames=None):
+        return i2c_devices(self.master, self.pads, {0x68: self.si5324},
+                           frames)
+
+
+def _capture(ctrl, dev, reg, count):
+    yield from ctrl.write(CAPTURE_DEV_ADDR, dev)
+    yield from ctrl.write(CAPTURE_REG_ADDR, reg)
+    yield from ctrl.write(CAPTURE_COUNT_ADDR, count)
+    yield from ctrl.write(CAPTURE_CTRL_ADDR, CAPTURE_START)
+    cycles = 0
+    while (yield from ctrl.read(CAPTURE_CTRL_ADDR)) & CAPTURE_BUSY:
+        cycles += 1
+    status = yield from ctrl.read(CAPTURE_CTRL_ADDR)
+    data = []
+    for i in range((count + 3)//4):
+        word = yield from ctrl.read(CAPTURE_DATA_BASE + i)
+        data += [(word >> 8*j) & 0xff for j in range(4)]
+    return status, data[:count]
+
+
+class TestI2CCapture(OpenDrainMixin, unittest.TestCase):
+    def test_capture(self):
+        dut = _TestSystem()
+        frames = []
+        result = {}
+
+        def gen():
+            yield from dut.capture.bus.write(I2C_CONFIG_ADDR, 4)
+            result["first"] = yield from _capture(dut.capture.ctrl,
+                                                  0x68 << 1, 0, 144)
+            result["second"] = yield from _capture(dut.capture.ctrl,
+                                                   0x68 << 1, 134, 2)
+
+        run_simulation(dut, [gen(), dut.devices(frames)])
+        status, data = result["first"]
+        self.assertEqual(status, CAPTURE_DONE | (144 << 8))
+        self.assertEqual(data, [dut.registers.get(reg, 0)
+                                for reg in range(144)])
+        self.assertEqual(result["second"][1], [0x01, 0x82])
+        # the register address, then all the reads after a repeated START
+        self.assertEqual(frames, [[0x68 << 1, 0], [(0x68 << 1) | 1],
+                                  [0x68 << 1, 134], [(0x68 << 1) | 1]])
+        self.assertEqual(dut.si5324.reads, 146)
+
+    def test_nack(self):
+        dut = _TestSystem()
+        result = {}
+
+        def gen():
+            bus = dut.capture.bus
+            yield from bus.write(I2C_CONFIG_ADDR, 4)
+            result["capture"] = yield from _capture(dut.capture.ctrl,
+                                                    0x69 << 1, 0, 8)
+            result["fifo"] = yield from bus.read(I2C_FIFO_ADDR)
+            # the bus is passed through again
+            yield from bus.write(I2C_FIFO_ADDR, (0x68 << 1) | I2C_START)
+            yield from bus.write(I2C_FIFO_ADDR, 1 | I2C_STOP)
+            while not ((yield from bus.read(I2C_FIFO_ADDR)) & I2C_IDLE):
+                pass
+            result["pointer"] = dut.si5324.pointer
+
+        run_simulation(dut, [gen(), dut.devices()])
+        status, _ = result["capture"]
+        self.assertEqual(status, CAPTURE_DONE | CAPTURE_ERROR)
+        self.assertFalse(result["fifo"] & I2C_ERROR)
+        self.assertEqual(result["pointer"], 1)
+
+    def test_busy(self):
+        dut = _TestSystem()
+        frames = []
+        result = {}
+
+        def gen():
+            bus, ctrl = dut.capture.bus, dut.capture.ctrl
+            yield from bus.write(I2C_CONFIG_ADDR, 4)
+            yield from ctrl.write(CAPTURE_DEV_ADDR, 0x68 << 1)
+            yield from ctrl.write(CAPTURE_REG_ADDR, 0)
+            yield from ctrl.write(CAPTURE_COUNT_ADDR, 16)
+            yield from ctrl.write(CAPTURE_CTRL_ADDR, CAPTURE_START)
+            yield
+            # acked at once, not stalled until the capture is done
+            result["fifo"] = yield from bus.read(I2C_FIFO_ADDR)
+            yield from bus.write(I2C_FIFO_ADDR,
+                                 (0x74 << 1) | I2C_START | I2C_STOP)
+            result["done"] = yield dut.capture.done
+            result["refused"] = yield from bus.read(I2C_FIFO_ADDR)
+            while (yield from ctrl.read(CAPTURE_CTRL_ADDR)) & CAPTURE_BUSY:
+                pass
+            result["xfer"] = yield from bus.read(I2C_XFER_ADDR)
+            result["after"] = yield from bus.read(I2C_FIFO_ADDR)
+            yield from bus.write(I2C_FIFO_ADDR, I2C_ERROR)
+            result["cleared"] = yield from bus.read(I2C_FIFO_ADDR)
+            for i in range(8):
+                yield
+
+        run_simulation(dut, [gen(), dut.devices(frames)])
+        self.assertEqual(result["fifo"] & (I2C_FULL | I2C_IDLE), I2C_FULL)
+        self.assertFalse(result["done"])
+        # the write was refused, and flagged until cleared
+        self.assertEqual(result["refused"] & (I2C_REFUSED | I2C_IDLE),
+                         I2C_REFUSED)
+        self.assertTrue(result["xfer"] & I2C_REFUSED)
+        self.assertEqual(result["after"] & (I2C_REFUSED | I2C_IDLE),
+                         I2C_REFUSED | I2C_IDLE)
+        self.assertEqual(result["cleared"] & (I2C_REFUSED | I2C_IDLE),
+                         I2C_IDLE)
+        self.assertEqual(frames, [[0x68 << 1, 0], [(0x68 << 1) | 1]])
+
+    def test_retry(self):
+        # a Sequencer sharing the bus retries the frame refused during the
+        # capture
+        program = [
+            InstWrite(I2C_CONFIG_ADDR, 4),
+            InstWaitEvent(0, 0),
+        ] + i2c_retry("write", [
+            InstI2CWrite(I2C_FIFO_ADDR, 0x68 << 1, 25, [0xa0]),
+        ], 3, 100, "fail") + [
+            InstEnd(),
+            Label("fail"),
+            InstAbort(),
+        ]
+        dut = _TestSystem()
+        dut.submodules.sequencer = Sequencer(program, dut.capture.bus)
+        frames = []
+        result = {}
+
+        def gen():
+            ctrl, seq = dut.capture.ctrl, dut.sequencer
+            for i in range(8):
+                yield
+            yield from ctrl.write(CAPTURE_DEV_ADDR, 0x68 << 1)
+            yield from ctrl.write(CAPTURE_REG_ADDR, 0)
+            yield from ctrl.write(CAPTURE_COUNT_ADDR, 16)
+            yield from ctrl.write(CAPTURE_CTRL_ADDR, CAPTURE_START)
+            yield seq.events.eq(1)
+            while (yield from seq.ctrl.read(SEQ_CTRL_ADDR)) & SEQ_RUNNING:
+                pass
+            result["status"] = yield from seq.ctrl.read(SEQ_CTRL_ADDR)
+
+        run_simulation(dut, [gen(), dut.devices(frames)])
+        self.assertEqual(result["status"], SEQ_DONE)
+        self.assertEqual(frames, [[0x68 << 1, 0], [(0x68 << 1) | 1],
+                                  [0x68 << 1, 25, 0xa0]])
+        self.assertEqual(dut.si5324.registers[25], 0xa0)
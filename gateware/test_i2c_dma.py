@@ -0,0 +1,344 @@
+import unittest
+
+from migen import *
+from misoc.interconnect import wishbone
+
+from i2c import *
+from i2c_capture import *
+from i2c_dma import *
+from i2c_sim import *
+
+
+class _TestSystem(Module):
+    def __init__(self):
+        self.pads = I2CPads()
+        self.submodules.master = I2CMaster(self.pads)
+        self.submodules.dma = I2CDMA(self.master)
+        self.switch = I2CSwitch()
+        self.si5324 = I2CRegisterDevice({134: 0x01, 135: 0x82})
+        # word addresses
+        self.memory = {}
+
+    def devices(self, frames=None):
+        return i2c_devices(self.master, self.pads, {
+            0x74: self.switch,
+            0x68: self.si5324,
+        }, frames)
+
+    @passive
+    def memory_slave(self, bus=None):
+        if bus is None:
+            bus = self.dma.dma
+        while True:
+            yield bus.ack.eq(0)
+            if (yield bus.cyc) and (yield bus.stb) and not (yield bus.ack):
+                adr = yield bus.adr
+                if (yield bus.we):
+                    sel = yield bus.sel
+                    mask = sum(0xff << 8*i for i in range(4) if sel & (1 << i))
+                    self.memory[adr] = ((self.memory.get(adr, 0) & ~mask) |
+                                        ((yield bus.dat_w) & mask))
+                else:
+                    yield bus.dat_r.eq(self.memory.get(adr, 0))
+                yield bus.ack.eq(1)
+            yield
+
+    # Writes the descriptors (dev, reg, flags, octets or length) and their
+    # buffers, returns the byte addresses of the descriptors
+    def load(self, descriptors, base=0x1000, buffers=0x2000):
+        addresses = [base + 4*DESC_WORDS*i for i in range(len(descriptors))]
+        for i, (dev, reg, flags, octets) in enumerate(descriptors):
+            buffer = buffers + 0x100*i
+            if isinstance(octets, int):
+                length = octets
+            else:
+                length = len(octets)
+                for j, octet in enumerate(octets):
+                    word = buffer//4 + j//4
+                    self.memory[word] = (self.memory.get(word, 0) |
+                                         octet << 8*(3 - j % 4))
+            following = addresses[i + 1] if i + 1 < len(addresses) else 0
+            words = [following, dev | (reg << 8) | flags, buffer, length,
+                     0xdeadbeef]
+            for j, word in enumerate(words):
+                self.memory[addresses[i]//4 + j] = word
+        return addresses
+
+    def status(self, address):
+        return self.memory[address//4 + DESC_WORDS - 1]
+
+    def buffer(self, address, length):
+        buffer = self.memory[address//4 + 2]
+        return [(self.memory.get(buffer//4 + j//4, 0) >> 8*(3 - j % 4)) & 0xff
+                for j in range(length)]
+
+
+# A CPU and the DMA engine as the two masters of one bus, as in the SoC:
+# the I2C registers at word 0, the DMA engine registers at word 0x100, and
+# the memory above. The grant only moves once the master holding it drops
+# cyc.
+class _SharedSystem(_TestSystem):
+    def __init__(self):
+        _TestSystem.__init__(self)
+        self.cpu = cpu = wishbone.Interface()
+        self.bus = bus = wishbone.Interface()
+        self.mem = wishbone.Interface()
+
+        ###
+
+        dma = self.dma.dma
+        grant = Signal()
+        self.sync += If(grant,
+            If(~dma.cyc & cpu.cyc, grant.eq(0)),
+        ).Else(
+            If(~cpu.cyc & dma.cyc, grant.eq(1)),
+        )
+        self.comb += If(grant,
+            dma.connect(bus),
+        ).Else(
+            cpu.connect(bus),
+        )
+
+        slaves = [
+            (self.dma.bus, bus.adr[:8], bus.adr[8:] == 0),
+            (self.dma.ctrl, bus.adr[:8], bus.adr[8:] == 1),
+            (self.mem, bus.adr, bus.adr[8:] > 1),
+        ]
+        for slave, adr, selected in slaves:
+            self.comb += [
+                slave.adr.eq(adr),
+                slave.dat_w.eq(bus.dat_w),
+                slave.sel.eq(bus.sel),
+                slave.we.eq(bus.we),
+                slave.cyc.eq(bus.cyc & selected),
+                slave.stb.eq(bus.stb & selected),
+                If(selected,
+                    bus.ack.eq(slave.ack),
+                    bus.dat_r.eq(slave.dat_r),
+                ),
+            ]
+
+
+# Fails instead of hanging if the access is never acked
+def _access(bus, adr, dat_w=None, timeout=1000):
+    yield bus.adr.eq(adr)
+    yield bus.sel.eq(0xf)
+    yield bus.cyc.eq(1)
+    yield bus.stb.eq(1)
+    if dat_w is not None:
+        yield bus.we.eq(1)
+        yield bus.dat_w.eq(dat_w)
+    yield
+    for i in range(timeout):
+        if (yield bus.ack):
+            break
+        yield
+    else:
+        raise AssertionError("access to {:#x} not acked".format(adr))
+    dat_r = yield bus.dat_r
+    yield bus.cyc.eq(0)
+    yield bus.stb.eq(0)
+    yield bus.we.eq(0)
+    yield
+    return dat_r
+
+
+def _run(ctrl, head):
+    yield from ctrl.write(DMA_HEAD_ADDR, head)
+    yield from ctrl.write(DMA_CTRL_ADDR, DMA_START)
+    while (yield from ctrl.read(DMA_CTRL_ADDR)) & DMA_BUSY:
+        pass
+    result = []
+    for address in DMA_CTRL_ADDR, DMA_CURRENT_ADDR, DMA_COUNT_ADDR:
+        result.append((yield from ctrl.read(address)))
+    return result
+
+
+class TestI2CDMA(OpenDrainMixin, unittest.TestCase):
+    def test_list(self):
+        dut = _TestSystem()
+        si5324 = 0x68 << 1
+        switch = 0x74 << 1
+        descriptors = dut.load([
+            (switch, 0, DESC_NO_REG, [0x80]),
+            (si5324, 25, 0, [0xa0]),
+            # across a word boundary
+            (si5324, 40, 0, [0x21, 0x02, 0x33, 0x44, 0x55]),
+            (si5324, 134, DESC_READ, 2),
+            (switch, 0, DESC_READ | DESC_NO_REG, 1),
+            (si5324, 40, DESC_READ, 5),
+        ])
+        buffer = dut.memory[descriptors[5]//4 + 2]
+        dut.memory[buffer//4 + 1] = 0x00c0ffee
+        frames = []
+        result = {}
+
+        def gen():
+            yield from dut.dma.bus.write(I2C_CONFIG_ADDR, 4)
+            result["dma"] = yield from _run(dut.dma.ctrl, descriptors[0])
+
+        run_simulation(dut, [gen(), dut.memory_slave(), dut.devices(frames)])
+        status, current, count = result["dma"]
+        self.assertEqual(status, DMA_DONE)
+        self.assertEqual(current, descriptors[-1])
+        self.assertEqual(count, 6)
+        self.assertEqual(frames, [
+            [switch, 0x80],
+            [si5324, 25, 0xa0],
+            [si5324, 40, 0x21, 0x02, 0x33, 0x44, 0x55],
+            [si5324, 134], [si5324 | 1],
+            [switch | 1],
+            [si5324, 40], [si5324 | 1],
+        ])
+        self.assertEqual(dut.switch.control, 0x80)
+        self.assertEqual(dut.si5324.registers[25], 0xa0)
+        self.assertEqual([dut.si5324.registers[reg] for reg in range(40, 45)],
+                         [0x21, 0x02, 0x33, 0x44, 0x55])
+        for address, length in zip(descriptors, [1, 1, 5, 2, 1, 5]):
+            self.assertEqual(dut.status(address), DESC_DONE | length)
+        self.assertEqual(dut.buffer(descriptors[3], 2), [0x01, 0x82])
+        self.assertEqual(dut.buffer(descriptors[4], 1), [0x80])
+        self.assertEqual(dut.buffer(descriptors[5], 5),
+                         [0x21, 0x02, 0x33, 0x44, 0x55])
+        # the rest of the last word is left alone
+        self.assertEqual(dut.memory[buffer//4 + 1], 0x55c0ffee)
+
+    def run_nack(self, flags):
+        dut = _TestSystem()
+        descriptors = dut.load([
+            (0x68 << 1, 25, 0, [0xa0]),
+            # no such device
+            (0x69 << 1, 25, flags, [0xa1, 0xa2]),
+            (0x68 << 1, 26, 0, [0xa3]),
+        ])
+        result = {}
+
+        def gen():
+            bus = dut.dma.bus
+            yield from bus.write(I2C_CONFIG_ADDR, 4)
+            result["dma"] = yield from _run(dut.dma.ctrl, descriptors[0])
+            result["fifo"] = yield from bus.read(I2C_FIFO_ADDR)
+
+        run_simulation(dut, [gen(), dut.memory_slave(), dut.devices()])
+        self.assertFalse(result["fifo"] & I2C_ERROR)
+        self.assertEqual(dut.status(descriptors[1]), DESC_DONE | DESC_NACK)
+        return dut, descriptors, result["dma"]
+
+    def test_nack(self):
+        dut, descriptors, (status, current, count) = self.run_nack(0)
+        self.assertEqual(status, DMA_DONE | DMA_ERROR)
+        self.assertEqual((current, count), (descriptors[1], 2))
+        self.assertEqual(dut.status(descriptors[2]), 0xdeadbeef)
+        self.assertNotIn(26, dut.si5324.registers)
+
+    def test_continue(self):
+        dut, descriptors, (status, current, count) = self.run_nack(
+            DESC_CONTINUE)
+        self.assertEqual(status, DMA_DONE | DMA_ERROR)
+        self.assertEqual((current, count), (descriptors[2], 3))
+        self.assertEqual(dut.status(descriptors[2]), DESC_DONE | 1)
+        self.assertEqual(dut.si5324.registers[26], 0xa3)
+
+    def test_shared_bus(self):
+        dut = _SharedSystem()
+        si5324 = 0x68 << 1
+        switch = 0x74 << 1
+        descriptors = dut.load([
+            (switch, 0, DESC_NO_REG, [0x80]),
+            (si5324, 25, 0, [0xa0]),
+            (si5324, 134, DESC_READ, 2),
+        ])
+        frames = []
+        result = {"fifo": []}
+
+        def cpu():
+            cpu = dut.cpu
+            yield from _access(cpu, I2C_CONFIG_ADDR, 4)
+            yield from _access(cpu, 0x100 + DMA_HEAD_ADDR, descriptors[0])
+            yield from _access(cpu, 0x100 + DMA_CTRL_ADDR, DMA_START)
+            # polls the I2C registers while the engine needs the bus
+            while True:
+                fifo = yield from _access(cpu, I2C_FIFO_ADDR)
+                if fifo & I2C_IDLE:
+                    result["idle"] = fifo
+                    break
+                if not result["fifo"]:
+                    # refused, and flagged
+                    yield from _access(cpu, I2C_FIFO_ADDR,
+                                       switch | I2C_START)
+                    yield from _access(cpu, I2C_FIFO_ADDR, 0x04 | I2C_STOP)
+                result["fifo"].append(fifo)
+            result["dma"] = yield from _access(cpu, 0x100 + DMA_CTRL_ADDR)
+            # passed through again, once the refusal is cleared
+            yield from _access(cpu, I2C_FIFO_ADDR, I2C_ERROR)
+            result["cleared"] = yield from _access(cpu, I2C_FIFO_ADDR)
+            yield from _access(cpu, I2C_FIFO_ADDR, switch | I2C_START)
+            yield from _access(cpu, I2C_FIFO_ADDR, 0x04 | I2C_STOP)
+            while not ((yield from _access(cpu, I2C_FIFO_ADDR)) & I2C_IDLE):
+                pass
+
+        run_simulation(dut, [cpu(), dut.memory_slave(dut.mem),
+                             dut.devices(frames)])
+        self.assertEqual(result["dma"], DMA_DONE)
+        self.assertTrue(result["fifo"])
+        for fifo in result["fifo"]:
+            self.assertEqual(fifo & (I2C_FULL | I2C_IDLE), I2C_FULL)
+        self.assertTrue(result["idle"] & I2C_REFUSED)
+        self.assertFalse(result["cleared"] & I2C_REFUSED)
+        self.assertEqual(frames, [
+            [switch, 0x80],
+            [si5324, 25, 0xa0],
+            [si5324, 134], [si5324 | 1],
+            [switch, 0x04],
+        ])
+        self.assertEqual(dut.switch.control, 0x04)
+        self.assertEqual(dut.buffer(descriptors[2], 2), [0x01, 0x82])
+
+    def test_chained(self):
+        dut = _TestSystem()
+        dut.submodules.capture = I2CCapture(dut.master)
+        dut.dma = I2CDMA(dut.master, dut.capture.bus)
+        dut.submodules += dut.dma
+        dut.comb += [
+            dut.capture.hold.eq(dut.dma.grant),
+            dut.dma.hold.eq(dut.capture.busy),
+        ]
+        si5324 = 0x68 << 1
+        switch = 0x74 << 1
+        descriptors = dut.load([
+            (si5324, 25, 0, [0xa0]),
+            (si5324, 26, 0, [0xa1]),
+        ])
+        frames = []
+        result = {}
+
+        def dma():
+            bus = dut.dma.bus
+            yield from bus.write(I2C_CONFIG_ADDR, 4)
+            yield from bus.write(I2C_FIFO_ADDR, switch | I2C_START)
+            yield from bus.write(I2C_FIFO_ADDR, 0x80 | I2C_STOP)
+            result["dma"] = yield from _run(dut.dma.ctrl, descriptors[0])
+
+        def capture():
+            ctrl = dut.capture.ctrl
+            yield from ctrl.write(CAPTURE_DEV_ADDR, si5324)
+            yield from ctrl.write(CAPTURE_REG_ADDR, 134)
+            yield from ctrl.write(CAPTURE_COUNT_ADDR, 2)
+            for i in range(32):
+                yield
+            yield from ctrl.write(CAPTURE_CTRL_ADDR, CAPTURE_START)
+            while (yield from ctrl.read(CAPTURE_CTRL_ADDR)) & CAPTURE_BUSY:
+                pass
+            result["capture"] = yield from ctrl.read(CAPTURE_DATA_BASE)
+
+        run_simulation(dut, [dma(), capture(), dut.memory_slave(),
+                             dut.devices(frames)])
+        self.assertEqual(result["dma"][0], DMA_DONE)
+        self.assertEqual(result["capture"] & 0xffff, 0x8201)
+        # the capture started with the list waiting, and ran first
+        self.assertEqual(frames, [
+            [switch, 0x80],
+            [si5324, 134], [si5324 | 1],
+            [si5324, 25, 0xa0],
+            [si5324, 26, 0xa1],
+        ])
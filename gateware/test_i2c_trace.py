@@ -0,0 +1,92 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from migen import *
+
+from i2c import *
+from i2c_sim import *
+from i2c_trace import *
+
+
+def _wait(bus):
+    while not ((yield from bus.read(I2C_XFER_ADDR)) & I2C_IDLE):
+        pass
+
+
+def _transfer(bus):
+    yield from bus.write(I2C_CONFIG_ADDR, 4)
+    for command in [I2C_START, I2C_WRITE | 0xd0, I2C_WRITE | 0x05,
+                    I2C_STOP | I2C_START, I2C_WRITE | 0xd1,
+                    I2C_READ | I2C_ACK, I2C_READ, I2C_STOP]:
+        yield from bus.write(I2C_XFER_ADDR, command)
+        yield from _wait(bus)
+
+
+class TestI2CTrace(OpenDrainMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_transfer(self, **kwargs):
+        pads = I2CPads()
+        dut = I2CMaster(pads)
+        device = I2CRegisterDevice({5: 0x12, 6: 0x34})
+        events = []
+        generators = [_transfer(dut.bus),
+                      i2c_devices(dut, pads, {0x68: device}),
+                      i2c_monitor(dut, events, **kwargs)]
+        return dut, events, generators
+
+    def test_decode(self):
+        log = io.StringIO()
+        dut, events, generators = self.run_transfer(log=log)
+        run_simulation(dut, generators)
+
+        bus = [event for event in events if event.kind in ("read", "write")]
+        self.assertEqual(bus[0].value, (I2C_CONFIG_ADDR, 4))
+        self.assertEqual(bus[1].value, (I2C_XFER_ADDR, I2C_START))
+        self.assertTrue(all(event.value[0] == I2C_XFER_ADDR
+                            for event in bus[1:]))
+
+        i2c = [event for event in events if event not in bus]
+        self.assertEqual([event[1:] for event in i2c], [
+            ("start", None, None),
+            ("addr", 0xd0, True),
+            ("data", 0x05, True),
+            ("restart", None, None),
+            ("addr", 0xd1, True),
+            ("data", 0x12, True),
+            ("data", 0x34, False),
+            ("stop", None, None),
+        ])
+        cycles = [event.cycle for event in events]
+        self.assertEqual(cycles, sorted(cycles))
+
+        lines = log.getvalue().splitlines()
+        self.assertEqual(lines, [format_event(event) for event in events])
+        self.assertIn(["DATA", "0x34", "NACK"],
+                      [line.split()[1:] for line in lines])
+
+    def test_bus_only(self):
+        dut, events, generators = self.run_transfer(wishbone=False)
+        run_simulation(dut, generators)
+        self.assertEqual(len(events), 8)
+
+    def test_vcd_window(self):
+        dut, events, generators = self.run_transfer(wishbone=False)
+        filename = os.path.join(self.tmp, "window.vcd")
+        generators.append(vcd_window([dut.scl_t.i, dut.sda_t.i, dut.bus.adr],
+                                     filename, 100, 200))
+        run_simulation(dut, generators)
+        with open(filename) as f:
+            vcd = f.read()
+        self.assertEqual(vcd.count("$var"), 3)
+        times = [int(line[1:]) for line in vcd.splitlines()
+                 if line.startswith("#")]
+        self.assertEqual(times, list(range(1000, 2000, 10)))
@@ -0,0 +1,43 @@
+import unittest
+
+from migen import *
+
+from lockdet import *
+
+
+class _TestSystem(Module):
+    def __init__(self, freq):
+        self.clock_domains.cd_clean = ClockDomain()
+        self.submodules.lock_detector = LockDetector(100e6, freq,
+                                                     gate_width=6)
+
+
+class TestLockDetector(unittest.TestCase):
+    def run_detector(self, freq, clean_period):
+        dut = _TestSystem(freq)
+        ld = dut.lock_detector
+        result = {}
+
+        def gen():
+            for _ in range(5*64):
+                yield
+            result["status"] = yield from ld.bus.read(LOCK_STATUS_ADDR)
+            result["count"] = yield from ld.bus.read(LOCK_COUNT_ADDR)
+            result["lock_cycles"] = yield from ld.bus.read(LOCK_CYCLES_ADDR)
+
+        run_simulation(dut, gen(), clocks={"sys": 10, "clean": clean_period})
+        return result
+
+    def test_locked(self):
+        result = self.run_detector(100e6, 10)
+        self.assertEqual(result["status"], LOCK_LOCKED)
+        self.assertIn(result["count"], range(63, 66))
+        # locked at the end of the second gate
+        self.assertIn(result["lock_cycles"], range(2*64, 3*64))
+
+    def test_half_frequency(self):
+        self.assertEqual(self.run_detector(50e6, 20)["status"], LOCK_LOCKED)
+        result = self.run_detector(100e6, 20)
+        self.assertEqual(result["status"], 0)
+        self.assertIn(result["count"], range(31, 34))
+        self.assertEqual(result["lock_cycles"], 0)
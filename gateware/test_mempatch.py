@@ -0,0 +1,60 @@
+import unittest
+
+from sequencer import *
+from sequencer import pack_program
+from mempatch import *
+
+
+class TestMemPatch(unittest.TestCase):
+    program = [
+        InstWrite(0, 0x12345),
+        InstWait(2, 1 << 13),
+        InstEnd(),
+    ]
+
+    def test_mem(self):
+        self.assertEqual(mem_data(self.program, depth=4),
+                         "@00000000\n"
+                         "10012345\n"
+                         "20202000\n"
+                         "00000000\n"
+                         "00000000\n")
+
+    def test_init(self):
+        self.assertEqual(init_data(self.program, depth=4),
+                         "10012345\n20202000\n00000000\n00000000\n")
+
+    def test_packed(self):
+        packed = pack_program(self.program)
+        self.assertEqual(mem_data(packed), mem_data(self.program))
+        self.assertEqual(len(mem_data(packed).splitlines()), 1 + PROGRAM_DEPTH)
+
+    def test_overflow(self):
+        with self.assertRaises(ValueError):
+            mem_data(self.program, depth=2)
+
+    def test_mmi(self):
+        self.assertEqual(mmi_data(depth=1024).encode(), b"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<MemInfo Version="1" Minor="0">
+  <Processor Endianness="Little" InstPath="sequencer">
+    <AddressSpace Name="sequencer_program" Begin="0" End="4095">
+      <BusBlock>
+        <BitLane MemType="RAMB36" Placement="X0Y0">
+          <DataWidth MSB="31" LSB="0"/>
+          <AddressRange Begin="0" End="1023"/>
+          <Parity ON="false" NumBits="0"/>
+        </BitLane>
+      </BusBlock>
+    </AddressSpace>
+  </Processor>
+  <Config>
+    <Option Name="Part" Val="xc7k325tffg900-2"/>
+  </Config>
+</MemInfo>
+""")
+
+    def test_constraints(self):
+        self.assertEqual(program_constraints(),
+            "set_property RAM_STYLE BLOCK [get_cells sequencer_program_reg]\n"
+            "set_property LOC RAMB36_X0Y0 [get_cells sequencer_program_reg]")
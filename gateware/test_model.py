@@ -0,0 +1,289 @@
+import time
+import unittest
+
+from migen import *
+
+from sequencer import *
+from i2c import *
+from si5324 import *
+from model import *
+from i2c_sim import *
+
+
+class _StatusDevice(I2CRegisterDevice):
+    # Returns the given octets in turn
+    def __init__(self, octets):
+        I2CRegisterDevice.__init__(self)
+        self.octets = list(octets)
+
+    def read(self):
+        return self.octets.pop(0)
+
+
+class _FlakyDevice(I2CRegisterDevice):
+    # NACKs the first writes to register 136
+    def __init__(self, nacks):
+        I2CRegisterDevice.__init__(self)
+        self.nacks = nacks
+
+    def write(self, octet):
+        if not self.addressed and octet == 136 and self.nacks:
+            self.nacks -= 1
+            return False
+        return I2CRegisterDevice.write(self, octet)
+
+
+def _flaky_ack(nacks):
+    # the same for the model
+    left = [nacks]
+
+    def ack(octets):
+        if octets[0] >> 1 != 0x68:
+            return False
+        if len(octets) == 2 and octets[1] == 136 and left[0]:
+            left[0] -= 1
+            return False
+        return True
+    return ack
+
+
+class TestModel(OpenDrainMixin, unittest.TestCase):
+    def simulate(self, program, fifo_depth, ack, devices=None, **kwargs):
+        dut = I2CSequencerSystem(program, fifo_depth, **kwargs)
+        bus = dut.sequencer.bus
+        i2c = dut.i2c_master.i2c
+        result = {"reads": 0, "writes": [], "frames": [],
+                  "octets": 0, "nacks": 0, "busy_cycles": 0, "polls": 0}
+
+        def gen():
+            n = 0
+            while (yield dut.sequencer.running):
+                if (yield bus.ack):
+                    if (yield bus.we):
+                        result["writes"].append(((yield bus.adr),
+                                                 (yield bus.dat_w)))
+                    else:
+                        result["reads"] += 1
+                        if (yield bus.adr) in (I2C_XFER_ADDR, I2C_FIFO_ADDR):
+                            result["polls"] += 1
+                result["octets"] += yield i2c.written
+                result["nacks"] += yield i2c.nack
+                result["busy_cycles"] += not (yield i2c.idle)
+                n += 1
+                yield
+            result["cycles"] = n
+            result["timeout"] = yield dut.sequencer.timeout
+            result["error"] = (yield dut.i2c_master.framer.error)
+            for name, address in [
+                    ("retired", SEQ_RETIRED_ADDR),
+                    ("wait_cycles", SEQ_WAIT_CYCLES_ADDR),
+                    ("write_cycles", SEQ_WRITE_CYCLES_ADDR),
+                    ("run_cycles", SEQ_RUN_CYCLES_ADDR)]:
+                result[name] = yield from dut.sequencer.ctrl.read(address)
+            if "mirror" in kwargs:
+                result["mirror"] = []
+                for reg in range(256):
+                    value = yield from dut.sequencer.ctrl.read(
+                        SEQ_MIRROR_BASE + reg)
+                    result["mirror"].append(value)
+
+        if devices is None:
+            slave = i2c_ack_slave(dut.i2c_master, dut.pads, ack,
+                                result["frames"])
+        else:
+            slave = i2c_devices(dut.i2c_master, dut.pads, devices,
+                                result["frames"])
+        run_simulation(dut, [gen(), slave])
+        return result
+
+    def check(self, program, fifo_depth=16, ack=lambda octets: True,
+              devices=None, read=None, **kwargs):
+        expected = self.simulate(program, fifo_depth, ack, devices, **kwargs)
+        model = SystemModel(program, fifo_depth, ack, read=read, **kwargs)
+        self.assertEqual(model.run(), expected["cycles"])
+        self.assertEqual(model.writes, expected["writes"])
+        self.assertEqual(model.reads, expected["reads"])
+        self.assertEqual(model.frames, expected["frames"])
+        self.assertEqual(model.sequencer.timeout, expected["timeout"])
+        self.assertEqual(model.i2c_master.error, expected["error"])
+        for name in "retired", "wait_cycles", "write_cycles", "run_cycles":
+            self.assertEqual(getattr(model.sequencer, name), expected[name])
+        for name in "octets", "nacks", "busy_cycles", "polls":
+            self.assertEqual(getattr(model.i2c_master, name), expected[name])
+        if "mirror" in kwargs:
+            self.assertEqual(model.sequencer.mirror, expected["mirror"])
+        return model
+
+    def sequence(self):
+        return i2c_sequence(0, 19, 1, 511, 31)[:3]
+
+    def test_xfer(self):
+        program = [InstWrite(I2C_CONFIG_ADDR, 3)]
+        for frame in self.sequence()[:2]:
+            program += [
+                InstWrite(I2C_XFER_ADDR, I2C_START),
+                InstWait(I2C_XFER_ADDR, I2C_IDLE),
+            ]
+            for octet in frame:
+                program += [
+                    InstWrite(I2C_XFER_ADDR, I2C_WRITE | octet),
+                    InstWait(I2C_XFER_ADDR, I2C_IDLE),
+                ]
+            program += [
+                InstWrite(I2C_XFER_ADDR, I2C_STOP),
+                InstWait(I2C_XFER_ADDR, I2C_IDLE),
+            ]
+        self.check(program + [InstEnd()])
+
+    def test_poll(self):
+        self.check([InstWrite(I2C_CONFIG_ADDR, 4)] +
+                   i2c_program(self.sequence()) + [InstEnd()])
+
+    def test_event(self):
+        self.check([InstWrite(I2C_CONFIG_ADDR, 5)] +
+                   i2c_program(self.sequence(), event=0) + [InstEnd()],
+                   fifo_depth=4)
+
+    def test_timeout(self):
+        self.check([InstWrite(I2C_CONFIG_ADDR, 2)] +
+                   i2c_program(self.sequence()[:1], event=0, timeout=1) +
+                   [InstWaitEvent(1, 1), InstWrite(0, 0x55), InstEnd()])
+
+    def test_nack(self):
+        self.check([InstWrite(I2C_CONFIG_ADDR, 1)] +
+                   i2c_program(self.sequence()[:2], event=0) + [InstEnd()],
+                   ack=ack_address(0x68))
+
+    def test_i2c_poll(self):
+        octets = [0x41, 0x03, 0x40, 0x55]
+        program = [
+            InstWrite(I2C_CONFIG_ADDR, 2),
+            InstI2CPoll(I2C_FIFO_ADDR, 0xd0, 130, 0x03, 0x00, 0),
+            InstI2CPoll(I2C_FIFO_ADDR, 0xd0, 131, 0xff, 0x55, 0),
+            InstEnd()
+        ]
+        self.check(program, devices={0x68: _StatusDevice(octets)},
+                   read=iter(octets).__next__)
+
+    def test_i2c_poll_timeout(self):
+        program = [
+            InstWrite(I2C_CONFIG_ADDR, 1),
+            InstI2CPoll(I2C_FIFO_ADDR, 0xd0, 130, 0x01, 0x00, 1),
+            InstWrite(0, 0x55),
+            InstEnd()
+        ]
+        self.check(program, devices={0x68: _StatusDevice([0x01]*100)},
+                   read=lambda: 0x01)
+
+    def test_mirror(self):
+        registers = {30: 0x55, 31: 0x11, 34: 0x66}
+        program = [
+            InstWrite(I2C_CONFIG_ADDR, 2),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 31, [0x01, 0x02, 0x03]),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd2, 40, [0x04]),
+            InstWait(I2C_FIFO_ADDR, I2C_IDLE),
+            InstI2CRead(I2C_FIFO_ADDR, 0xd0, 30, 5),
+            InstI2CUpdate(I2C_FIFO_ADDR, 0xd0, 31,
+                          [0x01, 0x07, 0x03, 0x66, 0x08]),
+            InstWait(I2C_FIFO_ADDR, I2C_IDLE),
+            # NACKed at the device address, the read is aborted
+            InstI2CRead(I2C_FIFO_ADDR, 0xd2, 50, 3),
+            InstI2CUpdate(I2C_FIFO_ADDR, 0xd0, 50, [0x0a, 0x09]),
+            InstWait(I2C_FIFO_ADDR, I2C_IDLE),
+            InstEnd()
+        ]
+        device = I2CRegisterDevice(registers)
+        model = self.check(program, ack=ack_address(0x68),
+                           devices={0x68: device},
+                           read=iter([0x55, 0x01, 0x02, 0x03, 0x66]).__next__,
+                           mirror={51: 0x09}, mirror_dev=0xd0)
+        self.assertEqual(model.frames[4:], [
+            [0xd0, 32, 0x07], [0xd0, 35, 0x08], [0xd2], [0xd0, 50, 0x0a]])
+        self.assertEqual(model.sequencer.mirror[30:36],
+                         [0x55, 0x01, 0x07, 0x03, 0x66, 0x08])
+        self.assertEqual(model.sequencer.mirror[40], 0x00)
+        self.assertEqual(model.sequencer.mirror[50:52], [0x0a, 0x09])
+        self.assertTrue(model.i2c_master.error)
+        for reg in range(30, 36):
+            self.assertEqual(device.registers[reg],
+                             model.sequencer.mirror[reg])
+
+    def test_retune(self):
+        # Changing NC1_LS rewrites a single register, and ICAL
+        clk_freq = 62.5e6
+        bringup = SystemModel(bringup_program(clk_freq, lock=False),
+                              mirror=SI5324_DEFAULTS, mirror_dev=0xd0)
+        bringup.run()
+        mirror = dict(enumerate(bringup.sequencer.mirror))
+        retune = SystemModel(retune_program(clk_freq, 2*clk_freq, lock=False),
+                             mirror=mirror, mirror_dev=0xd0)
+        retune.run()
+        self.assertEqual(retune.frames, [[0xd0, 33, 0x03], [0xd0, 136, 0x40]])
+        octets = sum(len(frame) for frame in retune.frames)
+        full = sum(len(frame) for frame in bringup.frames)
+        self.assertLess(4*octets, full)
+
+    def control_flow_program(self, retries):
+        return [
+            InstWrite(I2C_CONFIG_ADDR, 2),
+            InstLoad(1, 2),
+            Label("loop"),
+            InstCall("write"),
+            InstDelay(100),
+            InstLoop(1, "loop"),
+            InstBranch(I2C_CONFIG_ADDR, 0xff, 2, "skip"),
+            InstWrite(I2C_HOLD_ADDR, 0x55),
+            Label("skip"),
+        ] + i2c_retry("ical", [
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 136, [0x40]),
+        ], retries, 200, "fail") + [
+            InstEnd(),
+            Label("fail"),
+            InstAbort(),
+            Label("write"),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 1, [0x01]),
+            InstReturn(),
+        ]
+
+    def test_control_flow(self):
+        model = self.check(self.control_flow_program(3),
+                           devices={0x68: _FlakyDevice(2)},
+                           ack=_flaky_ack(2))
+        self.assertFalse(model.sequencer.timeout)
+        self.assertEqual(model.frames, [[0xd0, 1, 0x01]]*3 +
+                                       [[0xd0, 136]]*2 +
+                                       [[0xd0, 136, 0x40]])
+        self.assertNotIn((I2C_HOLD_ADDR, 0x55), model.writes)
+
+    def test_retry_fail(self):
+        model = self.check(self.control_flow_program(1),
+                           devices={0x68: _FlakyDevice(5)},
+                           ack=_flaky_ack(5))
+        self.assertTrue(model.sequencer.timeout)
+        self.assertEqual(model.frames[3:], [[0xd0, 136]]*2)
+
+    def test_bringup(self):
+        # The full bring-up at the real SCL rate, too long for migen
+        clk_freq = 62.5e6
+        program = bringup_program(clk_freq)
+        model = SystemModel(program)
+        t = time.monotonic()
+        cycles = model.run()
+        self.assertLess(time.monotonic() - t, 10)
+        self.assertFalse(model.sequencer.timeout)
+        expected = []
+        for inst in program:
+            if isinstance(inst, InstI2CWrite):
+                expected.append([inst.dev, inst.reg] + list(inst.data))
+            elif isinstance(inst, InstI2CPoll):
+                # the device is ready and locked at the first read
+                expected += [[inst.dev, inst.reg], [inst.dev | 1]]
+        self.assertEqual(model.frames, expected)
+        # 9 SCL periods of 2*(divider + 1) cycles, and the SCL synchronizer
+        # latency, per octet, START and STOP take a few more per frame
+        frames = len(model.frames)
+        reads = sum(isinstance(inst, InstI2CPoll) for inst in program)
+        octets = sum(len(frame) for frame in model.frames) + reads
+        period = 2*(i2c_divider(clk_freq, "fast") + 1) + 2
+        self.assertGreater(cycles, 9*octets*period)
+        self.assertLess(cycles, (9*octets + 5*frames)*period)
@@ -0,0 +1,58 @@
+import unittest
+
+from regmap import *
+from si5324 import *
+
+
+class TestRegmap(unittest.TestCase):
+    def test_compile(self):
+        phases = [
+            {1: 0x11, 2: 0x22, 3: 0x33, 5: 0x55, 7: 0x77, 8: 0x88, 20: 0x20},
+            {0: 0x00},
+        ]
+        defaults = {1: 0x11, 4: 0x44, 5: 0x55, 6: 0x66, 20: 0x00}
+        self.assertEqual(compile_writes(0xd0, phases, defaults), [
+            # 1 is at its reset value, 4 and 6 have no target value
+            [0xd0, 2, 0x22, 0x33],
+            # 5 is at its reset value but bridges 3 and 7
+            [0xd0, 7, 0x77, 0x88],
+            [0xd0, 20, 0x20],
+            # later phases are written later
+            [0xd0, 0, 0x00],
+        ])
+
+    def test_bridge(self):
+        phases = [{0: 0, 1: 1, 2: 2, 3: 3, 10: 10}]
+        defaults = {1: 1, 2: 2}
+        self.assertEqual(compile_writes(0xd0, phases, defaults),
+                         [[0xd0, 0, 0, 1, 2, 3], [0xd0, 10, 10]])
+        self.assertEqual(compile_writes(0xd0, phases, defaults, max_gap=1),
+                         [[0xd0, 0, 0], [0xd0, 3, 3], [0xd0, 10, 10]])
+
+    def test_max_burst(self):
+        phases = [{reg: reg for reg in range(20)}]
+        self.assertEqual(compile_writes(0xd0, phases, max_burst=15), [
+            [0xd0, 0] + list(range(0, 15)),
+            [0xd0, 15] + list(range(15, 20)),
+        ])
+
+    def test_cost(self):
+        sequence = [[0xd0, 0, 0], [0xd0, 1, 1, 2]]
+        self.assertEqual(i2c_cost(sequence, 100e3), (2, 7, (9*7 + 2*2)/100e3))
+
+    def test_si5324(self):
+        before = i2c_sequence(0, 19, 1, 511, 31, compile=False)
+        after = i2c_sequence(0, 19, 1, 511, 31)
+        self.assertEqual(after[-1], [(0x68 << 1), 136, 0x40])
+        frames_before, octets_before, _ = i2c_cost(before, 100e3)
+        frames_after, octets_after, _ = i2c_cost(after, 100e3)
+        self.assertLessEqual(2*frames_after, frames_before)
+        self.assertLess(octets_after, octets_before)
+
+    def test_cost_report(self):
+        before = [[0xd0, 0, 0], [0xd0, 1, 1]]
+        after = [[0xd0, 0, 0, 1]]
+        self.assertEqual(cost_report(before, after, 100e3).splitlines(), [
+            "before:   2 frames,    6 octets,    0.580 ms",
+            "after :   1 frames,    4 octets,    0.380 ms",
+        ])
@@ -3,9 +3,37 @@ import unittest
 from migen import *
 
 from sequencer import *
+from sequencer import encode, encode_program, pack_program, unpack_program
+from i2c import *
+from i2c_sim import *
+from si5324 import *
+from si5324_plan import *
+# $SIM_BACKEND selects the simulator
+from cosim import run_simulation
 
 
-class TestSequencer(unittest.TestCase):
+class _LockingDevice(I2CRegisterDevice):
+    # LOL_INT is cleared after a few reads
+    def __init__(self, reads):
+        I2CRegisterDevice.__init__(self)
+        self.lock_reads = reads
+
+    def read(self):
+        self.registers[130] = int(self.reads < self.lock_reads)
+        return I2CRegisterDevice.read(self)
+
+
+class _ZeroWaitTestSystem(Module):
+    def __init__(self, program, **kwargs):
+        self.submodules.sequencer = Sequencer(program, **kwargs)
+        bus = self.sequencer.bus
+        self.comb += [
+            bus.ack.eq(bus.cyc & bus.stb),
+            bus.dat_r.eq(0xfffff),
+        ]
+
+
+class TestSequencer(OpenDrainMixin, unittest.TestCase):
     def test_sequencer(self):
         program = [
             InstWrite(0, 0xaa),
@@ -64,3 +92,344 @@ class TestSequencer(unittest.TestCase):
                     raise ValueError
 
         run_simulation(dut, check())
+
+    def test_i2c_write(self):
+        program = [
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 0x10, [1, 2, 3, 4, 5]),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xe8, 0x80, []),
+            InstEnd()
+        ]
+        self.assertEqual(len(encode_program(program)), 5)
+        dut = Sequencer(program)
+        writes = []
+
+        def check():
+            for _ in range(200):
+                if (yield dut.bus.cyc) and (yield dut.bus.stb):
+                    self.assertTrue((yield dut.bus.we))
+                    writes.append(((yield dut.bus.adr), (yield dut.bus.dat_w)))
+                    yield dut.bus.ack.eq(1)
+                    yield
+                    yield dut.bus.ack.eq(0)
+                yield
+            self.assertTrue((yield dut.done))
+
+        run_simulation(dut, check())
+        self.assertEqual(writes, [(I2C_FIFO_ADDR, d) for d in [
+            I2C_START | 0xd0, 0x10, 1, 2, 3, 4, I2C_STOP | 5,
+            I2C_START | 0xe8, I2C_STOP | 0x80,
+        ]])
+
+    def test_si5324_program(self):
+        sequence = i2c_sequence(0, 19, 1, 511, 31)
+        program_xfer = [InstWrite(I2C_CONFIG_ADDR, 4)]
+        for subseq in sequence:
+            program_xfer += [
+                InstWrite(I2C_XFER_ADDR, I2C_START),
+                InstWait(I2C_XFER_ADDR, I2C_IDLE),
+            ]
+            for octet in subseq:
+                program_xfer += [
+                    InstWrite(I2C_XFER_ADDR, I2C_WRITE | octet),
+                    InstWait(I2C_XFER_ADDR, I2C_IDLE),
+                ]
+            program_xfer += [
+                InstWrite(I2C_XFER_ADDR, I2C_STOP),
+                InstWait(I2C_XFER_ADDR, I2C_IDLE),
+            ]
+        program_xfer += [InstEnd()]
+        program_macro = ([InstWrite(I2C_CONFIG_ADDR, 4)] +
+                         i2c_program(sequence) + [InstEnd()])
+
+        def run(program):
+            dut = I2CSequencerSystem(program)
+            cycles = []
+
+            def gen():
+                n = 0
+                while (yield dut.sequencer.running):
+                    n += 1
+                    yield
+                cycles.append(n)
+
+            run_simulation(dut, [gen(), dut.devices()])
+            return cycles[0]
+
+        cycles_xfer = run(program_xfer)
+        cycles_macro = run(program_macro)
+
+        rom_xfer = len(encode_program(program_xfer))
+        rom_macro = len(encode_program(program_macro))
+        self.assertGreater(rom_xfer, 4*rom_macro)
+        self.assertLess(cycles_macro, cycles_xfer)
+
+    def test_throughput(self):
+        program = [InstWrite(i & 1, i) for i in range(8)] + [
+            InstWait(0, 0x10),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 0x10, [1, 2, 3, 4, 5]),
+            InstWrite(1, 0x55),
+            InstEnd()
+        ]
+        dut = _ZeroWaitTestSystem(program)
+        bus = dut.sequencer.bus
+        accesses = []
+
+        def check():
+            cycle = 0
+            while (yield dut.sequencer.running):
+                if (yield bus.cyc) and (yield bus.stb):
+                    accesses.append(cycle)
+                cycle += 1
+                yield
+            # one cycle to read the first instruction, one to decode InstEnd
+            self.assertEqual(cycle, len(accesses) + 2)
+
+        run_simulation(dut, check())
+        self.assertEqual(len(accesses), 8 + 1 + 7 + 1)
+        self.assertEqual(accesses, list(range(1, len(accesses) + 1)))
+
+    def test_pipelined(self):
+        program = [InstWrite(I2C_HOLD_ADDR if i & 1 else I2C_CONFIG_ADDR, i)
+                   for i in range(1, 9)] + [
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 0x10, [1, 2, 3, 4, 5]),
+            InstEnd()
+        ]
+        for pipelined, spacing in (False, 2), (True, 1):
+            dut = I2CSequencerSystem(program, pipelined=pipelined)
+            bus = dut.sequencer.bus
+            accesses = []
+
+            def gen():
+                cycle = 0
+                while (yield dut.sequencer.running):
+                    if (yield bus.cyc) and (yield bus.stb) and (yield bus.ack):
+                        accesses.append(cycle)
+                    cycle += 1
+                    yield
+
+            run_simulation(dut, [gen(), dut.devices()])
+            with self.subTest(pipelined=pipelined):
+                self.assertEqual(len(accesses), 8 + 7)
+                self.assertEqual(accesses, list(range(
+                    accesses[0], accesses[0] + spacing*len(accesses),
+                    spacing)))
+
+    def test_wait_event(self):
+        sequence = i2c_sequence(0, 19, 1, 511, 31)[:3]
+        octets = sum(len(subseq) for subseq in sequence)
+
+        def run(event):
+            program = ([InstWrite(I2C_CONFIG_ADDR, 4)] +
+                       i2c_program(sequence, event=event) + [InstEnd()])
+            dut = I2CSequencerSystem(program)
+            bus = dut.sequencer.bus
+            transactions = []
+
+            def gen():
+                n = 0
+                while (yield dut.sequencer.running):
+                    if (yield bus.ack):
+                        n += 1
+                    yield
+                self.assertTrue((yield dut.i2c_master.idle))
+                self.assertFalse((yield dut.sequencer.timeout))
+                transactions.append(n)
+
+            run_simulation(dut, [gen(), dut.devices()])
+            return transactions[0]
+
+        self.assertGreater(run(None), 10*octets)
+        self.assertEqual(run(0), 1 + octets)
+
+    def test_timeout(self):
+        program = [
+            InstWaitEvent(1, 1),
+            InstWrite(0, 0x55),
+            InstEnd()
+        ]
+        dut = Sequencer(program)
+
+        def check():
+            for _ in range(4096):
+                self.assertTrue((yield dut.running))
+                yield
+            for _ in range(4):
+                yield
+            self.assertFalse((yield dut.running))
+            self.assertFalse((yield dut.done))
+            self.assertTrue((yield dut.timeout))
+            self.assertFalse((yield dut.bus.cyc))
+            self.assertEqual((yield from dut.ctrl.read(SEQ_CTRL_ADDR)),
+                             SEQ_TIMEOUT)
+
+        run_simulation(dut, check())
+
+    def test_status(self):
+        program = [InstWrite(0, 0x11), InstEnd(), InstAbort()]
+        dut = _ZeroWaitTestSystem(program, autostart=False)
+        seq = dut.sequencer
+        status = []
+
+        def gen():
+            # never started
+            status.append((yield from seq.ctrl.read(SEQ_CTRL_ADDR)))
+            yield from seq.ctrl.write(SEQ_CTRL_ADDR, SEQ_START)
+            while (yield from seq.ctrl.read(SEQ_CTRL_ADDR)) & SEQ_RUNNING:
+                pass
+            status.append((yield from seq.ctrl.read(SEQ_CTRL_ADDR)))
+            # InstAbort
+            yield from seq.ctrl.write(SEQ_PROGRAM_BASE,
+                                      encode(InstAbort())[0])
+            yield from seq.ctrl.write(SEQ_CTRL_ADDR, SEQ_START)
+            while (yield from seq.ctrl.read(SEQ_CTRL_ADDR)) & SEQ_RUNNING:
+                pass
+            status.append((yield from seq.ctrl.read(SEQ_CTRL_ADDR)))
+
+        run_simulation(dut, gen())
+        self.assertEqual(status, [0, SEQ_DONE, SEQ_TIMEOUT])
+
+    def test_reload(self):
+        program = [InstWrite(0, 0x11), InstEnd()]
+        new_program = [InstWrite(1, 0x22), InstWrite(0, 0x33), InstEnd()]
+        self.assertEqual(unpack_program(pack_program(new_program)),
+                         encode_program(new_program))
+        dut = _ZeroWaitTestSystem(program, depth=8)
+        seq = dut.sequencer
+        writes = []
+
+        @passive
+        def monitor():
+            while True:
+                if (yield seq.bus.cyc) and (yield seq.bus.stb):
+                    writes.append(((yield seq.bus.adr), (yield seq.bus.dat_w)))
+                yield
+
+        def gen():
+            while (yield seq.running):
+                yield
+            self.assertEqual((yield from seq.ctrl.read(SEQ_CTRL_ADDR)),
+                             SEQ_DONE)
+            words = unpack_program(pack_program(new_program))
+            for i, word in enumerate(words):
+                yield from seq.ctrl.write(SEQ_PROGRAM_BASE + i, word)
+            self.assertEqual((yield from seq.ctrl.read(SEQ_PROGRAM_BASE + 1)),
+                             encode(new_program[1])[0])
+            yield from seq.ctrl.write(SEQ_CTRL_ADDR, SEQ_START)
+            self.assertEqual((yield from seq.ctrl.read(SEQ_CTRL_ADDR)),
+                             SEQ_RUNNING)
+            while (yield seq.running):
+                yield
+
+        run_simulation(dut, [gen(), monitor()])
+        self.assertEqual(writes, [(0, 0x11), (1, 0x22), (0, 0x33)])
+
+    def test_autostart(self):
+        program = [InstWrite(0, 0x11), InstEnd()]
+        dut = _ZeroWaitTestSystem(program, autostart=False)
+        seq = dut.sequencer
+        writes = []
+
+        def gen():
+            for _ in range(16):
+                writes.append((yield seq.bus.cyc))
+                yield
+            yield from seq.ctrl.write(SEQ_CTRL_ADDR, SEQ_START)
+            for _ in range(16):
+                writes.append((yield seq.bus.cyc))
+                yield
+
+        run_simulation(dut, gen())
+        self.assertEqual(sum(writes[:16]), 0)
+        self.assertEqual(sum(writes[16:]), 1)
+
+    def test_counters(self):
+        program = [
+            InstWrite(0, 0x11),
+            InstWaitEvent(0, 0),
+            InstWait(1, 0x10),
+            InstI2CWrite(I2C_FIFO_ADDR, 0xd0, 0x10, [1, 2, 3]),
+            InstEnd()
+        ]
+        dut = _ZeroWaitTestSystem(program)
+        seq = dut.sequencer
+        counters = {}
+
+        def gen():
+            n = 0
+            while (yield seq.running):
+                if n == 10:
+                    yield seq.events.eq(1)
+                n += 1
+                yield
+            for address in (SEQ_RETIRED_ADDR, SEQ_WAIT_CYCLES_ADDR,
+                            SEQ_WRITE_CYCLES_ADDR, SEQ_RUN_CYCLES_ADDR):
+                counters[address] = yield from seq.ctrl.read(address)
+            self.assertEqual(counters[SEQ_RUN_CYCLES_ADDR], n)
+            yield from seq.ctrl.write(SEQ_CTRL_ADDR, SEQ_START)
+            self.assertEqual((yield from seq.ctrl.read(SEQ_RETIRED_ADDR)), 0)
+
+        run_simulation(dut, gen())
+        self.assertEqual(counters[SEQ_RETIRED_ADDR], len(program))
+        self.assertEqual(counters[SEQ_WRITE_CYCLES_ADDR], 1 + 1 + 4)
+        self.assertGreater(counters[SEQ_WAIT_CYCLES_ADDR], 10)
+        # one cycle to read the first instruction, one to decode InstEnd
+        self.assertEqual(counters[SEQ_WAIT_CYCLES_ADDR] +
+                         counters[SEQ_WRITE_CYCLES_ADDR] + 2,
+                         counters[SEQ_RUN_CYCLES_ADDR])
+
+    def test_i2c_poll(self):
+        for pipelined in False, True:
+            with self.subTest(pipelined=pipelined):
+                self.run_i2c_poll(pipelined)
+
+    def run_i2c_poll(self, pipelined):
+        program = [
+            InstWrite(I2C_CONFIG_ADDR, 1),
+            InstI2CPoll(I2C_FIFO_ADDR, 0xd0, 130, 0x01, 0x00, 1),
+            InstWrite(I2C_CONFIG_ADDR, 2),
+            InstI2CPoll(I2C_FIFO_ADDR, 0xd2, 130, 0x01, 0x00, 1),
+            InstEnd()
+        ]
+        self.assertEqual(len(encode_program(program)), 7)
+        dut = I2CSequencerSystem(program, pipelined=pipelined)
+        dut.si5324 = _LockingDevice(3)
+        result = {}
+
+        def gen():
+            while (yield dut.sequencer.running):
+                yield
+            result["timeout"] = yield dut.sequencer.timeout
+            result["config"] = yield dut.i2c_master.i2c.cg.load
+
+        run_simulation(dut, [gen(), dut.devices()])
+        self.assertEqual(dut.si5324.reads, 4)
+        # the second poll is NACKed until the timeout
+        self.assertTrue(result["timeout"])
+        self.assertEqual(result["config"], 2)
+
+    def test_retune(self):
+        clk_freq = 62.5e6
+        program = with_divider(
+            bringup_program(clk_freq, lock=False)[:-1] +
+            retune_program(clk_freq, 2*clk_freq, snapshot=True, lock=False),
+            4)
+        dut = I2CSequencerSystem(program, registers=SI5324_DEFAULTS,
+                                 mirror=SI5324_DEFAULTS, mirror_dev=0xd0)
+        mirror = {}
+
+        def gen():
+            while (yield dut.sequencer.running):
+                yield
+            for reg in range(256):
+                mirror[reg] = yield from dut.sequencer.ctrl.read(
+                    SEQ_MIRROR_BASE + reg)
+
+        run_simulation(dut, [gen(), dut.devices()])
+        expected = {}
+        for phase in si5324_registers(*plan_registers(solve(clk_freq,
+                                                            2*clk_freq))):
+            expected.update(phase)
+        for reg, value in expected.items():
+            self.assertEqual(dut.si5324.registers[reg], value)
+        self.assertEqual(mirror, {reg: dut.si5324.registers.get(reg, 0)
+                                  for reg in range(256)})
@@ -0,0 +1,53 @@
+import os
+import json
+import tempfile
+import unittest
+
+from si5324_plan import *
+
+
+class TestSi5324Plan(unittest.TestCase):
+    def test_dspllsim(self):
+        # Plans previously copied from DSPLLsim are valid...
+        self.assertTrue(check_plan(125e6, 125e6,
+                                   Si5324Plan(5, 8, 7, 360, 63)))
+        self.assertTrue(check_plan(62.5e6, 62.5e6,
+                                   Si5324Plan(4, 20, 5, 512, 32)))
+        # ...and the solver finds the same phase detector and VCO frequencies.
+        for f, n31 in (125e6, 63), (62.5e6, 32):
+            plan = solve(f, f, cache_dir=None)
+            self.assertTrue(check_plan(f, f, plan))
+            self.assertEqual(plan.N31, n31)
+            self.assertEqual(plan.N1_HS*plan.NC1_LS*f, 5e9)
+
+    def test_registers(self):
+        self.assertEqual(plan_registers(Si5324Plan(4, 20, 5, 512, 32)),
+                         (0, 19, 1, 511, 31))
+
+    def test_sweep(self):
+        fins = [10e6, 25e6, 62.5e6, 100e6, 125e6, 156.25e6]
+        fouts = [2e3, 44.1e3, 10e6, 62.5e6, 125e6, 155.52e6, 156.25e6,
+                 622.08e6]
+        for fin in fins:
+            for fout in fouts:
+                plan = solve(fin, fout, cache_dir=None)
+                self.assertTrue(check_plan(fin, fout, plan), (fin, fout, plan))
+
+    def test_no_plan(self):
+        with self.assertRaises(ValueError):
+            solve(1e3, 62.5e6, cache_dir=None)
+        with self.assertRaises(ValueError):
+            solve(62.5e6, 1, cache_dir=None)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            plan = solve(62.5e6, 125e6, cache_dir=cache_dir)
+            with open(os.path.join(cache_dir, "plans.json")) as f:
+                cache = json.load(f)
+            self.assertEqual(cache, {"62500000:125000000": list(plan)})
+
+            cache["62500000:125000000"] = [4, 20, 5, 512, 32]
+            with open(os.path.join(cache_dir, "plans.json"), "w") as f:
+                json.dump(cache, f)
+            self.assertEqual(solve(62.5e6, 125e6, cache_dir=cache_dir),
+                             Si5324Plan(4, 20, 5, 512, 32))